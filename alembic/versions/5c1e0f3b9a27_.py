@@ -0,0 +1,53 @@
+"""prebuffer jobs
+
+Revision ID: 5c1e0f3b9a27
+Revises: 28a8fddff848
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c1e0f3b9a27'
+down_revision: Union[str, Sequence[str], None] = '28a8fddff848'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "prebuffer_jobs",
+        sa.Column("room_id", sa.Uuid(), nullable=False),
+        sa.Column("file_index", sa.Integer(), nullable=False),
+        sa.Column("byte_start", sa.BigInteger(), nullable=False),
+        sa.Column("byte_end", sa.BigInteger(), nullable=True),
+        sa.Column(
+            "status",
+            sa.Enum(
+                "queued", "running", "done", "cancelled", "failed",
+                name="prebufferstatusenum",
+            ),
+            nullable=False,
+        ),
+        sa.Column("downloaded", sa.BigInteger(), nullable=False),
+        sa.Column("total", sa.BigInteger(), nullable=False),
+        sa.Column("error", sa.String(length=256), nullable=False),
+        sa.Column("created_at", sa.Float(), nullable=False),
+        sa.Column("job_id", sa.Uuid(), nullable=False),
+        sa.ForeignKeyConstraint(["room_id"], ["rooms.room_id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("job_id"),
+    )
+    op.create_index(
+        op.f("ix_prebuffer_jobs_room_id"), "prebuffer_jobs", ["room_id"], unique=False
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f("ix_prebuffer_jobs_room_id"), table_name="prebuffer_jobs")
+    op.drop_table("prebuffer_jobs")
@@ -0,0 +1,61 @@
+"""content addressed torrent files
+
+Revision ID: 9d4b7e2c61f0
+Revises: 5c1e0f3b9a27
+Create Date: 2026-10-19 13:00:00.000000
+
+"""
+import os
+from pathlib import Path
+from typing import Sequence, Union
+
+from alembic import op
+import libtorrent as lt
+import sqlalchemy as sa
+
+from config import TORRENT_FILES_SAVE_PATH
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9d4b7e2c61f0'
+down_revision: Union[str, Sequence[str], None] = '5c1e0f3b9a27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Move torrent files of rooms to paths named by their infohash."""
+    bind = op.get_bind()
+    rows = bind.execute(
+        sa.text(
+            "SELECT room_id, video_source_data FROM rooms "
+            "WHERE video_source = 'torrent'"
+        )
+    ).all()
+    old_paths: set[str] = set()
+    new_paths: set[str] = set()
+    for room_id, torrent_path in rows:
+        old_path = Path(torrent_path)
+        if not old_path.is_file():
+            continue
+        content = old_path.read_bytes()
+        new_path = TORRENT_FILES_SAVE_PATH / str(
+            lt.torrent_info(content).info_hashes().get_best()
+        )
+        if not new_path.exists():
+            os.makedirs(TORRENT_FILES_SAVE_PATH, exist_ok=True)
+            new_path.write_bytes(content)
+        bind.execute(
+            sa.text("UPDATE rooms SET video_source_data = :path WHERE room_id = :id"),
+            {"path": new_path.as_posix(), "id": room_id},
+        )
+        old_paths.add(old_path.as_posix())
+        new_paths.add(new_path.as_posix())
+    for old_path in old_paths - new_paths:
+        Path(old_path).unlink(missing_ok=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # Infohash named files are valid paths for the old code as well.
+    pass
@@ -0,0 +1,106 @@
+"""torrent manifests
+
+Revision ID: b7a3c9e1d542
+Revises: 9d4b7e2c61f0
+Create Date: 2026-10-19 14:00:00.000000
+
+"""
+from pathlib import Path
+from typing import Sequence, Union
+
+from alembic import op
+import libtorrent as lt
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7a3c9e1d542'
+down_revision: Union[str, Sequence[str], None] = '9d4b7e2c61f0'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    manifests = op.create_table(
+        "torrent_manifests",
+        sa.Column("infohash", sa.String(length=64), nullable=False),
+        sa.Column("torrent_path", sa.String(length=256), nullable=False),
+        sa.Column("name", sa.String(length=1024), nullable=False),
+        sa.Column("piece_length", sa.Integer(), nullable=False),
+        sa.Column("pieces_count", sa.Integer(), nullable=False),
+        sa.Column("total_size", sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint("infohash"),
+        sa.UniqueConstraint("torrent_path"),
+    )
+    files = op.create_table(
+        "torrent_manifest_files",
+        sa.Column("infohash", sa.String(length=64), nullable=False),
+        sa.Column("file_index", sa.Integer(), nullable=False),
+        sa.Column("sorted_index", sa.Integer(), nullable=False),
+        sa.Column("name", sa.String(length=1024), nullable=False),
+        sa.Column("path", sa.String(length=4096), nullable=False),
+        sa.Column("size", sa.BigInteger(), nullable=False),
+        sa.Column("offset", sa.BigInteger(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["infohash"], ["torrent_manifests.infohash"], ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("infohash", "file_index"),
+    )
+    backfill(manifests, files)
+
+
+def backfill(manifests: sa.Table, files: sa.Table) -> None:
+    """Parses torrent files rooms already use"""
+    bind = op.get_bind()
+    paths = bind.execute(
+        sa.text(
+            "SELECT DISTINCT video_source_data FROM rooms "
+            "WHERE video_source = 'torrent'"
+        )
+    ).scalars()
+    seen: set[str] = set()
+    for torrent_path in paths:
+        if not Path(torrent_path).is_file():
+            continue
+        ti = lt.torrent_info(torrent_path)
+        infohash = str(ti.info_hashes().get_best())
+        if infohash in seen:
+            continue
+        seen.add(infohash)
+        fs = ti.files()
+        order = sorted(range(ti.num_files()), key=fs.file_name)
+        op.bulk_insert(
+            manifests,
+            [
+                {
+                    "infohash": infohash,
+                    "torrent_path": torrent_path,
+                    "name": ti.name(),
+                    "piece_length": ti.piece_length(),
+                    "pieces_count": ti.num_pieces(),
+                    "total_size": ti.total_size(),
+                }
+            ],
+        )
+        op.bulk_insert(
+            files,
+            [
+                {
+                    "infohash": infohash,
+                    "file_index": file_index,
+                    "sorted_index": sorted_index,
+                    "name": fs.file_name(file_index),
+                    "path": fs.file_path(file_index),
+                    "size": fs.file_size(file_index),
+                    "offset": fs.file_offset(file_index),
+                }
+                for sorted_index, file_index in enumerate(order)
+            ],
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("torrent_manifest_files")
+    op.drop_table("torrent_manifests")
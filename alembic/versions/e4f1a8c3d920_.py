@@ -0,0 +1,111 @@
+"""natural file order
+
+Revision ID: e4f1a8c3d920
+Revises: b7a3c9e1d542
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+import re
+from typing import Any, Callable, Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e4f1a8c3d920'
+down_revision: Union[str, Sequence[str], None] = 'b7a3c9e1d542'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Copied from lib.torrent.file_index, so the migration keeps its meaning
+_DIGITS = re.compile(r"(\d+)")
+
+
+def natural_order(files: list[tuple[int, str]]) -> list[tuple[int, str]]:
+    def key(f: tuple[int, str]) -> tuple[Any, ...]:
+        parts = _DIGITS.split(f[1].casefold())
+        natural = tuple(int(p) if i % 2 else p for i, p in enumerate(parts))
+        return natural, f[1], f[0]
+
+    return sorted(files, key=key)
+
+
+def name_order(files: list[tuple[int, str]]) -> list[tuple[int, str]]:
+    return sorted(files, key=lambda f: f[1])
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    reorder(natural_order)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    reorder(name_order)
+
+
+def reorder(
+    order: Callable[[list[tuple[int, str]]], list[tuple[int, str]]],
+) -> None:
+    """Renumbers sorted indexes of stored manifests and the file indexes
+    rooms and pre-buffer jobs point to"""
+    bind = op.get_bind()
+    manifests = bind.execute(
+        sa.text("SELECT infohash, torrent_path FROM torrent_manifests")
+    ).all()
+    for infohash, torrent_path in manifests:
+        rows = bind.execute(
+            sa.text(
+                "SELECT file_index, sorted_index, name FROM torrent_manifest_files "
+                "WHERE infohash = :infohash ORDER BY file_index"
+            ),
+            {"infohash": infohash},
+        ).all()
+        old_sorted = {sorted_index: file_index for file_index, sorted_index, _ in rows}
+        new_sorted = {
+            file_index: i
+            for i, (file_index, _) in enumerate(order([(r[0], r[2]) for r in rows]))
+        }
+        remap = {old: new_sorted[fi] for old, fi in old_sorted.items()}
+        if all(old == new for old, new in remap.items()):
+            continue
+        for file_index, sorted_index in new_sorted.items():
+            bind.execute(
+                sa.text(
+                    "UPDATE torrent_manifest_files SET sorted_index = :sorted_index "
+                    "WHERE infohash = :infohash AND file_index = :file_index"
+                ),
+                {
+                    "sorted_index": sorted_index,
+                    "infohash": infohash,
+                    "file_index": file_index,
+                },
+            )
+        rooms = bind.execute(
+            sa.text(
+                "SELECT room_id, last_file_ind FROM rooms "
+                "WHERE video_source = 'torrent' AND video_source_data = :path"
+            ),
+            {"path": torrent_path},
+        ).all()
+        for room_id, last_file_ind in rooms:
+            bind.execute(
+                sa.text("UPDATE rooms SET last_file_ind = :fi WHERE room_id = :room_id"),
+                {"fi": remap.get(last_file_ind, 0), "room_id": room_id},
+            )
+            jobs = bind.execute(
+                sa.text(
+                    "SELECT job_id, file_index FROM prebuffer_jobs "
+                    "WHERE room_id = :room_id"
+                ),
+                {"room_id": room_id},
+            ).all()
+            for job_id, file_index in jobs:
+                bind.execute(
+                    sa.text(
+                        "UPDATE prebuffer_jobs SET file_index = :fi "
+                        "WHERE job_id = :job_id"
+                    ),
+                    {"fi": remap.get(file_index, file_index), "job_id": job_id},
+                )
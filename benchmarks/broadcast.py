@@ -0,0 +1,102 @@
+"""Measures what broadcasting a command to a room costs the server with
+commands encoded once per broadcast and once per connection.
+
+    python -m benchmarks.broadcast [--sizes 10 100 1000] [--repeat 20]
+
+Connections are fake and send nothing, so the times are the encoding,
+queueing and writer work of the server alone. For every room size it broadcasts a
+user joining and the users list, the two commands serialized by Pydantic.
+"""
+
+import argparse
+import asyncio
+import time
+
+from lib.commands.server_commands import (
+    ServerCommand,
+    UserConnectedCommand,
+    UsersListCommand,
+)
+from lib.connections import Connection, ConnectionsManager
+from schemas.user_schemas import GetUserSchema
+
+
+class NullWebSocket:
+    async def accept(self):
+        pass
+
+    async def send_text(self, text: str):
+        pass
+
+
+async def room(size: int) -> ConnectionsManager:
+    manager = ConnectionsManager()
+    for i in range(size):
+        _ = await manager.add_connection(
+            Connection(NullWebSocket()),  # pyright: ignore[reportArgumentType]
+            GetUserSchema(name=f"viewer{i}"),
+        )
+    return manager
+
+
+def per_connection(manager: ConnectionsManager, cmd: ServerCommand):
+    """Broadcast as it was done before, each connection encodes the command"""
+    for conn in manager.conns.values():
+        conn.send(cmd)
+
+
+async def timed(broadcast, repeat: int) -> float:
+    """Milliseconds per broadcast, until the writers sent it"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        broadcast()
+        await asyncio.sleep(0)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+async def measure(size: int, repeat: int):
+    manager = await room(size)
+    joined = UserConnectedCommand(manager.conns_users[size - 1])
+
+    def users_list() -> UsersListCommand:
+        return UsersListCommand(manager.get_users())
+
+    def changed_users_list():
+        # A join or leave between two broadcasts drops the cached frame
+        manager._users_frame = None  # pyright: ignore[reportPrivateUsage]
+        manager.send_room_text(manager.users_list_frame())
+
+    cases = {
+        "user joined": (
+            lambda: per_connection(manager, joined),
+            lambda: manager.send_room(joined),
+        ),
+        "users list": (
+            lambda: per_connection(manager, users_list()),
+            lambda: manager.send_room_text(manager.users_list_frame()),
+        ),
+        "users list, changed": (
+            lambda: per_connection(manager, users_list()),
+            changed_users_list,
+        ),
+    }
+    for name, (before, after) in cases.items():
+        old = await timed(before, repeat)
+        new = await timed(after, repeat)
+        print(
+            f"{size:>5} conns, {name:<20}: {old:8.3f} ms per connection,"
+            + f" {new:8.3f} ms once ({old / new:.0f}x)"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    for size in args.sizes:
+        asyncio.run(measure(size, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
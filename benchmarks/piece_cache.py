@@ -0,0 +1,87 @@
+"""Replays synthetic viewing sessions against the piece cache policies and
+prints their hit rates.
+
+    python -m benchmarks.piece_cache [--viewers 12] [--capacity 64] [--seed 1]
+
+Viewers of a few rooms watch the same episode at different positions. Every
+one of them reads the container header and the tail index first, most watch
+the opening, some skip to the first chapter, and now and then they rewind a
+little. Steps of all viewers are interleaved, so they compete for the cache.
+"""
+
+import argparse
+import random
+from collections.abc import Iterator
+
+from lib.torrent.piece_cache import PieceCache, piece_cache_policies
+
+PIECES = 2000
+HEADER_PIECES = 4
+TAIL_PIECES = 2
+OPENING_PIECES = 40
+CHAPTERS = (OPENING_PIECES, 500, 1000, 1500)
+STEP_S = 0.25  # simulated time between two reads of a viewer
+WATCH_PIECES = 400  # per session
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now: float = 0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def session(rng: random.Random) -> Iterator[int]:
+    """Pieces one viewer reads, in order"""
+    yield from range(HEADER_PIECES)
+    yield from range(PIECES - TAIL_PIECES, PIECES)
+    piece = rng.choice(CHAPTERS) if rng.random() < 0.3 else 0
+    watched = 0
+    while watched < WATCH_PIECES and piece < PIECES:
+        yield piece
+        watched += 1
+        piece += 1
+        if rng.random() < 0.02:
+            piece = max(0, piece - rng.randint(4, 16))
+        elif rng.random() < 0.005:
+            piece = rng.choice(CHAPTERS)
+
+
+def replay(cache: PieceCache, clock: Clock, viewers: int, seed: int) -> float:
+    rng = random.Random(seed)
+    pending = {viewer: session(rng) for viewer in range(viewers)}
+    # Viewers join one after another
+    joins = {viewer: viewer * rng.randint(20, 120) for viewer in range(viewers)}
+    step = 0
+    while pending:
+        for viewer in list(pending):
+            if joins[viewer] > step:
+                continue
+            piece = next(pending[viewer], None)
+            if piece is None:
+                cache.clear_playhead(viewer)
+                del pending[viewer]
+                continue
+            cache.set_playhead(viewer, piece)
+            if cache.get(piece) is None:
+                cache.put(piece, b"")
+        step += 1
+        clock.now = step * STEP_S
+    return cache.hit_rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--viewers", type=int, default=12)
+    parser.add_argument("--capacity", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    for name, policy in piece_cache_policies.items():
+        clock = Clock()
+        hit_rate = replay(policy(args.capacity, clock), clock, args.viewers, args.seed)
+        print(f"{name:>12}: {hit_rate:.1%} hit rate")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,11 +7,60 @@ DB_URL = os.environ.get("DB_URL", "sqlite+aiosqlite:///test.db")
 
 TORRENT_SAVE_PATH = Path("torrents")
 TORRENT_FILES_SAVE_PATH = Path("torrent_files")
+LINK_CACHE_PATH = Path("link_cache")
 MAX_TORRENT_FILE_SIZE = 5 * 1024 * 1024  # 5 megabytes
 
+# File lists of this many torrents are kept in memory
+FILE_INDEX_CACHE_SIZE = int(os.environ.get("FILE_INDEX_CACHE_SIZE", 64))
+FILES_PAGE_MAX_LIMIT = 500
+
 ROOM_INACTIVITY_PERIOD = 10 * 60  # 10 minutes
+# Frames queued for a slow websocket client before its status frames are coalesced, it is dropped if that is not enough
+WS_OUTBOX_MAX_FRAMES = int(os.environ.get("WS_OUTBOX_MAX_FRAMES", 256))
+# Torrent engine of a loaded room is stopped after this long without viewers or requests
+VIDEO_ENGINE_IDLE_PERIOD = int(os.environ.get("VIDEO_ENGINE_IDLE_PERIOD", 2 * 60))
+# Unreferenced torrent files are collected this often while the server runs
+TORRENT_GC_PERIOD = int(os.environ.get("TORRENT_GC_PERIOD", 60 * 60))
+
+# Start downloading the next file of a torrent once this part of the current one is watched
+NEXT_FILE_PREFETCH_AT = float(os.environ.get("NEXT_FILE_PREFETCH_AT", 0.8))
+
+# Bytes of a video response read ahead while the previous ones are sent
+STREAM_PREFETCH_BYTES = int(os.environ.get("STREAM_PREFETCH_BYTES", 4 * 1024 * 1024))
+# Serve finished blocks of torrent pieces before the whole piece passes its hash check, a failed piece was already sent
+SUB_PIECE_STREAMING = os.environ.get("SUB_PIECE_STREAMING", "0") == "1"
+
+# Video responses are paced to this multiple of the file's bitrate once their burst is sent, 0 disables pacing
+PACING_BITRATE_MULTIPLE = float(os.environ.get("PACING_BITRATE_MULTIPLE", 0))
+# Bytes at the start of a paced response that go out at full speed
+PACING_BURST_BYTES = int(os.environ.get("PACING_BURST_BYTES", 16 * 1024 * 1024))
+# Bytes up to this many seconds of video after the room's playhead are never paced
+PACING_FREE_AHEAD_S = int(os.environ.get("PACING_FREE_AHEAD_S", 30))
+
+# "popularity" keeps often read pieces and those around playheads in memory, "lru" the latest ones
+PIECE_CACHE_POLICY = os.environ.get("PIECE_CACHE_POLICY", "popularity")
+
+# "local" runs libtorrent in the web process, "process" in a separate worker
+TORRENT_ENGINE_MODE = os.environ.get("TORRENT_ENGINE_MODE", "local")
+
+# "redirect" sends viewers of link rooms to the link, "proxy" serves it from a range cache on disk
+LINK_MODE = os.environ.get("LINK_MODE", "redirect")
+# Disk space taken by the range cache of one link room
+LINK_CACHE_MAX_BYTES = int(os.environ.get("LINK_CACHE_MAX_BYTES", 1024**3))
+
+# Background pre-buffering of torrent rooms
+# Download rate of pre-buffering in bytes per second, 0 is unlimited
+PREBUFFER_DOWNLOAD_LIMIT = int(os.environ.get("PREBUFFER_DOWNLOAD_LIMIT", 0))
+# Disk space all active pre-buffering jobs may take together
+PREBUFFER_MAX_BYTES = int(os.environ.get("PREBUFFER_MAX_BYTES", 50 * 1024**3))
+PREBUFFER_MIN_FREE_DISK = int(os.environ.get("PREBUFFER_MIN_FREE_DISK", 1024**3))
 
 AUTH_SECRET_KEY = os.environ.get("AUTH_SECRET_KEY", "SOME RANDOM AUTH KEY(change for prod use)").encode("utf-8")
 PW_SECRET_KEY = os.environ.get("PW_SECRET_KEY", "SOME SECRET PW KEY(change for prod use)").encode("utf-8")
+VIDEO_URL_SECRET_KEY = os.environ.get(
+    "VIDEO_URL_SECRET_KEY", "SOME VIDEO URL KEY(change for prod use)"
+).encode("utf-8")
 
 ACCESS_TOKEN_EXPIRE = timedelta(days=30)  # one month
+# Signed video URLs are valid for at least this long, in seconds
+VIDEO_URL_EXPIRE = int(os.environ.get("VIDEO_URL_EXPIRE", 6 * 60 * 60))
@@ -8,11 +8,25 @@ export interface Room {
 }
 
 export interface RoomWatching extends Room {
-  files: [number, string][];
+  files_count: number;
   curr_fi: number;
   video: string | null;
 }
 
+export interface RoomFile {
+  index: number;
+  name: string;
+  size: number;
+  kind: 'video' | 'subtitle' | 'other';
+}
+
+export interface RoomFiles {
+  total: number;
+  offset: number;
+  limit: number;
+  files: RoomFile[];
+}
+
 export interface User {
   name: string;
 }
@@ -84,6 +98,10 @@ export async function getRoom(roomId: string): Promise<RoomWatching> {
   return request<RoomWatching>(`/rooms/${roomId}`);
 }
 
+export async function getRoomFiles(roomId: string, offset: number, limit: number): Promise<RoomFiles> {
+  return request<RoomFiles>(`/rooms/${roomId}/files?offset=${offset}&limit=${limit}`);
+}
+
 export async function deleteRoom(roomId: string): Promise<void> {
   return request<void>(`/rooms/${roomId}`, { method: 'DELETE' });
 }
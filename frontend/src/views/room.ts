@@ -1,9 +1,12 @@
-import { getRoom, getVideoUrl, type RoomWatching } from '../api.ts';
+import { getRoom, getRoomFiles, getVideoUrl, type RoomWatching } from '../api.ts';
 import { navigateTo } from '../router.ts';
 import { checkAuth, logout, getCurrentUser } from '../auth.ts';
 import { connectRoomSocket, type RoomSocket } from '../ws.ts';
 import { SyncPlayer } from '../player.ts';
 
+// Largest page the server hands out
+const FILES_PAGE_SIZE = 500;
+
 export async function renderRoom(): Promise<void> {
   const app = document.getElementById('app');
   if (!app) return;
@@ -114,16 +117,22 @@ export async function renderRoom(): Promise<void> {
   const titleEl = document.getElementById('room-title');
   if (titleEl) titleEl.textContent = room.name;
 
-  // Populate file select
+  // Populate file select page by page, the player does not wait for it
   const fileSelect = document.getElementById('file-select') as HTMLSelectElement | null;
   if (fileSelect) {
-    for (const [fi, name] of room.files) {
-      const opt = document.createElement('option');
-      opt.value = String(fi);
-      opt.textContent = name;
-      if (fi === room.curr_fi) opt.selected = true;
-      fileSelect.appendChild(opt);
-    }
+    void (async () => {
+      for (let offset = 0; offset < room.files_count; offset += FILES_PAGE_SIZE) {
+        const page = await getRoomFiles(roomId, offset, FILES_PAGE_SIZE);
+        for (const file of page.files) {
+          const opt = document.createElement('option');
+          opt.value = String(file.index);
+          opt.textContent = file.name;
+          if (file.index === room.curr_fi) opt.selected = true;
+          fileSelect.appendChild(opt);
+        }
+        if (page.files.length < FILES_PAGE_SIZE) break;
+      }
+    })();
     fileSelect.addEventListener('change', () => {
       const fi = parseInt(fileSelect.value, 10);
       if (!isNaN(fi)) {
@@ -8,8 +8,17 @@ export type ServerCommand =
   | { type: 'ua'; users: { conn_id: number; user_data: { name: string } }[] }
   | { type: 'uc'; user: { conn_id: number; user_data: { name: string } } }
   | { type: 'ud'; conn_id: number }
+  | { type: 'bs'; state: BufferState }
   | { type: 'unknown'; raw: string };
 
+export interface BufferState {
+  file_size: number;
+  ranges: [number, number][];
+  download_rate: number;
+  peers: number;
+  at_risk: boolean;
+}
+
 function parseCommand(raw: string): ServerCommand {
   const [prefix, ...rest] = raw.split(' ');
   const payload = rest.join(' ');
@@ -42,6 +51,13 @@ function parseCommand(raw: string): ServerCommand {
     }
     case 'ud':
       return { type: 'ud', conn_id: parseInt(payload, 10) };
+    case 'bs': {
+      try {
+        return { type: 'bs', state: JSON.parse(payload) };
+      } catch {
+        return { type: 'unknown', raw };
+      }
+    }
     default:
       return { type: 'unknown', raw };
   }
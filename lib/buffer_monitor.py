@@ -0,0 +1,108 @@
+from enum import Enum
+
+from lib.logger import Logging
+from lib.video_status.video_statuses import PlayStatus, SuspendStatus, VideoStatus
+from schemas.buffer_schemas import BufferStateSchema
+
+# Connection ids start from 0, so a negative id can't clash with a viewer.
+SERVER_SUSPENDER_ID = -1
+
+BUFFER_CHECK_SLEEP = 1
+LOW_BUFFER_S = 4
+RESUME_BUFFER_S = 15
+
+BUFFER_STATE_MIN_INTERVAL_S = 2
+BUFFER_STATE_MAX_INTERVAL_S = 30
+BUFFER_STATE_BYTES_CHANGE = 0.01  # part of the file size
+BUFFER_STATE_RATE_CHANGE = 0.25
+BUFFER_STATE_MIN_RATE = 64 * 1024  # bytes per second
+
+
+class BufferAction(Enum):
+    SUSPEND = "suspend"
+    RESUME = "resume"
+
+
+class BufferMonitor(Logging):
+    """Decides when the server itself should suspend the room because there
+    is not enough data ahead of the playhead, with hysteresis between the
+    suspend and resume thresholds."""
+
+    def __init__(
+        self,
+        low_buffer_s: float = LOW_BUFFER_S,
+        resume_buffer_s: float = RESUME_BUFFER_S,
+    ) -> None:
+        self.low_buffer_s: float = low_buffer_s
+        self.resume_buffer_s: float = resume_buffer_s
+
+    @staticmethod
+    def is_suspended(status: VideoStatus) -> bool:
+        return (
+            isinstance(status, SuspendStatus)
+            and SERVER_SUSPENDER_ID in status.suspend_by
+        )
+
+    @staticmethod
+    def wants_playback(status: VideoStatus) -> bool:
+        if isinstance(status, SuspendStatus):
+            return status.change_to is PlayStatus
+        return isinstance(status, PlayStatus)
+
+    def decide(
+        self, status: VideoStatus, buffered_s: float | None
+    ) -> BufferAction | None:
+        suspended = self.is_suspended(status)
+        if buffered_s is None:
+            return BufferAction.RESUME if suspended else None
+        if suspended:
+            if buffered_s >= self.resume_buffer_s or not self.wants_playback(status):
+                return BufferAction.RESUME
+            return None
+        if isinstance(status, PlayStatus) and buffered_s < self.low_buffer_s:
+            return BufferAction.SUSPEND
+        return None
+
+
+def _ranges_bytes(ranges: list[tuple[int, int]]) -> int:
+    return sum(end - start for start, end in ranges)
+
+
+class BufferStateThrottle:
+    """Lets a buffer state through only when it differs meaningfully from
+    the last one that was sent, and not more often than the min interval."""
+
+    def __init__(self) -> None:
+        self.last: BufferStateSchema | None = None
+        self.last_sent_at: float = 0
+
+    def changed(self, state: BufferStateSchema) -> bool:
+        last = self.last
+        if last is None:
+            return True
+        if (
+            state.file_size != last.file_size
+            or state.peers != last.peers
+            or state.at_risk != last.at_risk
+        ):
+            return True
+        bytes_diff = abs(_ranges_bytes(state.ranges) - _ranges_bytes(last.ranges))
+        if bytes_diff >= state.file_size * BUFFER_STATE_BYTES_CHANGE:
+            return True
+        top_rate = max(state.download_rate, last.download_rate)
+        rate_diff = abs(state.download_rate - last.download_rate)
+        return top_rate >= BUFFER_STATE_MIN_RATE and (
+            rate_diff >= top_rate * BUFFER_STATE_RATE_CHANGE
+        )
+
+    def should_send(self, state: BufferStateSchema, now: float) -> bool:
+        if self.last is None:
+            return True
+        since_last = now - self.last_sent_at
+        if since_last < BUFFER_STATE_MIN_INTERVAL_S:
+            return False
+        return since_last >= BUFFER_STATE_MAX_INTERVAL_S or self.changed(state)
+
+    def mark_sent(self, state: BufferStateSchema, now: float):
+        self.last = state
+        self.last_sent_at = now
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from collections.abc import Callable
 from typing import Self, override
 
 from lib.logger import Logging
@@ -6,6 +7,12 @@ from lib.video_status.status_storage import StatusHandler
 
 client_commands: dict[str, type["ClientCommand"]] = {}
 
+# Jumps in video time bigger than this are treated as seeks, smaller ones
+# are just clients catching up with the room clock.
+SEEK_THRESHOLD_S = 3
+
+SeekListener = Callable[[float], None]
+
 
 def register_client_command(cls: type["ClientCommand"]) -> type["ClientCommand"]:
     if cls.prefix in client_commands:
@@ -57,6 +64,8 @@ class ChangeFileClientCommand(StateChangeClientCommand):
 
 
 class StatusChangeClientCommand(StateChangeClientCommand, ABC):
+    prefetch_on_seek: bool = True
+
     def __init__(self, by: int, video_time: float) -> None:
         super().__init__(by)
         self.video_time: float = video_time
@@ -70,6 +79,12 @@ class StatusChangeClientCommand(StateChangeClientCommand, ABC):
         except (IndexError, ValueError) as exc:
             raise ParseFailedException(exc)
 
+    def is_seek(self, status_handler: StatusHandler) -> bool:
+        if not self.prefetch_on_seek:
+            return False
+        room_time = status_handler.status.video_time
+        return abs(self.video_time - room_time) > SEEK_THRESHOLD_S
+
     @override
     def handle(self, status_handler: StatusHandler):
         _ = status_handler.set_video_time(self.video_time)
@@ -108,6 +123,7 @@ class PlayClientCommand(StatusChangeClientCommand):
 @register_client_command
 class PauseClientCommand(StatusChangeClientCommand):
     prefix: str = "pa"
+    prefetch_on_seek: bool = False
 
     @override
     def handle(self, status_handler: StatusHandler):
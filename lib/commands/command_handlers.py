@@ -4,7 +4,9 @@ from typing import override
 
 from lib.commands.client_commands import (
     ClientCommand,
+    SeekListener,
     StateChangeClientCommand,
+    StatusChangeClientCommand,
     client_commands,
 )
 from lib.logger import Logging
@@ -22,9 +24,12 @@ class CommandTypeHandler(ABC):
 class StateChangeCommandsHandler(CommandTypeHandler):
     handle_type: type[ClientCommand] = StateChangeClientCommand
 
-    def __init__(self, status_storage: StatusHandler) -> None:
+    def __init__(
+        self, status_storage: StatusHandler, seek_listener: SeekListener | None = None
+    ) -> None:
         super().__init__()
         self.status_storage: StatusHandler = status_storage
+        self.seek_listener: SeekListener | None = seek_listener
 
     @override
     def handle(self, cmd: ClientCommand):
@@ -33,6 +38,12 @@ class StateChangeCommandsHandler(CommandTypeHandler):
         self.handle_status_change_cmd(cmd)
 
     def handle_status_change_cmd(self, cmd: StateChangeClientCommand):
+        if (
+            self.seek_listener is not None
+            and isinstance(cmd, StatusChangeClientCommand)
+            and cmd.is_seek(self.status_storage)
+        ):
+            self.seek_listener(cmd.video_time)
         _ = cmd.handle(self.status_storage)
 
 
@@ -3,11 +3,14 @@ from dataclasses import dataclass
 import json
 from typing import override
 
+from schemas.buffer_schemas import BufferStateSchema
 from schemas.user_schemas import UserRoomSchema, UsersListSchema
 
 
 class ServerCommand(ABC):
     prefix: str
+    # Queued commands with the same key are superseded by the newest one
+    coalesce_key: str | None = None
 
     @abstractmethod
     def to_string(self) -> str: ...
@@ -16,6 +19,7 @@ class ServerCommand(ABC):
 @dataclass
 class StatusChangeServerCommand(ServerCommand, ABC):
     video_time: float
+    coalesce_key = "status"
 
     @override
     def to_string(self) -> str:
@@ -82,3 +86,14 @@ class UserDisconnectedCommand(ServerCommand):
     @override
     def to_string(self) -> str:
         return f"{self.prefix} {self.user_id}"
+
+
+@dataclass
+class BufferStateCommand(ServerCommand):
+    state: BufferStateSchema
+    prefix: str = "bs"
+    coalesce_key = "buffer"
+
+    @override
+    def to_string(self) -> str:
+        return f"{self.prefix} {self.state.model_dump_json()}"
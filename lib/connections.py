@@ -1,33 +1,110 @@
-from asyncio import gather
+import asyncio
+from collections import deque
 from collections.abc import Iterator
 from dataclasses import dataclass, field
 from itertools import count
 
-from fastapi import WebSocket
+from fastapi import WebSocket, WebSocketDisconnect
+from starlette import status
 
-from lib.commands.server_commands import ServerCommand
+import config
+from lib.commands.server_commands import ServerCommand, UsersListCommand
 from lib.logger import Logging
 from schemas.user_schemas import GetUserSchema, UserRoomSchema, UsersListSchema
 
+# Encoded command and its coalesce key
+Frame = tuple[str, str | None]
+
 
 @dataclass
 class Connection(Logging):
+    """A client of a room. Commands wait in a bounded outbox and a writer
+    task sends them, so nobody else waits for this client's network. When
+    the outbox is full, queued frames superseded by a newer one with the
+    same coalesce key are dropped. A client still too far behind is
+    disconnected."""
+
     ws_conn: WebSocket
+    outbox: deque[Frame] = field(default_factory=deque, init=False)
+    writer: asyncio.Task[None] | None = field(default=None, init=False)
+    _queued: asyncio.Event = field(default_factory=asyncio.Event, init=False)
+    _dropped: asyncio.Event = field(default_factory=asyncio.Event, init=False)
 
     async def accept(self):
         try:
             await self.ws_conn.accept()
         except RuntimeError as err:
             raise RuntimeError(f"Raise in accept: {err}") from err
+        self.writer = asyncio.create_task(self._write())
 
-    async def receive(self):
-        return await self.ws_conn.receive_text()
+    async def receive(self) -> str:
+        """Next message of the client, WebSocketDisconnect once it is dropped"""
+        receiving = asyncio.ensure_future(self.ws_conn.receive_text())
+        dropped = asyncio.ensure_future(self._dropped.wait())
+        done, _ = await asyncio.wait(
+            (receiving, dropped), return_when=asyncio.FIRST_COMPLETED
+        )
+        _ = dropped.cancel()
+        if receiving in done:
+            return receiving.result()
+        _ = receiving.cancel()
+        raise WebSocketDisconnect(status.WS_1008_POLICY_VIOLATION, "Too far behind")
 
-    async def send(self, cmd: ServerCommand):
-        try:
-            await self.ws_conn.send_text(cmd.to_string())
-        except RuntimeError as exc:
-            self.logger.debug(f"Got exc on send; cmd: {cmd}, exc: {type(exc)} {exc}")
+    @property
+    def dropped(self) -> bool:
+        return self._dropped.is_set()
+
+    def send(self, cmd: ServerCommand):
+        self.send_text(cmd.to_string(), cmd.coalesce_key)
+
+    def send_text(self, text: str, coalesce_key: str | None = None):
+        """Queues an already encoded command"""
+        if self.dropped:
+            return
+        if len(self.outbox) >= config.WS_OUTBOX_MAX_FRAMES:
+            self._coalesce(coalesce_key)
+        if len(self.outbox) >= config.WS_OUTBOX_MAX_FRAMES:
+            self.logger.warning(f"Dropping a client {len(self.outbox)} frames behind")
+            self.close()
+            return
+        self.outbox.append((text, coalesce_key))
+        self._queued.set()
+
+    def _coalesce(self, newest_key: str | None):
+        """Keeps only the newest queued frame of every coalesce key"""
+        seen: set[str] = set() if newest_key is None else {newest_key}
+        kept: deque[Frame] = deque()
+        for text, key in reversed(self.outbox):
+            if key is not None:
+                if key in seen:
+                    continue
+                seen.add(key)
+            kept.appendleft((text, key))
+        self.outbox = kept
+
+    async def _write(self):
+        while True:
+            while not self.outbox:
+                self._queued.clear()
+                _ = await self._queued.wait()
+            text, _ = self.outbox.popleft()
+            try:
+                await self.ws_conn.send_text(text)
+            except (WebSocketDisconnect, RuntimeError, OSError) as exc:
+                self.logger.debug(
+                    f"Got exc on send; cmd: {text[:64]}, exc: {type(exc)} {exc}"
+                )
+                self.writer = None
+                self.close()
+                return
+
+    def close(self):
+        """Stops sending, frames still queued are discarded"""
+        self._dropped.set()
+        self.outbox.clear()
+        if self.writer is not None:
+            _ = self.writer.cancel()
+            self.writer = None
 
 
 @dataclass
@@ -35,19 +112,25 @@ class ConnectionsManager:
     conns: dict[int, Connection] = field(default_factory=dict)
     conns_users: dict[int, UserRoomSchema] = field(default_factory=dict)
     conn_id_iter: Iterator[int] = field(default_factory=count)
+    # Encoded users list, until the next join or leave
+    _users_frame: str | None = field(default=None, init=False)
 
-    async def send_to(self, conn_id: int, cmd: ServerCommand):
+    def send_to(self, conn_id: int, cmd: ServerCommand):
+        self.send_text_to(conn_id, cmd.to_string(), cmd.coalesce_key)
+
+    def send_text_to(self, conn_id: int, text: str, coalesce_key: str | None = None):
         if conn_id not in self.conns:
             raise RuntimeError(f"Unknown id:{conn_id}")
-        conn = self.conns[conn_id]
-        try:
-            await conn.send(cmd)
-        except RuntimeError as exc:
-            raise RuntimeError(f"It's here: {exc}") from exc
+        self.conns[conn_id].send_text(text, coalesce_key)
 
     def get_users(self) -> UsersListSchema:
         return UsersListSchema(users=list(self.conns_users.values()))
 
+    def users_list_frame(self) -> str:
+        if self._users_frame is None:
+            self._users_frame = UsersListCommand(self.get_users()).to_string()
+        return self._users_frame
+
     async def add_connection(
         self, conn: Connection, user: GetUserSchema
     ) -> UserRoomSchema:
@@ -55,22 +138,31 @@ class ConnectionsManager:
         conn_id = next(self.conn_id_iter)
         self.conns[conn_id] = conn
         self.conns_users[conn_id] = UserRoomSchema(conn_id=conn_id, user_data=user)
+        self._users_frame = None
         return self.conns_users[conn_id]
 
     def remove_connection(self, conn_id: int):
-        self.conns.pop(conn_id, None)
+        conn = self.conns.pop(conn_id, None)
+        if conn is not None:
+            conn.close()
         self.conns_users.pop(conn_id, None)
+        self._users_frame = None
 
-    async def send_room(self, cmd: ServerCommand, exclude: list[int] | None = None):
-        exclude = exclude or []
-        await gather(
-            *(
-                conn.send(cmd)
-                for conn_id, conn in self.conns.items()
-                if conn_id not in exclude
-            ),
-            return_exceptions=True,
-        )
+    def send_room(self, cmd: ServerCommand, exclude: list[int] | None = None):
+        """Encodes the command once for every connection and queues it,
+        without waiting for any network"""
+        self.send_room_text(cmd.to_string(), exclude, cmd.coalesce_key)
+
+    def send_room_text(
+        self,
+        text: str,
+        exclude: list[int] | None = None,
+        coalesce_key: str | None = None,
+    ):
+        excluded = set(exclude or ())
+        for conn_id, conn in self.conns.items():
+            if conn_id not in excluded:
+                conn.send_text(text, coalesce_key)
 
     def conn_count(self) -> int:
         return len(self.conns)
@@ -0,0 +1,18 @@
+import struct
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+
+class ContainerParseException(Exception): ...
+
+
+class UnknownContainerException(ContainerParseException): ...
+
+
+@contextmanager
+def parse_errors(what: str) -> Iterator[None]:
+    """Reading past the data of a broken file fails like any other parse error"""
+    try:
+        yield
+    except (struct.error, IndexError) as exc:
+        raise ContainerParseException(f"Malformed {what}: {exc}") from exc
@@ -0,0 +1,216 @@
+import asyncio
+import math
+from collections import OrderedDict
+from dataclasses import dataclass
+from itertools import pairwise
+
+from lib.containers.exceptions import (
+    ContainerParseException,
+    UnknownContainerException,
+    parse_errors,
+)
+from lib.containers.mp4 import Box, is_mp4, read_top_level_boxes, sidx_references
+from lib.containers.seek_index import ByteReader, exact_reader
+from lib.containers.ts import (
+    TS_PACKET_SIZE,
+    TsKeyframe,
+    find_keyframe,
+    is_ts,
+    last_pts,
+    pts_seconds,
+    video_pid,
+)
+
+FMP4_TARGET_SEGMENT_S = 6
+# TS has no index, every segment boundary costs a scan for a keyframe
+TS_TARGET_SEGMENT_S = 10
+TS_SCAN_STEP = TS_PACKET_SIZE * 1024
+TS_MAX_SCAN = 16 * 1024 * 1024
+MAX_PARALLEL_READS = 8
+
+
+@dataclass
+class HlsSegment:
+    offset: int
+    size: int
+    duration: float
+
+
+@dataclass
+class HlsPlaylist:
+    """VOD media playlist of byte ranges of a single file"""
+
+    segments: list[HlsSegment]
+    # Byte range of the fMP4 initialization section, ftyp and moov
+    init: tuple[int, int] | None = None
+    # Whether every segment starts with a keyframe
+    independent: bool = True
+
+    @property
+    def target_duration(self) -> int:
+        return math.ceil(max((s.duration for s in self.segments), default=1))
+
+    def render(self, uri: str) -> str:
+        lines = [
+            "#EXTM3U",
+            f"#EXT-X-VERSION:{6 if self.init is not None else 4}",
+            f"#EXT-X-TARGETDURATION:{self.target_duration}",
+            "#EXT-X-PLAYLIST-TYPE:VOD",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+        ]
+        if self.independent:
+            lines.append("#EXT-X-INDEPENDENT-SEGMENTS")
+        if self.init is not None:
+            offset, size = self.init
+            lines.append(f'#EXT-X-MAP:URI="{uri}",BYTERANGE="{size}@{offset}"')
+        for segment in self.segments:
+            lines += [
+                f"#EXTINF:{segment.duration:.3f},",
+                f"#EXT-X-BYTERANGE:{segment.size}@{segment.offset}",
+                uri,
+            ]
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+
+async def fmp4_playlist(read: ByteReader, file_size: int) -> HlsPlaylist:
+    """Segments are runs of sidx subsegments, each starting at a keyframe"""
+    boxes = await read_top_level_boxes(read, file_size)
+    moov = next((b for b in boxes if b.type == b"moov"), None)
+    if moov is None:
+        raise ContainerParseException("No moov box")
+    if not any(b.type in (b"moof", b"sidx") for b in boxes):
+        raise ContainerParseException("MP4 is not fragmented, HLS needs fMP4")
+    sidx = next((b for b in boxes if b.type == b"sidx"), None)
+    if sidx is None:
+        raise ContainerParseException("Fragmented MP4 has no sidx")
+    data = await read(sidx.offset, sidx.size)
+    local = Box(sidx.type, 0, sidx.header_size, sidx.size)
+    references = sidx_references(data, local, sidx.offset)
+    if not references or any(ref.is_index for ref in references):
+        raise ContainerParseException("sidx does not reference media directly")
+    if moov.end > references[0].offset:
+        raise ContainerParseException("moov follows media fragments")
+
+    segments: list[HlsSegment] = []
+    for ref in references:
+        last = segments[-1] if segments else None
+        if last is not None and (
+            not ref.starts_with_sap or last.duration < FMP4_TARGET_SEGMENT_S
+        ):
+            last.size += ref.size
+            last.duration += ref.duration
+        else:
+            segments.append(HlsSegment(ref.offset, ref.size, ref.duration))
+    return HlsPlaylist(segments, (0, moov.end))
+
+
+async def _scan_keyframe(
+    read: ByteReader, file_size: int, offset: int, pid: int
+) -> TsKeyframe | None:
+    limit = min(file_size, offset + TS_MAX_SCAN)
+    while offset < limit:
+        # Overlap by a packet so one split between reads is not missed
+        size = min(TS_SCAN_STEP + TS_PACKET_SIZE, file_size - offset)
+        keyframe = find_keyframe(await read(offset, size), offset, pid)
+        if keyframe is not None:
+            return keyframe
+        offset += TS_SCAN_STEP
+    return None
+
+
+def ts_estimated_playlist(file_size: int, duration: float) -> HlsPlaylist:
+    """Evenly sized segments at the average bitrate, nothing but the head
+    and the tail of the file is read. Segments don't start at keyframes."""
+    count = max(1, round(duration / TS_TARGET_SEGMENT_S))
+    packets = file_size // TS_PACKET_SIZE
+    offsets = [packets * k // count * TS_PACKET_SIZE for k in range(count)]
+    offsets.append(file_size)
+    return HlsPlaylist(
+        [
+            HlsSegment(offset, end - offset, duration * (end - offset) / file_size)
+            for offset, end in pairwise(offsets)
+            if end > offset
+        ],
+        independent=False,
+    )
+
+
+async def ts_playlist(
+    read: ByteReader, file_size: int, head: bytes, scan: bool = True
+) -> HlsPlaylist:
+    """Boundaries are keyframes found near evenly spaced offsets, the
+    duration comes from the first and last timestamps of the video stream.
+    Without scan the boundaries are estimated instead."""
+    pid = video_pid(head)
+    first = find_keyframe(head, 0, pid)
+    if first is None:
+        raise ContainerParseException("No keyframe at the start")
+    tail_start = max(0, file_size - TS_SCAN_STEP)
+    end_pts = last_pts(await read(tail_start, file_size - tail_start), pid)
+    duration = 0 if end_pts is None else pts_seconds(end_pts, first.pts)
+    if duration <= 0:
+        raise ContainerParseException("Unknown duration")
+    if not scan:
+        return ts_estimated_playlist(file_size, duration)
+
+    count = max(1, round(duration / TS_TARGET_SEGMENT_S))
+    slots = asyncio.Semaphore(MAX_PARALLEL_READS)
+
+    async def scan_at(offset: int) -> TsKeyframe | None:
+        async with slots:
+            return await _scan_keyframe(read, file_size, offset, pid)
+
+    keyframes = await asyncio.gather(
+        *(scan_at(file_size * k // count) for k in range(1, count))
+    )
+    boundaries = [(0, 0.0)]
+    for keyframe in keyframes:
+        if keyframe is None:
+            continue
+        time = pts_seconds(keyframe.pts, first.pts)
+        if keyframe.offset > boundaries[-1][0] and boundaries[-1][1] < time < duration:
+            boundaries.append((keyframe.offset, time))
+    boundaries.append((file_size, duration))
+    return HlsPlaylist(
+        [
+            HlsSegment(offset, next_offset - offset, next_time - time)
+            for (offset, time), (next_offset, next_time) in pairwise(boundaries)
+        ]
+    )
+
+
+async def build_hls_playlist(
+    read: ByteReader, file_size: int, scan: bool = True
+) -> HlsPlaylist:
+    """scan allows reading a TS file whole, for files on disk or cached"""
+    read = exact_reader(read)
+    head = await read(0, min(TS_SCAN_STEP, file_size))
+    with parse_errors("video"):
+        if is_ts(head):
+            return await ts_playlist(read, file_size, head, scan)
+        if is_mp4(head):
+            return await fmp4_playlist(read, file_size)
+    raise UnknownContainerException(f"Unknown container: {head[:8]!r}")
+
+
+class HlsPlaylistStorage:
+    """Least recently used playlists, by the ETag of their file"""
+
+    MAX_PLAYLISTS: int = 64
+    playlists: OrderedDict[str, HlsPlaylist] = OrderedDict()
+
+    @classmethod
+    def get(cls, key: str) -> HlsPlaylist | None:
+        playlist = cls.playlists.get(key)
+        if playlist is not None:
+            cls.playlists.move_to_end(key)
+        return playlist
+
+    @classmethod
+    def put(cls, key: str, playlist: HlsPlaylist) -> HlsPlaylist:
+        cls.playlists[key] = playlist
+        cls.playlists.move_to_end(key)
+        while len(cls.playlists) > cls.MAX_PLAYLISTS:
+            _ = cls.playlists.popitem(last=False)
+        return playlist
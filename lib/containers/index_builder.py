@@ -0,0 +1,17 @@
+from lib.containers.exceptions import UnknownContainerException, parse_errors
+from lib.containers.mkv import is_mkv, mkv_seek_index
+from lib.containers.mp4 import is_mp4, mp4_seek_index
+from lib.containers.seek_index import ByteReader, SeekIndex, exact_reader
+
+PROBE_SIZE = 16
+
+
+async def build_seek_index(read: ByteReader, file_size: int) -> SeekIndex:
+    read = exact_reader(read)
+    head = await read(0, min(PROBE_SIZE, file_size))
+    with parse_errors("video"):
+        if is_mkv(head):
+            return await mkv_seek_index(read, file_size)
+        if is_mp4(head):
+            return await mp4_seek_index(read, file_size)
+    raise UnknownContainerException(f"Unknown container: {head[:8]!r}")
@@ -0,0 +1,207 @@
+import struct
+from collections.abc import Iterator
+from dataclasses import dataclass
+
+from lib.containers.exceptions import ContainerParseException, parse_errors
+from lib.containers.seek_index import ByteReader, SeekIndex, SeekPoint
+
+EBML_ID = 0x1A45DFA3
+SEGMENT_ID = 0x18538067
+SEEK_HEAD_ID = 0x114D9B74
+SEEK_ID = 0x4DBB
+SEEK_ELEMENT_ID = 0x53AB
+SEEK_POSITION_ID = 0x53AC
+INFO_ID = 0x1549A966
+TIMECODE_SCALE_ID = 0x2AD7B1
+DURATION_ID = 0x4489
+CUES_ID = 0x1C53BB6B
+CUE_POINT_ID = 0xBB
+CUE_TIME_ID = 0xB3
+CUE_TRACK_POSITIONS_ID = 0xB7
+CUE_CLUSTER_POSITION_ID = 0xF1
+CLUSTER_ID = 0x1F43B675
+
+DEFAULT_TIMECODE_SCALE = 1_000_000  # nanoseconds
+HEAD_SIZE = 64 * 1024
+MAX_ELEMENT_HEADER_SIZE = 12  # 4 bytes of id and 8 of size
+MAX_CUES_SIZE = 16 * 1024 * 1024
+
+
+@dataclass
+class Element:
+    id: int
+    data_offset: int
+    size: int | None  # None stands for the unknown size
+
+    @property
+    def end(self) -> int | None:
+        return None if self.size is None else self.data_offset + self.size
+
+    @property
+    def known_end(self) -> int:
+        """End of an element that must have a size"""
+        if self.size is None:
+            raise ContainerParseException(f"Element {self.id:#x} has unknown size")
+        return self.data_offset + self.size
+
+
+def read_vint(
+    data: bytes, pos: int, keep_marker: bool = False
+) -> tuple[int | None, int]:
+    """Returns value of variable size integer and its length, value is None
+    for the reserved "unknown" size"""
+    if pos >= len(data):
+        raise ContainerParseException(f"Truncated vint at {pos}")
+    first = data[pos]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise ContainerParseException(f"Invalid vint at {pos}")
+    if pos + length > len(data):
+        raise ContainerParseException(f"Truncated vint at {pos}")
+    value = first if keep_marker else first & (0xFF >> length)
+    for byte in data[pos + 1 : pos + length]:
+        value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        return None, length
+    return value, length
+
+
+def parse_element_header(data: bytes, pos: int) -> Element:
+    element_id, id_length = read_vint(data, pos, keep_marker=True)
+    if element_id is None:
+        raise ContainerParseException(f"Invalid element id at {pos}")
+    size, size_length = read_vint(data, pos + id_length)
+    return Element(element_id, pos + id_length + size_length, size)
+
+
+def iter_elements(data: bytes, start: int, end: int) -> Iterator[Element]:
+    pos = start
+    while pos < end:
+        element = parse_element_header(data, pos)
+        if element.end is None or element.end > end:
+            raise ContainerParseException(f"Element {element.id:#x} overflows parent")
+        yield element
+        pos = element.end
+
+
+def read_uint(data: bytes, element: Element) -> int:
+    return int.from_bytes(data[element.data_offset : element.known_end], "big")
+
+
+def read_float(data: bytes, element: Element) -> float:
+    with parse_errors(f"float element {element.id:#x}"):
+        if element.size == 4:
+            return struct.unpack_from(">f", data, element.data_offset)[0]
+        if element.size == 8:
+            return struct.unpack_from(">d", data, element.data_offset)[0]
+    raise ContainerParseException(f"Invalid float size {element.size}")
+
+
+def parse_info(data: bytes, info: Element) -> tuple[int, float]:
+    """Returns timecode scale and duration in timecode ticks"""
+    scale, duration = DEFAULT_TIMECODE_SCALE, 0.0
+    for element in iter_elements(data, info.data_offset, info.known_end):
+        if element.id == TIMECODE_SCALE_ID:
+            scale = read_uint(data, element)
+        elif element.id == DURATION_ID:
+            duration = read_float(data, element)
+    if scale == 0:
+        raise ContainerParseException("Timecode scale is zero")
+    return scale, duration
+
+
+def parse_seek_head(data: bytes, seek_head: Element) -> dict[int, int]:
+    """Positions of top level elements relative to the segment data"""
+    positions: dict[int, int] = {}
+    for seek in iter_elements(data, seek_head.data_offset, seek_head.known_end):
+        if seek.id != SEEK_ID:
+            continue
+        seek_id, position = None, None
+        for element in iter_elements(data, seek.data_offset, seek.known_end):
+            if element.id == SEEK_ELEMENT_ID:
+                seek_id = read_uint(data, element)
+            elif element.id == SEEK_POSITION_ID:
+                position = read_uint(data, element)
+        if seek_id is not None and position is not None:
+            positions[seek_id] = position
+    return positions
+
+
+def parse_cues(
+    data: bytes, cues: Element, segment_start: int, scale: int
+) -> list[SeekPoint]:
+    points: list[SeekPoint] = []
+    for cue_point in iter_elements(data, cues.data_offset, cues.known_end):
+        if cue_point.id != CUE_POINT_ID:
+            continue
+        time, position = None, None
+        for element in iter_elements(data, cue_point.data_offset, cue_point.known_end):
+            if element.id == CUE_TIME_ID:
+                time = read_uint(data, element)
+            elif element.id == CUE_TRACK_POSITIONS_ID and position is None:
+                end = element.known_end
+                for track_element in iter_elements(data, element.data_offset, end):
+                    if track_element.id == CUE_CLUSTER_POSITION_ID:
+                        position = read_uint(data, track_element)
+        if time is not None and position is not None:
+            points.append(SeekPoint(time * scale / 1e9, segment_start + position))
+    return points
+
+
+def is_mkv(head: bytes) -> bool:
+    return head[:4] == EBML_ID.to_bytes(4, "big")
+
+
+async def _read_element(
+    read: ByteReader, offset: int, file_size: int, max_size: int
+) -> tuple[bytes, Element]:
+    header = await read(offset, min(MAX_ELEMENT_HEADER_SIZE, file_size - offset))
+    element = parse_element_header(header, 0)
+    if element.size is None or element.size > max_size:
+        raise ContainerParseException(f"Element {element.id:#x} is too large")
+    length = element.data_offset + element.size
+    return await read(offset, min(length, file_size - offset)), element
+
+
+async def mkv_seek_index(read: ByteReader, file_size: int) -> SeekIndex:
+    head = await read(0, min(HEAD_SIZE, file_size))
+    ebml = parse_element_header(head, 0)
+    if ebml.id != EBML_ID or ebml.end is None:
+        raise ContainerParseException("No EBML header")
+    segment = parse_element_header(head, ebml.end)
+    if segment.id != SEGMENT_ID:
+        raise ContainerParseException("No Segment element")
+    segment_start = segment.data_offset
+
+    scale, duration = DEFAULT_TIMECODE_SCALE, 0.0
+    positions: dict[int, int] = {}
+    pos = segment_start
+    # Metadata is at the start of the segment, stop at the first cluster
+    # or at the first element that doesn't fit the head.
+    while pos + MAX_ELEMENT_HEADER_SIZE <= len(head):
+        element = parse_element_header(head, pos)
+        if element.id == CLUSTER_ID or element.end is None or element.end > len(head):
+            if element.id == CUES_ID:
+                positions.setdefault(CUES_ID, pos - segment_start)
+            break
+        if element.id == INFO_ID:
+            scale, duration = parse_info(head, element)
+        elif element.id == SEEK_HEAD_ID:
+            positions.update(parse_seek_head(head, element))
+        elif element.id == CUES_ID:
+            positions[CUES_ID] = pos - segment_start
+        pos = element.end
+
+    points: list[SeekPoint] = []
+    if CUES_ID in positions:
+        cues_offset = segment_start + positions[CUES_ID]
+        data, cues = await _read_element(read, cues_offset, file_size, MAX_CUES_SIZE)
+        if cues.id != CUES_ID:
+            raise ContainerParseException(f"No Cues at {cues_offset}")
+        points = parse_cues(data, cues, segment_start, scale)
+    seconds = duration * scale / 1e9
+    if not seconds and points:
+        seconds = points[-1].time
+    return SeekIndex(seconds, points)
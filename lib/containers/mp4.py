@@ -0,0 +1,330 @@
+import struct
+from collections.abc import Iterator
+from dataclasses import dataclass
+
+from lib.containers.exceptions import ContainerParseException, parse_errors
+from lib.containers.seek_index import ByteReader, SeekIndex, SeekPoint
+
+BOX_HEADER_SIZE = 8
+LARGE_BOX_HEADER_SIZE = 16
+MAX_MOOV_SIZE = 64 * 1024 * 1024
+MAX_TOP_LEVEL_BOXES = 64
+# Hours of video at a high frame rate, more samples mean a broken stsz
+MAX_SAMPLES = 8 * 1024 * 1024
+
+TOP_LEVEL_BOXES = {
+    b"ftyp",
+    b"styp",
+    b"moov",
+    b"mdat",
+    b"free",
+    b"skip",
+    b"wide",
+    b"sidx",
+    b"moof",
+    b"mfra",
+    b"uuid",
+    b"pdin",
+    b"meta",
+}
+
+
+@dataclass
+class Box:
+    type: bytes
+    offset: int
+    header_size: int
+    size: int
+
+    @property
+    def data_offset(self) -> int:
+        return self.offset + self.header_size
+
+    @property
+    def end(self) -> int:
+        return self.offset + self.size
+
+
+def parse_box_header(data: bytes, offset: int, limit: int) -> Box:
+    if offset + BOX_HEADER_SIZE > len(data):
+        raise ContainerParseException(f"Truncated box header at {offset}")
+    size, box_type = struct.unpack_from(">I4s", data, offset)
+    header_size = BOX_HEADER_SIZE
+    if size == 1:
+        if offset + LARGE_BOX_HEADER_SIZE > len(data):
+            raise ContainerParseException(f"Truncated large box header at {offset}")
+        size = struct.unpack_from(">Q", data, offset + BOX_HEADER_SIZE)[0]
+        header_size = LARGE_BOX_HEADER_SIZE
+    elif size == 0:
+        size = limit - offset
+    if size < header_size:
+        raise ContainerParseException(f"Invalid size {size} of {box_type} at {offset}")
+    return Box(box_type, offset, header_size, size)
+
+
+def iter_boxes(data: bytes, start: int, end: int) -> Iterator[Box]:
+    offset = start
+    while offset + BOX_HEADER_SIZE <= end:
+        box = parse_box_header(data, offset, end)
+        yield box
+        offset = box.end
+
+
+def find_box(data: bytes, start: int, end: int, *path: bytes) -> Box | None:
+    box_type, *rest = path
+    for box in iter_boxes(data, start, end):
+        if box.type != box_type:
+            continue
+        if not rest:
+            return box
+        return find_box(data, box.data_offset, min(box.end, end), *rest)
+    return None
+
+
+def children(data: bytes, box: Box, box_type: bytes) -> list[Box]:
+    return [b for b in iter_boxes(data, box.data_offset, box.end) if b.type == box_type]
+
+
+async def read_top_level_boxes(read: ByteReader, file_size: int) -> list[Box]:
+    """Walks top level boxes reading only their headers. Stops after the
+    first media fragment that follows moov, fragmented files can have
+    thousands of them."""
+    boxes: list[Box] = []
+    offset = 0
+    while offset + BOX_HEADER_SIZE <= file_size and len(boxes) < MAX_TOP_LEVEL_BOXES:
+        header = await read(offset, min(LARGE_BOX_HEADER_SIZE, file_size - offset))
+        box = parse_box_header(header, 0, file_size - offset)
+        box.offset = offset
+        if box.type not in TOP_LEVEL_BOXES:
+            raise ContainerParseException(f"Unexpected top level box {box.type}")
+        boxes.append(box)
+        if box.type in (b"moof", b"mdat") and any(b.type == b"moov" for b in boxes):
+            break
+        offset = box.end
+    return boxes
+
+
+def _version(data: bytes, box: Box) -> int:
+    with parse_errors(f"{box.type} box"):
+        return data[box.data_offset]
+
+
+def _check_fits(box: Box, end: int):
+    if end > box.end:
+        raise ContainerParseException(f"{box.type} entries overflow the box")
+
+
+def parse_timescale_duration(data: bytes, box: Box) -> tuple[int, int]:
+    """Works for both mvhd and mdhd, they share the layout of these fields"""
+    payload = box.data_offset + 4
+    with parse_errors(f"{box.type} box"):
+        if _version(data, box) == 1:
+            return struct.unpack_from(">IQ", data, payload + 16)
+        return struct.unpack_from(">II", data, payload + 8)
+
+
+def _table(data: bytes, box: Box, fmt: str) -> list[tuple[int, ...]]:
+    payload = box.data_offset + 4
+    entry_size = struct.calcsize(fmt)
+    with parse_errors(f"{box.type} box"):
+        (count,) = struct.unpack_from(">I", data, payload)
+        _check_fits(box, payload + 4 + count * entry_size)
+        return [
+            struct.unpack_from(fmt, data, payload + 4 + i * entry_size)
+            for i in range(count)
+        ]
+
+
+def _sample_sizes(data: bytes, box: Box) -> list[int]:
+    payload = box.data_offset + 4
+    with parse_errors(f"{box.type} box"):
+        sample_size, count = struct.unpack_from(">II", data, payload)
+        if count > MAX_SAMPLES:
+            raise ContainerParseException(f"Too many samples: {count}")
+        if sample_size:
+            return [sample_size] * count
+        _check_fits(box, payload + 8 + count * 4)
+        return list(struct.unpack_from(f">{count}I", data, payload + 8))
+
+
+def _sample_times(stts: list[tuple[int, ...]], samples: list[int]) -> list[int]:
+    """Decode times of the given sorted zero based samples"""
+    times: list[int] = []
+    it = iter(samples)
+    sample = next(it, None)
+    first, time = 0, 0
+    for count, delta in stts:
+        while sample is not None and sample < first + count:
+            times.append(time + (sample - first) * delta)
+            sample = next(it, None)
+        first += count
+        time += count * delta
+    return times
+
+
+def _sample_offsets(
+    stsc: list[tuple[int, ...]],
+    chunk_offsets: list[int],
+    sizes: list[int],
+    samples: list[int],
+) -> list[int]:
+    """File offsets of the given sorted zero based samples"""
+    offsets: list[int] = []
+    it = iter(samples)
+    sample = next(it, None)
+    first_sample = 0
+    for run, (first_chunk, per_chunk, _) in enumerate(stsc):
+        if first_chunk < 1:
+            raise ContainerParseException(f"Invalid first chunk {first_chunk}")
+        last_chunk = stsc[run + 1][0] - 1 if run + 1 < len(stsc) else len(chunk_offsets)
+        for chunk in range(first_chunk - 1, last_chunk):
+            if sample is None:
+                return offsets
+            chunk_end = first_sample + per_chunk
+            offset = chunk_offsets[chunk]
+            pos = first_sample
+            while sample is not None and sample < chunk_end:
+                offset += sum(sizes[pos:sample])
+                pos = sample
+                offsets.append(offset)
+                sample = next(it, None)
+            first_sample = chunk_end
+    return offsets
+
+
+def keyframe_points(data: bytes, stbl: Box, timescale: int) -> list[SeekPoint]:
+    if timescale == 0:
+        raise ContainerParseException("Video track has a zero timescale")
+    boxes = {b.type: b for b in iter_boxes(data, stbl.data_offset, stbl.end)}
+    if not all(t in boxes for t in (b"stts", b"stsc", b"stsz")):
+        return []
+    sizes = _sample_sizes(data, boxes[b"stsz"])
+    if not sizes:
+        return []
+    if b"stco" in boxes:
+        chunk_offsets = [o for (o,) in _table(data, boxes[b"stco"], ">I")]
+    elif b"co64" in boxes:
+        chunk_offsets = [o for (o,) in _table(data, boxes[b"co64"], ">Q")]
+    else:
+        return []
+    if b"stss" in boxes:
+        sync = sorted(n - 1 for (n,) in _table(data, boxes[b"stss"], ">I"))
+    else:
+        sync = list(range(len(sizes)))
+    times = _sample_times(_table(data, boxes[b"stts"], ">II"), sync)
+    with parse_errors("sample to chunk table"):
+        offsets = _sample_offsets(
+            _table(data, boxes[b"stsc"], ">III"), chunk_offsets, sizes, sync
+        )
+    return [SeekPoint(time / timescale, offset) for time, offset in zip(times, offsets)]
+
+
+def video_track(data: bytes, moov: Box) -> Box | None:
+    for trak in children(data, moov, b"trak"):
+        hdlr = find_box(data, trak.data_offset, trak.end, b"mdia", b"hdlr")
+        if hdlr is None:
+            continue
+        # version/flags, then pre_defined, then handler type
+        handler_type = data[hdlr.data_offset + 8 : hdlr.data_offset + 12]
+        if handler_type == b"vide":
+            return trak
+    return None
+
+
+@dataclass
+class SidxReference:
+    """One subsegment of a sidx box, usually a moof with its mdat"""
+
+    time: float
+    duration: float
+    offset: int
+    size: int
+    starts_with_sap: bool
+    is_index: bool
+
+
+def sidx_references(data: bytes, sidx: Box, file_offset: int) -> list[SidxReference]:
+    """Subsegments of a sidx box, data must contain the box at sidx.offset
+    while file_offset is where it's located in the file"""
+    payload = sidx.data_offset + 4
+    with parse_errors("sidx box"):
+        _, timescale = struct.unpack_from(">II", data, payload)
+        payload += 8
+        if _version(data, sidx) == 1:
+            earliest, first_offset = struct.unpack_from(">QQ", data, payload)
+            payload += 16
+        else:
+            earliest, first_offset = struct.unpack_from(">II", data, payload)
+            payload += 8
+        (count,) = struct.unpack_from(">H", data, payload + 2)
+    payload += 4
+    if timescale == 0:
+        raise ContainerParseException("sidx has a zero timescale")
+    _check_fits(sidx, payload + count * 12)
+    offset = file_offset + sidx.size + first_offset
+    time = earliest
+    references: list[SidxReference] = []
+    for i in range(count):
+        with parse_errors("sidx box"):
+            ref, duration, sap = struct.unpack_from(">III", data, payload + i * 12)
+        size = ref & 0x7FFFFFFF
+        references.append(
+            SidxReference(
+                time / timescale,
+                duration / timescale,
+                offset,
+                size,
+                bool(sap & 0x80000000),
+                bool(ref & 0x80000000),
+            )
+        )
+        offset += size
+        time += duration
+    return references
+
+
+def sidx_points(data: bytes, sidx: Box, file_offset: int) -> list[SeekPoint]:
+    """Segment starts from a sidx box, data must contain the box at sidx.offset
+    while file_offset is where it's located in the file"""
+    return [
+        SeekPoint(ref.time, ref.offset)
+        for ref in sidx_references(data, sidx, file_offset)
+    ]
+
+
+def is_mp4(head: bytes) -> bool:
+    return len(head) >= BOX_HEADER_SIZE and head[4:8] in TOP_LEVEL_BOXES
+
+
+async def mp4_seek_index(read: ByteReader, file_size: int) -> SeekIndex:
+    boxes = await read_top_level_boxes(read, file_size)
+    moov = next((b for b in boxes if b.type == b"moov"), None)
+    if moov is None:
+        raise ContainerParseException("No moov box")
+    if moov.size > MAX_MOOV_SIZE:
+        raise ContainerParseException(f"moov is too large: {moov.size}")
+    data = await read(moov.offset, moov.size)
+    moov.offset = 0
+    mvhd = find_box(data, moov.data_offset, moov.end, b"mvhd")
+    if mvhd is None:
+        raise ContainerParseException("No mvhd box")
+    movie_timescale, movie_duration = parse_timescale_duration(data, mvhd)
+    duration = movie_duration / movie_timescale if movie_timescale else 0
+
+    points: list[SeekPoint] = []
+    trak = video_track(data, moov)
+    if trak is not None:
+        mdhd = find_box(data, trak.data_offset, trak.end, b"mdia", b"mdhd")
+        stbl = find_box(data, trak.data_offset, trak.end, b"mdia", b"minf", b"stbl")
+        if mdhd is not None and stbl is not None:
+            timescale, _ = parse_timescale_duration(data, mdhd)
+            points = keyframe_points(data, stbl, timescale)
+    if not points:
+        sidx = next((b for b in boxes if b.type == b"sidx"), None)
+        if sidx is not None:
+            sidx_data = await read(sidx.offset, sidx.size)
+            local = Box(sidx.type, 0, sidx.header_size, sidx.size)
+            points = sidx_points(sidx_data, local, sidx.offset)
+    if not duration and points:
+        duration = points[-1].time
+    return SeekIndex(duration, points)
@@ -0,0 +1,55 @@
+from bisect import bisect_right
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+
+from lib.containers.exceptions import ContainerParseException
+
+ByteReader = Callable[[int, int], Awaitable[bytes]]
+
+
+def exact_reader(read: ByteReader) -> ByteReader:
+    """Short reads of a truncated file fail like any other broken file"""
+
+    async def read_exact(start: int, length: int) -> bytes:
+        data = await read(start, length)
+        if len(data) != length:
+            raise ContainerParseException(
+                f"File is truncated, read {len(data)} of {length} at {start}"
+            )
+        return data
+
+    return read_exact
+
+
+@dataclass(order=True)
+class SeekPoint:
+    time: float
+    offset: int
+
+
+@dataclass
+class SeekIndex:
+    """Maps playback time to the byte offset of the closest keyframe (or
+    cluster) at or before it."""
+
+    duration: float
+    points: list[SeekPoint] = field(default_factory=list)
+
+    def __post_init__(self):
+        self.points.sort()
+        self._times: list[float] = [p.time for p in self.points]
+
+    def point_at(self, video_time: float) -> SeekPoint | None:
+        ind = bisect_right(self._times, video_time) - 1
+        if ind < 0:
+            return None
+        return self.points[ind]
+
+    def byte_at(self, video_time: float) -> int:
+        point = self.point_at(video_time)
+        return 0 if point is None else point.offset
+
+    def bitrate(self, file_size: int) -> int | None:
+        if self.duration <= 0:
+            return None
+        return int(file_size / self.duration)
@@ -0,0 +1,174 @@
+from collections.abc import Iterator
+from dataclasses import dataclass
+
+from lib.containers.exceptions import ContainerParseException
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+PAT_PID = 0
+PTS_CLOCK = 90000
+PTS_WRAP = 1 << 33
+
+# MPEG-1/2, MPEG-4 part 2, H.264, HEVC, AVS and VC-1 video
+VIDEO_STREAM_TYPES = {0x01, 0x02, 0x10, 0x1B, 0x24, 0x42, 0xEA}
+
+
+@dataclass
+class TsKeyframe:
+    # Offset of the packet a segment starting at this keyframe begins with
+    offset: int
+    pts: int
+
+
+def is_ts(head: bytes) -> bool:
+    return (
+        len(head) > 2 * TS_PACKET_SIZE
+        and head[0] == TS_SYNC_BYTE
+        and head[TS_PACKET_SIZE] == TS_SYNC_BYTE
+        and head[2 * TS_PACKET_SIZE] == TS_SYNC_BYTE
+    )
+
+
+def sync_offset(data: bytes) -> int | None:
+    """Offset of the first packet in data, checked against the next two"""
+    for offset in range(min(TS_PACKET_SIZE, len(data))):
+        if is_ts(data[offset:]):
+            return offset
+    return None
+
+
+def _pid(data: bytes, packet: int) -> int:
+    return ((data[packet + 1] & 0x1F) << 8) | data[packet + 2]
+
+
+def _payload_start(data: bytes, packet: int) -> int | None:
+    control = (data[packet + 3] >> 4) & 0x3
+    if not control & 0x1:
+        return None
+    start = packet + 4
+    if control & 0x2:
+        start += 1 + data[packet + 4]
+    return start if start < packet + TS_PACKET_SIZE else None
+
+
+def _unit_start(data: bytes, packet: int) -> bool:
+    return bool(data[packet + 1] & 0x40)
+
+
+def _random_access(data: bytes, packet: int) -> bool:
+    control = (data[packet + 3] >> 4) & 0x3
+    has_flags = bool(control & 0x2) and data[packet + 4] > 0
+    return has_flags and bool(data[packet + 5] & 0x40)
+
+
+def _packets(data: bytes, start: int) -> Iterator[int]:
+    """Offsets of packets from start, up to the first one out of sync"""
+    for packet in range(start, len(data) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE):
+        if data[packet] != TS_SYNC_BYTE:
+            return
+        yield packet
+
+
+def _section(data: bytes, packet: int) -> bytes | None:
+    """PSI section starting in this packet, without its CRC"""
+    if not _unit_start(data, packet):
+        return None
+    start = _payload_start(data, packet)
+    if start is None:
+        return None
+    start += 1 + data[start]
+    section = data[start : packet + TS_PACKET_SIZE]
+    if len(section) < 3:
+        return None
+    length = ((section[1] & 0x0F) << 8) | section[2]
+    return section[: 3 + length - 4]
+
+
+def video_pid(data: bytes) -> int:
+    """PID of the first video stream of the first program, from the PAT and
+    PMT at the start of the file"""
+    start = sync_offset(data)
+    if start is None:
+        raise ContainerParseException("No TS sync")
+    pmt_pid: int | None = None
+    for packet in _packets(data, start):
+        pid = _pid(data, packet)
+        if pmt_pid is None and pid == PAT_PID:
+            section = _section(data, packet)
+            if section is None:
+                continue
+            for entry in range(8, len(section) - 3, 4):
+                program = (section[entry] << 8) | section[entry + 1]
+                if program != 0:
+                    pmt_pid = ((section[entry + 2] & 0x1F) << 8) | section[entry + 3]
+                    break
+        elif pmt_pid is not None and pid == pmt_pid:
+            section = _section(data, packet)
+            if section is None:
+                continue
+            entry = 12 + (((section[10] & 0x0F) << 8) | section[11])
+            while entry + 5 <= len(section):
+                stream_type = section[entry]
+                stream_pid = ((section[entry + 1] & 0x1F) << 8) | section[entry + 2]
+                if stream_type in VIDEO_STREAM_TYPES:
+                    return stream_pid
+                entry += 5 + (((section[entry + 3] & 0x0F) << 8) | section[entry + 4])
+            raise ContainerParseException("No video stream in PMT")
+    raise ContainerParseException("No PAT and PMT at the start")
+
+
+def _pes_pts(data: bytes, packet: int) -> int | None:
+    start = _payload_start(data, packet)
+    if start is None or start + 14 > packet + TS_PACKET_SIZE:
+        return None
+    if data[start : start + 3] != b"\x00\x00\x01" or not data[start + 7] & 0x80:
+        return None
+    b = data[start + 9 : start + 14]
+    return (
+        ((b[0] >> 1) & 0x07) << 30
+        | b[1] << 22
+        | (b[2] >> 1) << 15
+        | b[3] << 7
+        | b[4] >> 1
+    )
+
+
+def find_keyframe(data: bytes, file_offset: int, pid: int) -> TsKeyframe | None:
+    """First keyframe of the video stream in data read at file_offset. The
+    segment starts at the last PAT before it when the window has one, so
+    players find the program tables at the start of every segment."""
+    start = sync_offset(data)
+    if start is None:
+        return None
+    last_pat: int | None = None
+    for packet in _packets(data, start):
+        packet_pid = _pid(data, packet)
+        if packet_pid == PAT_PID and _unit_start(data, packet):
+            last_pat = packet
+        if packet_pid != pid or not _unit_start(data, packet):
+            continue
+        if not _random_access(data, packet):
+            continue
+        pts = _pes_pts(data, packet)
+        if pts is not None:
+            offset = packet if last_pat is None else last_pat
+            return TsKeyframe(file_offset + offset, pts)
+    return None
+
+
+def last_pts(data: bytes, pid: int) -> int | None:
+    start = sync_offset(data)
+    if start is None:
+        return None
+    pts: int | None = None
+    for packet in _packets(data, start):
+        if _pid(data, packet) != pid or not _unit_start(data, packet):
+            continue
+        packet_pts = _pes_pts(data, packet)
+        if packet_pts is not None:
+            pts = packet_pts
+    return pts
+
+
+def pts_seconds(pts: int, first_pts: int) -> float:
+    return ((pts - first_pts) % PTS_WRAP) / PTS_CLOCK
@@ -1,33 +1,128 @@
 import asyncio
 import hashlib
-import os
 from asyncio import Task
-from email.utils import formatdate
+from dataclasses import dataclass
+from email.utils import formatdate, parsedate_to_datetime
+from functools import lru_cache
 from secrets import token_hex
 from typing import override
-from collections.abc import Mapping
+from collections.abc import AsyncGenerator, Callable, Mapping
+from contextlib import aclosing
+import anyio
 from fastapi import Request
-from starlette.responses import FileResponse
-from starlette.types import Send
+from starlette.datastructures import Headers
+from starlette.responses import (
+    FileResponse,
+    MalformedRangeHeader,
+    PlainTextResponse,
+    RangeNotSatisfiable,
+)
+from starlette.types import Receive, Scope, Send
 
+from config import STREAM_PREFETCH_BYTES
+from lib.link_proxy import LinkProxy
 from lib.logger import Logging
+from lib.prefetch_stream import PrefetchStream
+from lib.send_pacer import SendPacer
+from lib.torrent.piece_cache import PieceData
 from lib.torrent.torrent_handler import FileTorrentHandler
 
 
+@dataclass(frozen=True)
+class FileValidators:
+    size: int
+    etag: str
+    last_modified: str
+    modified_at: int
+
+
+@lru_cache(maxsize=1024)
+def file_validators(infohash: str, file_index: int, size: int) -> FileValidators:
+    """Content of a torrent file is fixed by the infohash, so are its validators.
+    They must not follow the file on disk: mtime changes on every written
+    piece, which breaks If-Range and makes players refetch whole files."""
+    digest = hashlib.md5(
+        f"{infohash}-{file_index}-{size}".encode(), usedforsecurity=False
+    ).hexdigest()
+    modified_at = int(digest, 16) % 1700000000
+    return FileValidators(
+        size, f'"{digest}"', formatdate(modified_at, usegmt=True), modified_at
+    )
+
+
+def is_not_modified(headers: Headers, validators: FileValidators) -> bool:
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        # Weak comparison, as If-None-Match asks for
+        return "*" in tags or any(
+            tag.removeprefix("W/") == validators.etag for tag in tags
+        )
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+    return validators.modified_at <= since
+
+
+def is_range_allowed(headers: Headers, validators: FileValidators) -> bool:
+    """If-Range validator still matches, strong comparison only"""
+    if_range = headers.get("if-range")
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith(('"', "W/")):
+        return if_range == validators.etag
+    return if_range == validators.last_modified
+
+
+def coalesce_ranges(ranges: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    """Sorted ranges with overlapping and adjacent ones merged"""
+    merged: list[tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def multipart_part_header(
+    boundary: str, content_type: str, start: int, end: int, file_size: int
+) -> bytes:
+    return (
+        f"--{boundary}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Range: bytes {start}-{end - 1}/{file_size}\r\n\r\n"
+    ).encode("latin-1")
+
+
+def needs_body(request: Request, validators: FileValidators) -> bool:
+    return request.method != "HEAD" and not is_not_modified(request.headers, validators)
+
+
 class LoadingTorrentFileResponse(FileResponse, Logging):
+    """Serves a torrent file while it downloads. Size and validators come
+    from the torrent, so the file is never stat-ed. Responses without a body
+    (HEAD, 304) need no torrent handler."""
+
     def __init__(
         self,
-        torrent_handler: FileTorrentHandler,
+        torrent_handler: FileTorrentHandler | None,
+        validators: FileValidators,
         request: Request,
+        file_name: str,
         status_code: int = 200,
         headers: Mapping[str, str] | None = None,
         media_type: str | None = None,
         method: str | None = None,
         content_disposition_type: str = "attachment",
     ):
-        path = torrent_handler.file_path
         super().__init__(
-            path,
+            file_name,
             status_code=status_code,
             headers=headers,
             media_type=media_type,
@@ -36,8 +131,89 @@ class LoadingTorrentFileResponse(FileResponse, Logging):
         )
         self.request: Request = request
         self.tasks: list[Task[None]] = []
-        self.torrent_handler: FileTorrentHandler = torrent_handler
+        self._torrent_handler: FileTorrentHandler | None = torrent_handler
+        self.validators: FileValidators = validators
+        self.headers.setdefault("content-length", str(validators.size))
+        self.headers.setdefault("etag", validators.etag)
+        self.headers.setdefault("last-modified", validators.last_modified)
         self._cancelled: bool = False
+        self.finished: bool = False
+        self._finish_callbacks: list[Callable[[], None]] = []
+        self.pacer: SendPacer | None = None
+
+    @property
+    def torrent_handler(self) -> FileTorrentHandler:
+        if self._torrent_handler is None:
+            raise RuntimeError("Response body needs a torrent handler")
+        return self._torrent_handler
+
+    @override
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await self._respond(scope, receive, send)
+        finally:
+            self.finished = True
+            self.tasks.clear()
+            for callback in self._finish_callbacks:
+                callback()
+            self._finish_callbacks.clear()
+
+    def on_finish(self, callback: Callable[[], None]):
+        self._finish_callbacks.append(callback)
+
+    @property
+    def byte_span(self) -> tuple[int, int]:
+        """Bytes from the first to the last one requested"""
+        size = self.validators.size
+        http_range = self.request.headers.get("range")
+        if http_range is None:
+            return 0, size
+        try:
+            ranges = self._parse_range_header(http_range, size)
+        except (MalformedRangeHeader, RangeNotSatisfiable):
+            return 0, size
+        return min(start for start, _ in ranges), max(end for _, end in ranges)
+
+    async def _respond(self, scope: Scope, receive: Receive, send: Send) -> None:
+        send_header_only: bool = scope["method"].upper() == "HEAD"
+        headers = Headers(scope=scope)
+        if is_not_modified(headers, self.validators):
+            await self._handle_not_modified(send)
+            return
+        http_range = headers.get("range")
+        if http_range is None or not is_range_allowed(headers, self.validators):
+            await self._handle_simple(send, send_header_only)
+            return
+        file_size = self.validators.size
+        try:
+            ranges = self._parse_range_header(http_range, file_size)
+        except MalformedRangeHeader as exc:
+            return await PlainTextResponse(exc.content, status_code=400)(
+                scope, receive, send
+            )
+        except RangeNotSatisfiable as exc:
+            response = PlainTextResponse(
+                status_code=416, headers={"Content-Range": f"*/{exc.max_size}"}
+            )
+            return await response(scope, receive, send)
+        ranges = coalesce_ranges(ranges)
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            await self._handle_single_range(
+                send, start, end, file_size, send_header_only
+            )
+        else:
+            await self._handle_multiple_ranges(
+                send, ranges, file_size, send_header_only
+            )
+
+    async def _handle_not_modified(self, send: Send) -> None:
+        headers = [
+            (b"etag", self.validators.etag.encode("latin-1")),
+            (b"last-modified", self.validators.last_modified.encode("latin-1")),
+        ]
+        await send({"type": "http.response.start", "status": 304, "headers": headers})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
 
     def cancel(self):
         self._cancelled = True
@@ -45,28 +221,31 @@ class LoadingTorrentFileResponse(FileResponse, Logging):
             _ = task.cancel()
         self.tasks.clear()
 
-    @override
-    def set_stat_headers(self, stat_result: os.stat_result) -> None:
-        # Use stable headers that don't change while libtorrent writes pieces.
-        # mtime/ctime change on every write, which breaks Chrome's If-Range
-        # validation and causes range requests to fall back to whole-file 200.
-        file_size = self.torrent_handler.torrent.file_size(
-            self.torrent_handler.file_index
-        )
-        self.headers.setdefault("content-length", str(file_size))
-        etag_base = self.torrent_handler.file_path + "-" + str(file_size)
-        etag = f'"{hashlib.md5(etag_base.encode(), usedforsecurity=False).hexdigest()}"'
-        self.headers.setdefault("etag", etag)
-        # Derive a stable last-modified from the path hash (constant per file).
-        path_hash = int(hashlib.md5(self.torrent_handler.file_path.encode(), usedforsecurity=False).hexdigest(), 16)
-        self.headers.setdefault("last-modified", formatdate(path_hash % 1700000000, usegmt=True))
+    def _read(self, start: int, end: int) -> AsyncGenerator[PieceData]:
+        return self.torrent_handler.iter_pieces(start, end)
+
+    async def _iter_bytes(self, start: int, end: int) -> AsyncGenerator[PieceData]:
+        """Bytes of the range, the next ones fetched while these are sent"""
+        stream = PrefetchStream(self._read(start, end), STREAM_PREFETCH_BYTES)
+        self.tasks = [task for task in self.tasks if not task.done()]
+        self.tasks.append(stream.start())
+        async with aclosing(stream.read()) as chunks:
+            async for data in chunks:
+                yield data
+
+    async def _pace(self, position: int, size: int):
+        if self.pacer is not None:
+            await self.pacer.wait(position, size)
 
     async def _download_range(self, start: int, end: int):
-        async for buffer in self.torrent_handler.iter_pieces(start, end):
-            if self._cancelled:
-                break
-            yield buffer, True
-            await asyncio.sleep(0)
+        async with aclosing(self._iter_bytes(start, end)) as chunks:
+            async for buffer in chunks:
+                if self._cancelled:
+                    break
+                await self._pace(start, len(buffer))
+                start += len(buffer)
+                yield buffer, True
+                await asyncio.sleep(0)
         yield b"", False
 
     async def _download_single_range(self, send: Send, start: int, end: int):
@@ -76,32 +255,77 @@ class LoadingTorrentFileResponse(FileResponse, Logging):
             )
         self.logger.debug(f"Request {start}-{end} fully finished")
 
+    def _piece_groups(
+        self, ranges: list[tuple[int, int]]
+    ) -> list[list[tuple[int, int]]]:
+        """Sorted, disjoint ranges grouped so that ranges sharing a piece are
+        read in one pass and the piece is fetched once"""
+        handler = self.torrent_handler
+
+        def piece_of(byte: int) -> int:
+            return handler.torrent.piece_bytes_offset(handler.file_index, byte)[0]
+
+        groups: list[list[tuple[int, int]]] = []
+        for start, end in ranges:
+            if groups and piece_of(start) == piece_of(groups[-1][-1][1] - 1):
+                groups[-1].append((start, end))
+            else:
+                groups.append([(start, end)])
+        return groups
+
     async def _download_multiple_ranges(
-        self, send: Send, ranges: list[tuple[int, int]]
+        self,
+        send: Send,
+        ranges: list[tuple[int, int]],
+        part_header: Callable[[int, int], bytes],
+        boundary: str,
     ):
-        boundary = token_hex(13)
-        for start, end in ranges:
-            async for piece in self._download_range(start, end):
-                await send(
-                    {"type": "http.response.body", "body": piece, "more_body": True}
-                )
-            await send({"type": "http.response.body", "body": b"\n", "more_body": True})
-        await send(
-            {
-                "type": "http.response.body",
-                "body": f"\n--{boundary}--\n".encode("latin-1"),
-                "more_body": False,
-            }
+        for group in self._piece_groups(ranges):
+            parts = iter(group[1:])
+            part: tuple[int, int] | None = group[0]
+            await self._send_body(send, part_header(*group[0]))
+            pos = group[0][0]
+            async with aclosing(self._iter_bytes(pos, group[-1][1])) as chunks:
+                async for data in chunks:
+                    if self._cancelled:
+                        await self._send_body(send, b"", more_body=False)
+                        return
+                    await self._pace(pos, len(data))
+                    while data and part is not None:
+                        start, end = part
+                        if pos < start:
+                            # Bytes between two parts of the same piece
+                            size = min(len(data), start - pos)
+                        else:
+                            size = min(len(data), end - pos)
+                            await self._send_body(send, data[:size])
+                        data = data[size:]
+                        pos += size
+                        if pos == end:
+                            await self._send_body(send, b"\r\n")
+                            part = next(parts, None)
+                            if part is not None:
+                                await self._send_body(send, part_header(*part))
+                    await asyncio.sleep(0)
+        await self._send_body(
+            send, f"--{boundary}--\r\n".encode("latin-1"), more_body=False
         )
+        self.logger.debug(f"Multipart request {ranges} fully finished")
+
+    @staticmethod
+    async def _send_body(send: Send, body: PieceData, more_body: bool = True):
+        await send({"type": "http.response.body", "body": body, "more_body": more_body})
 
     @override
     async def _handle_simple(self, send: Send, send_header_only: bool) -> None:
-        file_size = self.torrent_handler.torrent.file_size(
-            self.torrent_handler.file_index
-        )
+        file_size = self.validators.size
         self.headers["content-length"] = str(file_size)
         await send(
-            {"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers}
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
         )
         if send_header_only:
             await send({"type": "http.response.body", "body": b"", "more_body": False})
@@ -132,10 +356,15 @@ class LoadingTorrentFileResponse(FileResponse, Logging):
     ) -> None:
         # In firefox and chrome, they use boundary with 95-96 bits entropy (that's roughly 13 bytes).
         boundary = token_hex(13)
-        content_length, _ = self.generate_multipart(
-            ranges, boundary, file_size, self.headers["content-type"]
-        )
-        self.headers["content-range"] = f"multipart/byteranges; boundary={boundary}"
+        part_type = self.headers["content-type"]
+
+        def part_header(start: int, end: int) -> bytes:
+            return multipart_part_header(boundary, part_type, start, end, file_size)
+
+        content_length = sum(
+            len(part_header(start, end)) + (end - start) + 2 for start, end in ranges
+        ) + len(f"--{boundary}--\r\n")
+        self.headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
         self.headers["content-length"] = str(content_length)
         await send(
             {"type": "http.response.start", "status": 206, "headers": self.raw_headers}
@@ -143,4 +372,87 @@ class LoadingTorrentFileResponse(FileResponse, Logging):
         if send_header_only:
             await send({"type": "http.response.body", "body": b"", "more_body": False})
         else:
-            await self._download_multiple_ranges(send, ranges)
\ No newline at end of file
+            await self._download_multiple_ranges(send, ranges, part_header, boundary)
+
+
+class CompletedFileResponse(LoadingTorrentFileResponse):
+    """Serves a file whose pieces are all downloaded and verified straight
+    from disk, skipping the piece machinery. The whole file goes out with
+    sendfile when the server supports the pathsend extension."""
+
+    chunk_size: int = 1024 * 1024
+
+    def __init__(
+        self,
+        path: str,
+        validators: FileValidators,
+        request: Request,
+        file_name: str,
+    ):
+        super().__init__(None, validators, request, file_name)
+        self.path: str = path
+        self._pathsend: bool = False
+
+    @override
+    async def _respond(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self._pathsend = "http.response.pathsend" in scope.get("extensions", {})
+        await super()._respond(scope, receive, send)
+
+    @override
+    async def _iter_bytes(self, start: int, end: int) -> AsyncGenerator[PieceData]:
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            _ = await file.seek(start)
+            while start < end:
+                data = await file.read(min(self.chunk_size, end - start))
+                if not data:
+                    raise RuntimeError(f"File {self.path} is shorter than {end}")
+                start += len(data)
+                yield data
+
+    @override
+    def _piece_groups(
+        self, ranges: list[tuple[int, int]]
+    ) -> list[list[tuple[int, int]]]:
+        return [[part] for part in ranges]
+
+    @override
+    async def _handle_simple(self, send: Send, send_header_only: bool) -> None:
+        # sendfile can't be paced
+        if send_header_only or not self._pathsend or self.pacer is not None:
+            await super()._handle_simple(send, send_header_only)
+            return
+        self.headers["content-length"] = str(self.validators.size)
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        await send({"type": "http.response.pathsend", "path": self.path})
+
+
+class LinkProxyResponse(LoadingTorrentFileResponse):
+    """Serves a link from the range cache of its proxy"""
+
+    def __init__(
+        self,
+        proxy: LinkProxy,
+        validators: FileValidators,
+        request: Request,
+        file_name: str,
+    ):
+        super().__init__(
+            None, validators, request, file_name, media_type=proxy.info.content_type
+        )
+        self.proxy: LinkProxy = proxy
+
+    @override
+    def _read(self, start: int, end: int) -> AsyncGenerator[PieceData]:
+        return self.proxy.iter_bytes(start, end)
+
+    @override
+    def _piece_groups(
+        self, ranges: list[tuple[int, int]]
+    ) -> list[list[tuple[int, int]]]:
+        return [[part] for part in ranges]
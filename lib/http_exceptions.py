@@ -24,3 +24,7 @@ class UnprocessableEntity(HTTPException):
 
 class ContentTooLarge(HTTPException):
     status_code: int = 413
+
+
+class BadGateway(HTTPException):
+    status_code: int = 502
@@ -0,0 +1,262 @@
+import asyncio
+import ipaddress
+import shutil
+import socket
+from collections import OrderedDict
+from collections.abc import AsyncGenerator
+from dataclasses import dataclass
+from pathlib import Path
+
+import anyio
+import httpx
+
+import config
+from lib.http_exceptions import BadGateway
+from lib.logger import Logging
+
+LINK_MODE_PROXY = "proxy"
+
+ORIGIN_TIMEOUT_S = 30
+ORIGIN_MAX_CONNECTIONS = 32
+ORIGIN_MAX_REDIRECTS = 5
+ORIGIN_SCHEMES = ("http", "https")
+
+_client: httpx.AsyncClient | None = None
+
+
+def is_public_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return not (
+        ip.is_loopback
+        or ip.is_private
+        or ip.is_link_local
+        or ip.is_reserved
+        or ip.is_multicast
+        or ip.is_unspecified
+    )
+
+
+async def check_origin(url: httpx.URL):
+    """Links are given by users, so the server must not be made to fetch
+    anything but public http(s) hosts"""
+    if url.scheme not in ORIGIN_SCHEMES:
+        raise BadGateway(f"Link scheme {url.scheme!r} is not allowed")
+    port = url.port or (443 if url.scheme == "https" else 80)
+    try:
+        addresses = await asyncio.get_running_loop().getaddrinfo(
+            url.host, port, type=socket.SOCK_STREAM
+        )
+    except (socket.gaierror, UnicodeError) as exc:
+        raise BadGateway(f"Link host {url.host!r} is not resolvable: {exc}")
+    for *_, sockaddr in addresses:
+        if not is_public_address(str(sockaddr[0])):
+            raise BadGateway(f"Link host {url.host!r} is not a public address")
+
+
+async def _check_request(request: httpx.Request):
+    # Request hooks also run for every redirect hop
+    await check_origin(request.url)
+
+
+def get_client() -> httpx.AsyncClient:
+    """One connection pool for every proxied link"""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=ORIGIN_TIMEOUT_S,
+            follow_redirects=True,
+            max_redirects=ORIGIN_MAX_REDIRECTS,
+            limits=httpx.Limits(max_connections=ORIGIN_MAX_CONNECTIONS),
+            event_hooks={"request": [_check_request]},
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def clear_link_cache():
+    """Caches of a previous run are never reused"""
+    shutil.rmtree(config.LINK_CACHE_PATH, ignore_errors=True)
+
+
+@dataclass(frozen=True)
+class LinkInfo:
+    size: int
+    content_type: str | None
+    # Origin validator, the cache is only valid for this version of the link
+    etag: str
+
+
+async def fetch_range(
+    client: httpx.AsyncClient, url: str, start: int, end: int
+) -> httpx.Response:
+    try:
+        response = await client.get(url, headers={"Range": f"bytes={start}-{end - 1}"})
+    except httpx.HTTPError as exc:
+        raise BadGateway(f"Link is not reachable: {exc}")
+    if response.status_code != 206:
+        raise BadGateway(f"Link answered {response.status_code} to a range request")
+    return response
+
+
+async def probe_link(client: httpx.AsyncClient, url: str) -> LinkInfo:
+    response = await fetch_range(client, url, 0, 1)
+    _, _, size = response.headers.get("content-range", "").rpartition("/")
+    if not size.isdigit():
+        raise BadGateway("Link has unknown size")
+    return LinkInfo(
+        int(size),
+        response.headers.get("content-type"),
+        response.headers.get("etag") or response.headers.get("last-modified", ""),
+    )
+
+
+class ChunkCache:
+    """Fixed-size chunks of one link in a directory, the least recently used
+    chunks are deleted once max_chunks are stored"""
+
+    def __init__(self, path: Path, max_chunks: int) -> None:
+        self.path: Path = path
+        self.max_chunks: int = max_chunks
+        self.chunks: OrderedDict[int, int] = OrderedDict()
+
+    def _file(self, chunk_id: int) -> Path:
+        return self.path / str(chunk_id)
+
+    def __contains__(self, chunk_id: int) -> bool:
+        return chunk_id in self.chunks
+
+    async def get(self, chunk_id: int) -> bytes | None:
+        if chunk_id not in self.chunks:
+            return None
+        self.chunks.move_to_end(chunk_id)
+        try:
+            return await anyio.Path(self._file(chunk_id)).read_bytes()
+        except FileNotFoundError:
+            # Evicted while being read
+            return None
+
+    async def put(self, chunk_id: int, data: bytes):
+        await anyio.Path(self.path).mkdir(parents=True, exist_ok=True)
+        _ = await anyio.Path(self._file(chunk_id)).write_bytes(data)
+        self.chunks[chunk_id] = len(data)
+        self.chunks.move_to_end(chunk_id)
+        while len(self.chunks) > self.max_chunks:
+            victim, _ = self.chunks.popitem(last=False)
+            self._file(victim).unlink(missing_ok=True)
+
+    def clear(self):
+        self.chunks.clear()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class LinkProxy(Logging):
+    """Serves a link from a range cache on disk. Each chunk is fetched from
+    the origin once however many viewers ask for it, and chunks ahead of
+    the room's playhead are fetched before anyone asks."""
+
+    CHUNK_SIZE: int = 1024 * 1024
+    READ_AHEAD_CHUNKS: int = 16
+
+    def __init__(
+        self, url: str, info: LinkInfo, cache: ChunkCache, client: httpx.AsyncClient
+    ) -> None:
+        self.url: str = url
+        self.info: LinkInfo = info
+        self.cache: ChunkCache = cache
+        self.client: httpx.AsyncClient = client
+        self.fetching: dict[int, asyncio.Task[bytes]] = {}
+        self.playhead_chunk: int = 0
+        self._read_ahead_task: asyncio.Task[None] | None = None
+
+    @classmethod
+    async def open(cls, url: str, cache_path: Path, max_bytes: int) -> "LinkProxy":
+        client = get_client()
+        info = await probe_link(client, url)
+        max_chunks = max(cls.READ_AHEAD_CHUNKS, max_bytes // cls.CHUNK_SIZE)
+        return cls(url, info, ChunkCache(cache_path, max_chunks), client)
+
+    @property
+    def size(self) -> int:
+        return self.info.size
+
+    @property
+    def chunks_count(self) -> int:
+        return -(-self.size // self.CHUNK_SIZE)
+
+    async def read_chunk(self, chunk_id: int) -> bytes:
+        data = await self.cache.get(chunk_id)
+        if data is not None:
+            return data
+        task = self.fetching.get(chunk_id)
+        if task is None:
+            task = asyncio.create_task(self._fetch(chunk_id))
+            self.fetching[chunk_id] = task
+            task.add_done_callback(lambda t: self._fetched(chunk_id, t))
+        # A viewer going away must not cancel a fetch others may wait for
+        return await asyncio.shield(task)
+
+    async def _fetch(self, chunk_id: int) -> bytes:
+        start = chunk_id * self.CHUNK_SIZE
+        end = min(self.size, start + self.CHUNK_SIZE)
+        response = await fetch_range(self.client, self.url, start, end)
+        if len(response.content) != end - start:
+            raise BadGateway(f"Link sent a short chunk {chunk_id}")
+        await self.cache.put(chunk_id, response.content)
+        return response.content
+
+    def _fetched(self, chunk_id: int, task: asyncio.Task[bytes]):
+        _ = self.fetching.pop(chunk_id, None)
+        if not task.cancelled() and task.exception() is not None:
+            self.logger.warning(f"Chunk {chunk_id} of {self.url}: {task.exception()}")
+
+    async def read(self, start: int, length: int) -> bytes:
+        if length <= 0:
+            return b""
+        chunks = [data async for data in self.iter_bytes(start, start + length)]
+        return b"".join(chunks)
+
+    async def iter_bytes(self, start: int, end: int) -> AsyncGenerator[bytes]:
+        end = min(end, self.size)
+        while start < end:
+            chunk_id, offset = divmod(start, self.CHUNK_SIZE)
+            data = await self.read_chunk(chunk_id)
+            data = data[offset : offset + end - start]
+            start += len(data)
+            yield data
+
+    def set_playhead(self, byte: int):
+        self.playhead_chunk = max(0, byte) // self.CHUNK_SIZE
+        if self._read_ahead_task is None or self._read_ahead_task.done():
+            self._read_ahead_task = asyncio.create_task(self._read_ahead())
+
+    def _next_missing(self) -> int | None:
+        last = min(self.chunks_count, self.playhead_chunk + self.READ_AHEAD_CHUNKS)
+        for chunk_id in range(self.playhead_chunk, last):
+            if chunk_id not in self.cache and chunk_id not in self.fetching:
+                return chunk_id
+        return None
+
+    async def _read_ahead(self):
+        """One chunk at a time, the rest of the pool is left to viewers"""
+        while (chunk_id := self._next_missing()) is not None:
+            try:
+                _ = await self.read_chunk(chunk_id)
+            except BadGateway:
+                return
+
+    def close(self):
+        if self._read_ahead_task is not None:
+            _ = self._read_ahead_task.cancel()
+            self._read_ahead_task = None
+        for task in self.fetching.values():
+            _ = task.cancel()
+        self.fetching.clear()
+        self.cache.clear()
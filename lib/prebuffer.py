@@ -0,0 +1,221 @@
+import asyncio
+import shutil
+from uuid import UUID
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import config
+from lib.engine import async_session_maker
+from lib.http_exceptions import ContentTooLarge, NotFound, UnprocessableEntity
+from lib.logger import create_logger
+from lib.room import Room, RoomStorage
+from lib.video_sources import TorrentVideoSource
+from models.prebuffer_model import (
+    UNFINISHED_STATUSES,
+    PrebufferJobModel,
+    PrebufferStatusEnum,
+)
+from schemas.prebuffer_schemas import CreatePrebufferJobSchema
+
+PREBUFFER_CHECK_SLEEP = 5
+MAX_ERROR_LENGTH = 256
+
+logger = create_logger("Prebuffer")
+
+
+class PrebufferException(Exception): ...
+
+
+def free_disk_space() -> int:
+    config.TORRENT_SAVE_PATH.mkdir(parents=True, exist_ok=True)
+    return shutil.disk_usage(config.TORRENT_SAVE_PATH).free
+
+
+def torrent_source(room: Room) -> TorrentVideoSource:
+    if not isinstance(room.video_source, TorrentVideoSource):
+        raise UnprocessableEntity("Only torrent rooms can be pre-buffered!")
+    return room.video_source
+
+
+def job_pieces(source: TorrentVideoSource, job: PrebufferJobModel) -> range:
+    if job.file_index >= len(source.get_available_files()):
+        raise NotFound("File not found!")
+    return source.file_span_pieces(job.file_index, job.byte_start, job.byte_end)
+
+
+class PrebufferStorage:
+    """Downloads spans of torrent rooms in the background. Jobs live in the
+    database, so they are picked up again after a restart."""
+
+    tasks: dict[UUID, asyncio.Task] = {}
+
+    @classmethod
+    async def create_job(
+        cls, session: AsyncSession, room_id: UUID, data: CreatePrebufferJobSchema
+    ) -> PrebufferJobModel:
+        room = await RoomStorage.get_room(session, room_id)
+        source = torrent_source(room)
+        if data.file_index >= len(source.get_available_files()):
+            raise NotFound("File not found!")
+        if data.start_s is not None or data.end_s is not None:
+            byte_start = source.file_byte_at(data.file_index, data.start_s or 0)
+            byte_end = (
+                None
+                if data.end_s is None
+                else source.file_byte_at(data.file_index, data.end_s)
+            )
+        else:
+            byte_start, byte_end = data.byte_start or 0, data.byte_end
+        pieces = source.file_span_pieces(data.file_index, byte_start, byte_end)
+        room.start_video()
+        downloaded, total = source.engine().downloaded_of(pieces)
+        await cls.check_limits(session, total - downloaded)
+        return await PrebufferJobModel.create(
+            session, room_id, data.file_index, byte_start, byte_end, total
+        )
+
+    @classmethod
+    async def check_limits(cls, session: AsyncSession, left: int):
+        active = sum(
+            job.total - job.downloaded
+            for job in await PrebufferJobModel.get_unfinished(session)
+        )
+        if active + left > config.PREBUFFER_MAX_BYTES:
+            raise ContentTooLarge(
+                f"Pre-buffer limit is {config.PREBUFFER_MAX_BYTES} bytes, "
+                + f"{active} are already queued"
+            )
+        if free_disk_space() - left < config.PREBUFFER_MIN_FREE_DISK:
+            raise ContentTooLarge("Not enough disk space!")
+
+    @classmethod
+    def start_job(cls, job_id: UUID):
+        if job_id in cls.tasks:
+            return
+        task = asyncio.create_task(cls.run_job(job_id))
+        cls.tasks[job_id] = task
+        task.add_done_callback(lambda _: cls.tasks.pop(job_id, None))
+
+    @classmethod
+    async def run_job(cls, job_id: UUID):
+        try:
+            await cls.download(job_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.exception(f"Pre-buffer job {job_id} failed")
+            async with async_session_maker.begin() as session:
+                await PrebufferJobModel.update(
+                    session,
+                    job_id,
+                    status=PrebufferStatusEnum.failed,
+                    error=str(exc)[:MAX_ERROR_LENGTH],
+                )
+
+    @classmethod
+    async def download(cls, job_id: UUID):
+        room: Room | None = None
+        try:
+            while True:
+                async with async_session_maker.begin() as session:
+                    job = await PrebufferJobModel.get_job_id(session, job_id)
+                    current = await RoomStorage.get_room(session, job.room_id)
+                    if current is not room:
+                        # The room could be reloaded with another torrent
+                        if room is not None:
+                            room.kept_by.discard(job_id)
+                        current.kept_by.add(job_id)
+                    room = current
+                    source = torrent_source(room)
+                    pieces = job_pieces(source, job)
+                    room.start_video()
+                    handler = source.engine()
+                    # Other jobs or viewers could have changed priorities
+                    _ = handler.download_in_background(pieces)
+                    source.set_download_limit(
+                        0 if room.people_inside else config.PREBUFFER_DOWNLOAD_LIMIT
+                    )
+                    downloaded, total = handler.downloaded_of(pieces)
+                    done = downloaded >= total
+                    await PrebufferJobModel.update(
+                        session,
+                        job_id,
+                        status=(
+                            PrebufferStatusEnum.done
+                            if done
+                            else PrebufferStatusEnum.running
+                        ),
+                        downloaded=downloaded,
+                        total=total,
+                    )
+                if done:
+                    logger.info(f"Pre-buffer job {job_id} is done")
+                    return
+                if free_disk_space() < config.PREBUFFER_MIN_FREE_DISK:
+                    raise PrebufferException("Not enough disk space!")
+                await asyncio.sleep(PREBUFFER_CHECK_SLEEP)
+        finally:
+            if room is not None:
+                room.kept_by.discard(job_id)
+                if not room.kept_by and isinstance(
+                    room.video_source, TorrentVideoSource
+                ):
+                    room.video_source.set_download_limit(0)
+
+    @classmethod
+    async def get_job(
+        cls, session: AsyncSession, room_id: UUID, job_id: UUID
+    ) -> PrebufferJobModel:
+        job = await PrebufferJobModel.get_job_id(session, job_id)
+        if job.room_id != room_id:
+            raise NotFound("Pre-buffer job not found!")
+        return job
+
+    @classmethod
+    async def cancel_job(
+        cls, session: AsyncSession, room_id: UUID, job_id: UUID
+    ) -> PrebufferJobModel:
+        job = await cls.get_job(session, room_id, job_id)
+        task = cls.tasks.pop(job_id, None)
+        if task is not None:
+            _ = task.cancel()
+        if job.status in UNFINISHED_STATUSES:
+            job.status = PrebufferStatusEnum.cancelled
+        room = RoomStorage.loaded_rooms.get(room_id)
+        if room is not None and isinstance(room.video_source, TorrentVideoSource):
+            handler = room.video_source.torrent_manager
+            if handler is None:
+                return job
+            try:
+                pieces = job_pieces(room.video_source, job)
+            except NotFound:
+                return job
+            handler.stop_background_download(pieces)
+            # Let jobs that share these pieces take them back
+            for other in await PrebufferJobModel.get_room_jobs(session, room_id):
+                if other.status in UNFINISHED_STATUSES and other.job_id != job_id:
+                    _ = handler.download_in_background(
+                        job_pieces(room.video_source, other)
+                    )
+        return job
+
+    @classmethod
+    async def cancel_room_jobs(cls, session: AsyncSession, room_id: UUID):
+        for job in await PrebufferJobModel.get_room_jobs(session, room_id):
+            if job.status in UNFINISHED_STATUSES:
+                _ = await cls.cancel_job(session, room_id, job.job_id)
+
+    @classmethod
+    async def resume_jobs(cls):
+        async with async_session_maker.begin() as session:
+            jobs = await PrebufferJobModel.get_unfinished(session)
+        logger.info(f"Resuming {len(jobs)} pre-buffer jobs")
+        for job in jobs:
+            cls.start_job(job.job_id)
+
+    @classmethod
+    def stop_all(cls):
+        """Stops jobs without touching their status, so they resume on start"""
+        for task in list(cls.tasks.values()):
+            _ = task.cancel()
+        cls.tasks.clear()
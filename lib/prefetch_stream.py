@@ -0,0 +1,62 @@
+import asyncio
+from collections import deque
+from collections.abc import AsyncGenerator
+from contextlib import aclosing
+
+from lib.torrent.piece_cache import PieceData
+
+
+class PrefetchStream:
+    """Reads a byte stream ahead in its own task while the consumer is busy
+    sending, so fetching and sending overlap. At most max_bytes wait in the
+    buffer: a slow consumer stops the reader instead of piling up memory."""
+
+    def __init__(self, source: AsyncGenerator[PieceData], max_bytes: int) -> None:
+        self.source: AsyncGenerator[PieceData] = source
+        self.max_bytes: int = max_bytes
+        self.chunks: deque[PieceData] = deque()
+        self.buffered: int = 0
+        self.done: bool = False
+        self.task: asyncio.Task[None] | None = None
+        self._filled: asyncio.Event = asyncio.Event()
+        self._drained: asyncio.Event = asyncio.Event()
+
+    def start(self) -> asyncio.Task[None]:
+        if self.task is None:
+            self.task = asyncio.create_task(self._read_ahead())
+        return self.task
+
+    async def _read_ahead(self):
+        try:
+            async with aclosing(self.source) as source:
+                async for data in source:
+                    while self.buffered >= self.max_bytes:
+                        self._drained.clear()
+                        await self._drained.wait()
+                    self.chunks.append(data)
+                    self.buffered += len(data)
+                    self._filled.set()
+        finally:
+            self.done = True
+            self._filled.set()
+
+    async def read(self) -> AsyncGenerator[PieceData]:
+        task = self.start()
+        try:
+            while True:
+                while not self.chunks and not self.done:
+                    self._filled.clear()
+                    await self._filled.wait()
+                if not self.chunks:
+                    break
+                data = self.chunks.popleft()
+                self.buffered -= len(data)
+                self._drained.set()
+                yield data
+        finally:
+            if not task.done():
+                _ = task.cancel()
+            _ = await asyncio.wait((task,))
+        # A failure of the source reaches the consumer after the chunks read before it
+        if not task.cancelled() and (error := task.exception()) is not None:
+            raise error
@@ -0,0 +1,62 @@
+from fastapi import Request
+
+from lib.custom_responses import LoadingTorrentFileResponse
+from lib.logger import Logging
+
+# Query parameter with the websocket conn_id of the player asking for video
+PLAYER_PARAM = "player"
+
+ClientKey = str
+
+
+def client_key(request: Request) -> ClientKey | None:
+    """Player the request comes from, None for clients not telling"""
+    return request.query_params.get(PLAYER_PARAM) or None
+
+
+def overlaps(a: tuple[int, int], b: tuple[int, int]) -> bool:
+    return a[0] < b[1] and b[0] < a[1]
+
+
+class ResponseRegistry(Logging):
+    """Video responses in flight, by player. A player starting a range apart
+    from the ones it is downloading has seeked, its older responses are
+    superseded so only what a viewer is watching now keeps downloading.
+    Overlapping ranges are kept, players fetch those in parallel.
+    Responses leave once they finish."""
+
+    def __init__(self) -> None:
+        self.responses: dict[ClientKey | None, list[LoadingTorrentFileResponse]] = {}
+
+    def add(self, client: ClientKey | None, response: LoadingTorrentFileResponse):
+        responses = self.responses.setdefault(client, [])
+        span = response.byte_span
+        for old in responses:
+            if client is None or old.finished or overlaps(old.byte_span, span):
+                continue
+            self.logger.debug(f"Response {old.byte_span} of player {client} superseded")
+            old.cancel()
+        responses.append(response)
+        response.on_finish(lambda: self._discard(client, response))
+
+    def _discard(self, client: ClientKey | None, response: LoadingTorrentFileResponse):
+        responses = self.responses.get(client, [])
+        if response in responses:
+            responses.remove(response)
+        if not responses:
+            _ = self.responses.pop(client, None)
+
+    def all(self) -> list[LoadingTorrentFileResponse]:
+        return [r for responses in self.responses.values() for r in responses]
+
+    @property
+    def busy(self) -> bool:
+        return any(not r.finished for r in self.all())
+
+    def cancel_all(self):
+        for response in self.all():
+            response.cancel()
+        self.responses.clear()
+
+    def __len__(self) -> int:
+        return len(self.all())
@@ -5,17 +5,29 @@ from uuid import UUID
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from config import ROOM_INACTIVITY_PERIOD
+from config import (
+    ROOM_INACTIVITY_PERIOD,
+    TORRENT_GC_PERIOD,
+    VIDEO_ENGINE_IDLE_PERIOD,
+)
+from lib.auth import sign_video_query
+from lib.buffer_monitor import (
+    BUFFER_CHECK_SLEEP,
+    SERVER_SUSPENDER_ID,
+    BufferAction,
+    BufferMonitor,
+    BufferStateThrottle,
+)
 from lib.commands.command_handlers import (
     CommandsGroupHandler,
     StateChangeCommandsHandler,
 )
 from lib.commands.server_commands import (
+    BufferStateCommand,
     FileChangeCommand,
     ServerCommand,
     UserConnectedCommand,
     UserDisconnectedCommand,
-    UsersListCommand,
 )
 from lib.connections import Connection, ConnectionsManager
 from lib.http_exceptions import NotFound
@@ -25,10 +37,20 @@ from lib.video_status.status_storage import StatusHandler
 from lib.video_status.video_statuses import SuspendStatus, VideoStatus
 from models.room_model import RoomModel
 from schemas.user_schemas import GetUserSchema, UserRoomSchema
+from services.torrent_store import TorrentStore
 
 monitor_logger = create_logger("RoomMonitor")
 
 
+def video_url(room_id: UUID, file_index: int) -> str:
+    return f"/files/{room_id}/{file_index}"
+
+
+def signed_video_url(room_id: UUID, file_index: int, user: str) -> str:
+    query = sign_video_query(room_id, file_index, user)
+    return f"{video_url(room_id, file_index)}?{query}"
+
+
 class RoomStateHandler(Logging):
     def __init__(
         self,
@@ -46,7 +68,7 @@ class RoomStateHandler(Logging):
     def update_model(self, model: RoomModel):
         self.status_handler.update_model(model)
 
-    async def send_status_update(self):
+    def send_status_update(self):
         status = self.status_handler.status
         state_name = status.__class__.__name__
         if isinstance(status, SuspendStatus):
@@ -55,59 +77,69 @@ class RoomStateHandler(Logging):
             )
         else:
             self.logger.info(f"Room {self.room_id} is in state: {state_name}")
-        await self.conn_manager.send_room(self.status_handler.to_server_command())
+        self.conn_manager.send_room(self.status_handler.to_server_command())
 
     async def handle_cmd_str(self, cmd_str: str, by: UserRoomSchema):
+        # Broadcasts only queue frames, so no client's network holds the lock
         async with self.status_change_lock:
             self.cmd_handler.handle_str_cmd(cmd_str, by)
-            await self.send_status_update()
+            self.send_status_update()
 
-    async def send_cmd(self, cmd: ServerCommand, exclude_id: list[int] | None = None):
+    async def set_server_suspend(self, action: BufferAction):
+        async with self.status_change_lock:
+            if action == BufferAction.SUSPEND:
+                _ = self.status_handler.add_suspend_by(SERVER_SUSPENDER_ID)
+            else:
+                _ = self.status_handler.remove_suspend_by(SERVER_SUSPENDER_ID)
+            self.send_status_update()
+
+    def send_cmd(self, cmd: ServerCommand, exclude_id: list[int] | None = None):
         exclude_id = exclude_id or []
-        await self.conn_manager.send_room(cmd, exclude_id)
+        self.conn_manager.send_room(cmd, exclude_id)
+
+    def send_cmd_to(self, conn_id: int, cmd: ServerCommand):
+        self.conn_manager.send_to(conn_id, cmd)
 
     async def add_connection(
         self, conn: Connection, user: GetUserSchema
     ) -> UserRoomSchema:
         user_room = await self.conn_manager.add_connection(conn, user)
         self.status_handler.add_suspend_by(user_room.conn_id)
-        await self.send_user_list(user_room)
-        await self.send_current_file_to(user_room.conn_id)
-        await self.send_status_update()
-        await self.send_user_connected(user_room)
+        self.send_user_list(user_room)
+        self.send_current_file_to(user_room.conn_id)
+        self.send_status_update()
+        self.send_user_connected(user_room)
         return user_room
 
-    async def send_status_to(self, conn_id: int):
-        await self.conn_manager.send_to(
-            conn_id, self.status_handler.to_server_command()
-        )
+    def send_status_to(self, conn_id: int):
+        self.conn_manager.send_to(conn_id, self.status_handler.to_server_command())
 
-    async def send_current_file_to(self, conn_id: int):
-        await self.conn_manager.send_to(
+    def send_current_file_to(self, conn_id: int):
+        self.conn_manager.send_to(
             conn_id, FileChangeCommand(self.status_handler.current_file_ind)
         )
 
-    async def send_change_file(self):
-        await self.conn_manager.send_room(
+    def send_change_file(self):
+        self.conn_manager.send_room(
             FileChangeCommand(self.status_handler.current_file_ind)
         )
 
-    async def send_user_connected(self, user: UserRoomSchema):
-        await self.conn_manager.send_room(UserConnectedCommand(user))
+    def send_user_connected(self, user: UserRoomSchema):
+        self.conn_manager.send_room(UserConnectedCommand(user))
 
-    async def send_user_disconnected(self, conn_id: int):
-        await self.conn_manager.send_room(UserDisconnectedCommand(conn_id))
+    def send_user_disconnected(self, conn_id: int):
+        self.conn_manager.send_room(UserDisconnectedCommand(conn_id))
 
-    async def send_user_list(self, user: UserRoomSchema):
-        await self.conn_manager.send_to(
-            user.conn_id, UsersListCommand(self.conn_manager.get_users())
+    def send_user_list(self, user: UserRoomSchema):
+        self.conn_manager.send_text_to(
+            user.conn_id, self.conn_manager.users_list_frame()
         )
 
     async def remove_connection(self, conn_id: int):
         self.conn_manager.remove_connection(conn_id)
         self.status_handler.remove_suspend_by(conn_id).set_pause_status()
-        await self.send_user_disconnected(conn_id)
-        await self.send_status_update()
+        self.send_user_disconnected(conn_id)
+        self.send_status_update()
 
     async def cleanup(self): ...
 
@@ -135,14 +167,20 @@ class Room:
         self.img_link: str = img_link
         self.video_source: VideoSource = video_source
         cmd_handler = CommandsGroupHandler(
-            (StateChangeCommandsHandler(status_storage),)
+            (StateChangeCommandsHandler(status_storage, video_source.prefetch_at),)
         )
         conn_manager = ConnectionsManager()
         self.room_state_handler: RoomStateHandler = RoomStateHandler(
             room_id, status_storage, cmd_handler, conn_manager
         )
         self.last_leave: float = time.time()
+        self.video_used_at: float = time.time()
         self.description: str = description
+        self.buffer_monitor: BufferMonitor = BufferMonitor()
+        self.buffer_throttle: BufferStateThrottle = BufferStateThrottle()
+        self._buffer_task: asyncio.Task | None = None
+        # Ids of background jobs that need the room to stay loaded
+        self.kept_by: set[UUID] = set()
 
     @classmethod
     def from_model(cls, model: RoomModel) -> "Room":
@@ -164,7 +202,9 @@ class Room:
     async def add_connection(
         self, conn: Connection, user_schema: GetUserSchema
     ) -> UserRoomSchema:
-        return await self.room_state_handler.add_connection(conn, user_schema)
+        user_room = await self.room_state_handler.add_connection(conn, user_schema)
+        self.send_buffer_state_to(user_room.conn_id)
+        return user_room
 
     async def remove_connection(self, conn_id: int):
         await self.room_state_handler.remove_connection(conn_id)
@@ -173,10 +213,72 @@ class Room:
     async def handle_cmd_str(self, cmd_str: str, by: UserRoomSchema):
         await self.room_state_handler.handle_cmd_str(cmd_str, by)
         if self.video_source.set_file_index(self.room_state_handler.current_status.current_file_ind):
-            await self.room_state_handler.send_change_file()
+            self.room_state_handler.send_change_file()
+
+    def start(self):
+        if self._buffer_task is None:
+            self._buffer_task = asyncio.create_task(self.watch_buffer())
+
+    def start_video(self):
+        """Called by everything that needs video data, the room itself
+        (metadata and sync state) works without the video engine."""
+        self.video_used_at = time.time()
+        self.video_source.start()
+
+    def is_video_idle(self, now: float) -> bool:
+        return (
+            not self.people_inside
+            and not self.kept_by
+            and not self.video_source.busy
+            and now - max(self.last_leave, self.video_used_at)
+            >= VIDEO_ENGINE_IDLE_PERIOD
+        )
 
-    async def cleanup(self):
-        self.video_source.cleanup()
+    async def check_buffer(self):
+        status = self.room_state_handler.current_status
+        self.video_source.track_playhead(status.video_time)
+        self.video_source.prefetch_next(status.video_time)
+        action = self.buffer_monitor.decide(
+            status, self.video_source.seconds_buffered(status.video_time)
+        )
+        if action is not None:
+            monitor_logger.info(f"Room {self.room_id}: buffer monitor {action.value}s")
+            await self.room_state_handler.set_server_suspend(action)
+
+    async def publish_buffer_state(self):
+        if not self.people_inside:
+            return
+        state = self.video_source.buffer_state(
+            self.room_state_handler.current_status.video_time
+        )
+        now = time.time()
+        if state is None or not self.buffer_throttle.should_send(state, now):
+            return
+        self.buffer_throttle.mark_sent(state, now)
+        self.room_state_handler.send_cmd(BufferStateCommand(state))
+
+    def send_buffer_state_to(self, conn_id: int):
+        """A joining viewer gets the state at once, the others keep the throttled updates"""
+        state = self.video_source.buffer_state(
+            self.room_state_handler.current_status.video_time
+        )
+        if state is not None:
+            self.room_state_handler.send_cmd_to(conn_id, BufferStateCommand(state))
+
+    async def watch_buffer(self):
+        while True:
+            await asyncio.sleep(BUFFER_CHECK_SLEEP)
+            try:
+                await self.check_buffer()
+                await self.publish_buffer_state()
+            except Exception:
+                monitor_logger.exception(f"Error in buffer monitor of {self.room_id}")
+
+    async def cleanup(self, delete_files: bool = True):
+        if self._buffer_task is not None:
+            _ = self._buffer_task.cancel()
+            self._buffer_task = None
+        self.video_source.cleanup(delete_files)
         await self.room_state_handler.cleanup()
 
     @property
@@ -187,18 +289,27 @@ class Room:
     def curr_fi(self):
         return self.video_source.file_index
 
+    def check_file(self, fi: int):
+        """Only the current file is served, URLs of a previous one are stale"""
+        if fi != self.curr_fi:
+            raise NotFound(f"File {fi} is not played in the room")
+
     async def set_send_curr_fi(self, val: int):
         if self.room_state_handler.status_handler.set_current_file_ind(val) and \
            self.video_source.set_file_index(self.room_state_handler.status_handler.current_file_ind):
-            await self.room_state_handler.send_change_file()
+            self.room_state_handler.send_change_file()
 
     @property
     def people_inside(self):
         return self.room_state_handler.people_inside
 
+    @property
+    def at_risk(self) -> bool:
+        return self.video_source.at_risk
+
     @property
     def video(self):
-        return f"/files/{self.room_id}/{self.curr_fi}"
+        return video_url(self.room_id, self.curr_fi)
 
 
 room_st_logger = create_logger("RoomStorage")
@@ -216,8 +327,17 @@ class RoomStorage:
             if room_id in cls.loaded_rooms and ignore_if_loaded:
                 return
             room = await RoomModel.get_room_id(session, room_id)
-            cls.loaded_rooms[room_id] = Room.from_model(room)
-            cls.loaded_rooms[room_id].video_source.start()
+            old = cls.loaded_rooms.get(room_id)
+            new = Room.from_model(room)
+            cls.loaded_rooms[room_id] = new
+            new.start()
+            if old is not None:
+                # Started first, so an unchanged torrent keeps its download
+                if old.people_inside:
+                    new.start_video()
+                await old.cleanup(
+                    delete_files=not old.video_source.same_video(new.video_source)
+                )
 
     @classmethod
     async def unload_room(cls, room_id: UUID):
@@ -228,6 +348,10 @@ class RoomStorage:
 
     @classmethod
     async def get_room(cls, session: AsyncSession, room_id: UUID) -> Room:
+        # Every video range request lands here, loaded rooms skip the lock
+        room = cls.loaded_rooms.get(room_id)
+        if room is not None:
+            return room
         await cls.load_room(session, room_id)
         room = cls.loaded_rooms.get(room_id)
         if room is None:
@@ -258,6 +382,13 @@ class RoomStorage:
             return_exceptions=True,
         )
 
+    @classmethod
+    def stop_idle_videos(cls):
+        now = time.time()
+        for room in cls.loaded_rooms.values():
+            if room.is_video_idle(now):
+                room.video_source.stop()
+
     @classmethod
     async def remove_inactive(cls):
         room_st_logger.debug("Cleaning up inactive rooms")
@@ -265,6 +396,7 @@ class RoomStorage:
             room_id
             for room_id, room in cls.loaded_rooms.items()
             if not room.people_inside
+            and not room.kept_by
             and time.time() - room.last_leave >= ROOM_INACTIVITY_PERIOD
         ]
         _ = await asyncio.gather(
@@ -274,10 +406,16 @@ class RoomStorage:
 
 
 async def _monitor_rooms():
+    # Collected at startup, the next collection is a period later
+    collected_at = time.monotonic()
     while True:
         await asyncio.sleep(60)
         try:
             await RoomStorage.remove_inactive()
+            RoomStorage.stop_idle_videos()
+            if time.monotonic() - collected_at >= TORRENT_GC_PERIOD:
+                collected_at = time.monotonic()
+                await TorrentStore.collect_garbage()
         except Exception:
             monitor_logger.exception("Error in room monitor")
 
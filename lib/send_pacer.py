@@ -0,0 +1,43 @@
+import asyncio
+import time
+from collections.abc import Callable
+
+# Bytes per second at a position of the file, None where sending is not paced
+PacingRate = Callable[[int], float | None]
+
+
+class SendPacer:
+    """Token bucket pacing one response. The first burst bytes go out at full
+    speed, so players fill their buffer and seeks start quickly. After that
+    the bucket refills at rate(position) and holds at most a second of it,
+    so a viewer that stops reading for a while gets no second burst."""
+
+    def __init__(
+        self,
+        rate: PacingRate,
+        burst: int,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.rate: PacingRate = rate
+        self.clock: Callable[[], float] = clock
+        self.tokens: float = burst
+        self.updated: float = clock()
+
+    def reserve(self, position: int, size: int) -> float:
+        """Takes size bytes at position, returns seconds to wait before
+        sending them"""
+        now = self.clock()
+        elapsed = now - self.updated
+        self.updated = now
+        rate = self.rate(position)
+        if rate is None:
+            return 0
+        if elapsed > 0:
+            self.tokens = max(self.tokens, min(self.tokens + elapsed * rate, rate))
+        self.tokens -= size
+        return max(0.0, -self.tokens / rate)
+
+    async def wait(self, position: int, size: int):
+        delay = self.reserve(position, size)
+        if delay > 0:
+            await asyncio.sleep(delay)
@@ -4,6 +4,7 @@ from typing import Callable
 
 
 from lib.logger import Logging
+from lib.torrent.alert_records import AlertRecord
 from lib.torrent.torrent_info import Alert, TorrentInfo
 
 OBSERVE_ALERTS_SLEEP = 0.1
@@ -24,10 +25,15 @@ class AlertObserver(Logging):
         while self.observe:
             alerts = self.torrent.pop_alerts()
             for a in alerts:
-                alert_type = type(a)
+                # Alerts from the engine process are records of the original type
+                alert_type = a.lt_type if isinstance(a, AlertRecord) else type(a)
                 self.logger.debug(f"Got alert: {a}")
-                for observer in self.alert_observers[alert_type]:
-                    observer(a)
+                try:
+                    for observer in self.alert_observers[alert_type]:
+                        observer(a)
+                finally:
+                    if isinstance(a, AlertRecord):
+                        a.release()
             await sleep(OBSERVE_ALERTS_SLEEP)
 
     def cleanup(self):
@@ -0,0 +1,101 @@
+import mmap
+import os
+from dataclasses import dataclass, field
+from typing import ClassVar
+
+import libtorrent as lt
+
+# Where POSIX shared memory blocks of the engine process show up as files
+SHM_DIR = "/dev/shm"
+
+
+@dataclass
+class ErrorCode:
+    code: int = 0
+
+    def value(self) -> int:
+        return self.code
+
+
+@dataclass
+class AlertRecord:
+    """Picklable copy of a libtorrent alert, for alerts coming from the
+    engine process. Observers are notified by lt_type, and fields are named
+    like the ones of the original alert."""
+
+    lt_type: ClassVar[type]
+
+    def release(self): ...
+
+
+@dataclass
+class ReadPieceRecord(AlertRecord):
+    """Piece data stays in shared memory created by the engine process. The
+    block is mapped read only and unlinked right away, the mapping lives as
+    long as views of the buffer do, so nothing is copied."""
+
+    lt_type: ClassVar[type] = lt.read_piece_alert
+    piece: int
+    size: int
+    error: ErrorCode
+    shm_name: str | None = None
+    _view: memoryview | None = field(default=None, repr=False, compare=False)
+
+    @property
+    def buffer(self) -> memoryview | None:
+        if self._view is None and self.shm_name is not None:
+            path = os.path.join(SHM_DIR, self.shm_name)
+            with open(path, "rb") as file:
+                mapped = mmap.mmap(file.fileno(), self.size, access=mmap.ACCESS_READ)
+            os.unlink(path)
+            self.shm_name = None
+            self._view = memoryview(mapped)
+        return self._view
+
+    def release(self):
+        """Unlinks a block nobody mapped, a mapped one is unmapped by the
+        garbage collector with its last view"""
+        if self.shm_name is not None:
+            try:
+                os.unlink(os.path.join(SHM_DIR, self.shm_name))
+            except FileNotFoundError:
+                pass
+            self.shm_name = None
+        self._view = None
+
+
+@dataclass
+class TorrentStatusRecord:
+    """State of a torrent handle the engine process pushes periodically, so
+    queries of the web process are answered without a round trip"""
+
+    pieces: list[bool]
+    priorities: list[int]
+    peers: int
+    download_rate: int
+    downloading_peers: dict[int, set[str]]
+
+
+@dataclass
+class BlockFinishedRecord(AlertRecord):
+    lt_type: ClassVar[type] = lt.block_finished_alert
+    piece_index: int
+    block_index: int
+
+
+@dataclass
+class PieceFinishedRecord(AlertRecord):
+    lt_type: ClassVar[type] = lt.piece_finished_alert
+    piece_index: int
+
+
+@dataclass
+class HashFailedRecord(AlertRecord):
+    lt_type: ClassVar[type] = lt.hash_failed_alert
+    piece_index: int
+
+
+@dataclass
+class FileCompletedRecord(AlertRecord):
+    lt_type: ClassVar[type] = lt.file_completed_alert
+    index: int
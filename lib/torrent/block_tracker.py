@@ -0,0 +1,127 @@
+import asyncio
+from collections import defaultdict
+from collections.abc import Callable
+from contextlib import suppress
+
+import libtorrent as lt
+
+from lib.logger import Logging
+from lib.torrent.alert_observer import AlertObserver
+from lib.torrent.alert_records import (
+    BlockFinishedRecord,
+    HashFailedRecord,
+    PieceFinishedRecord,
+)
+from lib.torrent.torrent_info import (
+    BLOCK_SIZE,
+    Alert,
+    BlockFinishedAlert,
+    HashFailedAlert,
+    PieceFinishedAlert,
+    TorrentInfo,
+)
+
+
+class BlockTracker(Logging):
+    """Tracks finished 16 KiB blocks of pieces that are still downloading.
+    libtorrent reports a block finished once it is written to disk.
+
+    Data served from a partially downloaded piece is not hash checked yet,
+    so streams that sent such data are remembered with the piece until
+    libtorrent either verifies it or reports a hash failure, which is
+    passed on to them.
+    """
+
+    def __init__(self, torrent: TorrentInfo, alert_observer: AlertObserver) -> None:
+        self.torrent: TorrentInfo = torrent
+        self.finished_blocks: defaultdict[int, set[int]] = defaultdict(set)
+        self.verified: set[int] = set()
+        # piece -> callbacks of streams that sent it before its hash check
+        self.served_unverified: defaultdict[int, list[Callable[[int], None]]] = (
+            defaultdict(list)
+        )
+        # piece -> event set on its next finished block, verification or failure
+        self._changed: dict[int, asyncio.Event] = {}
+        self.alert_observer: AlertObserver = alert_observer
+        self.alert_observer.add_alert_observer(
+            lt.block_finished_alert, self.handle_block_finished_alert
+        )
+        self.alert_observer.add_alert_observer(
+            lt.piece_finished_alert, self.handle_piece_finished_alert
+        )
+        self.alert_observer.add_alert_observer(
+            lt.hash_failed_alert, self.handle_hash_failed_alert
+        )
+
+    def handle_block_finished_alert(self, alert: Alert) -> None:
+        if not isinstance(alert, (BlockFinishedAlert, BlockFinishedRecord)):
+            raise RuntimeError(
+                f"Alert is not a type of block_finished_alert! Actual type: {type(alert)}"
+            )
+        if alert.piece_index in self.verified:
+            return
+        self.finished_blocks[alert.piece_index].add(alert.block_index)
+        self._notify(alert.piece_index)
+
+    def handle_piece_finished_alert(self, alert: Alert) -> None:
+        if not isinstance(alert, (PieceFinishedAlert, PieceFinishedRecord)):
+            raise RuntimeError(
+                f"Alert is not a type of piece_finished_alert! Actual type: {type(alert)}"
+            )
+        self.verified.add(alert.piece_index)
+        _ = self.finished_blocks.pop(alert.piece_index, None)
+        _ = self.served_unverified.pop(alert.piece_index, None)
+        self._notify(alert.piece_index)
+
+    def handle_hash_failed_alert(self, alert: Alert) -> None:
+        if not isinstance(alert, (HashFailedAlert, HashFailedRecord)):
+            raise RuntimeError(
+                f"Alert is not a type of hash_failed_alert! Actual type: {type(alert)}"
+            )
+        _ = self.finished_blocks.pop(alert.piece_index, None)
+        self.verified.discard(alert.piece_index)
+        streams = self.served_unverified.pop(alert.piece_index, None)
+        if streams:
+            self.logger.warning(
+                f"Piece {alert.piece_index} failed hash check after being "
+                + f"streamed unverified by {len(streams)} streams"
+            )
+            for on_failed in streams:
+                on_failed(alert.piece_index)
+        self._notify(alert.piece_index)
+
+    def _notify(self, piece_id: int):
+        event = self._changed.pop(piece_id, None)
+        if event is not None:
+            event.set()
+
+    async def wait_change(self, piece_id: int, timeout_s: float):
+        """Waits for the next finished block of the piece, its verification
+        or hash failure, at most timeout_s"""
+        event = self._changed.setdefault(piece_id, asyncio.Event())
+        with suppress(TimeoutError):
+            _ = await asyncio.wait_for(event.wait(), max(0.0, timeout_s))
+
+    def is_verified(self, piece_id: int) -> bool:
+        return piece_id in self.verified or self.torrent.have_piece(piece_id)
+
+    def mark_served(self, piece_id: int, on_failed: Callable[[int], None]) -> None:
+        """on_failed is called with the piece if it fails its hash check"""
+        if self.is_verified(piece_id):
+            return
+        streams = self.served_unverified[piece_id]
+        if on_failed not in streams:
+            streams.append(on_failed)
+
+    def readable_until(self, piece_id: int, offset: int) -> int:
+        """Returns the end (piece relative) of contiguous finished blocks
+        starting from the block with offset."""
+        blocks = self.finished_blocks.get(piece_id)
+        block_id = offset // BLOCK_SIZE
+        if not blocks or block_id not in blocks:
+            return offset
+        while block_id in blocks:
+            block_id += 1
+        return max(
+            offset, min(block_id * BLOCK_SIZE, self.torrent.piece_size(piece_id))
+        )
@@ -0,0 +1,113 @@
+from collections import defaultdict
+from collections.abc import Hashable
+from time import time
+
+from lib.logger import Logging
+from lib.torrent.torrent_info import SetDeadlineFlags, TorrentInfo
+
+
+class DeadlineScheduler(Logging):
+    """Merges piece deadlines of everyone streaming one torrent handle.
+
+    Each owner keeps its own deadlines. libtorrent gets the earliest deadline
+    of a piece and loses it only when no owner wants the piece anymore.
+    """
+
+    def __init__(self, torrent: TorrentInfo) -> None:
+        self.torrent: TorrentInfo = torrent
+        # piece -> owner -> (due timestamp, flags)
+        self.wants: defaultdict[int, dict[Hashable, tuple[float, int]]] = defaultdict(
+            dict
+        )
+
+    def merged(self, piece_id: int) -> tuple[float, int] | None:
+        owners = self.wants.get(piece_id)
+        if not owners:
+            return None
+        due = min(due for due, _ in owners.values())
+        flags = 0
+        for _, owner_flags in owners.values():
+            flags |= owner_flags
+        return due, flags
+
+    def set_piece_deadline(
+        self,
+        owner: Hashable,
+        piece_id: int,
+        deadline_ms: int,
+        flags: int = 0,
+        now: float | None = None,
+    ):
+        now = time() if now is None else now
+        before = self.merged(piece_id)
+        self._want(owner, piece_id, deadline_ms, flags, now)
+        after = self.merged(piece_id)
+        assert after is not None
+        if (
+            before is None
+            or after[0] < before[0]
+            or after[1] != before[1]
+            # Asking for an alert is asking for a read, it must reach libtorrent
+            or flags & SetDeadlineFlags.ALERT_WHEN_AVAILABLE
+        ):
+            self._send(piece_id, now)
+
+    def rerequest(
+        self,
+        owner: Hashable,
+        piece_id: int,
+        deadline_ms: int,
+        flags: int = 0,
+        now: float | None = None,
+    ):
+        """Like set_piece_deadline, but libtorrent drops the piece's deadline
+        first, so its blocks are requested anew"""
+        now = time() if now is None else now
+        self._want(owner, piece_id, deadline_ms, flags, now)
+        self.torrent.reset_piece_deadline(piece_id)
+        self._send(piece_id, now)
+
+    def _want(
+        self, owner: Hashable, piece_id: int, deadline_ms: int, flags: int, now: float
+    ):
+        due = now + deadline_ms / 1000
+        current = self.wants[piece_id].get(owner)
+        if current is not None:
+            due = min(due, current[0])
+            flags |= current[1]
+        self.wants[piece_id][owner] = (due, flags)
+
+    def _send(self, piece_id: int, now: float):
+        merged = self.merged(piece_id)
+        assert merged is not None
+        due, flags = merged
+        self.torrent.set_piece_deadline(
+            piece_id, max(0, round((due - now) * 1000)), flags
+        )
+
+    def forget(self, owner: Hashable, piece_id: int) -> bool:
+        """Drops the owner's deadline without touching libtorrent.
+        Returns whether anyone else still wants the piece."""
+        owners = self.wants.get(piece_id)
+        if owners is None:
+            return False
+        _ = owners.pop(owner, None)
+        if not owners:
+            del self.wants[piece_id]
+            return False
+        return True
+
+    def reset_piece_deadline(self, owner: Hashable, piece_id: int):
+        if piece_id not in self.wants or owner not in self.wants[piece_id]:
+            return
+        if not self.forget(owner, piece_id):
+            self.torrent.reset_piece_deadline(piece_id)
+
+    def clear(self, owner: Hashable):
+        """Resets deadlines of the owner, pieces other owners want keep theirs"""
+        pieces = [
+            piece_id for piece_id, owners in self.wants.items() if owner in owners
+        ]
+        self.logger.debug(f"Clearing {len(pieces)} deadlines of {owner}")
+        for piece_id in pieces:
+            self.reset_piece_deadline(owner, piece_id)
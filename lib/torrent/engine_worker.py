@@ -0,0 +1,160 @@
+from multiprocessing import resource_tracker
+from multiprocessing.connection import Connection
+from multiprocessing.shared_memory import SharedMemory
+from time import monotonic
+from typing import Any
+
+import libtorrent as lt
+
+from lib.logger import create_logger
+from lib.torrent.alert_records import (
+    AlertRecord,
+    BlockFinishedRecord,
+    ErrorCode,
+    FileCompletedRecord,
+    HashFailedRecord,
+    PieceFinishedRecord,
+    ReadPieceRecord,
+    TorrentStatusRecord,
+)
+from lib.torrent.torrent_info import (
+    Alert,
+    BlockFinishedAlert,
+    FileCompletedAlert,
+    HashFailedAlert,
+    PieceFinishedAlert,
+    ReadPieceAlert,
+    TorrentInfo,
+)
+
+WORKER_POLL_S = 0.05
+# How often the state of every torrent is pushed to the web process
+WORKER_STATUS_S = 0.5
+
+# Requests are tuples of (kind, call_id, torrent_id, *arguments), replies are
+# (REPLY, call_id, ok, value), alerts are pushed as (ALERTS, torrent_id, records)
+# and the state of a torrent as (STATUS, torrent_id, record).
+ADD = "add"
+CALL = "call"
+REMOVE = "remove"
+STOP = "stop"
+REPLY = "reply"
+ALERTS = "alerts"
+STATUS = "status"
+
+logger = create_logger("TorrentEngineWorker")
+
+
+def share_piece(alert: Any) -> str | None:
+    """Copies piece data into a new shared memory block. The block is owned
+    by the web process from now on, so it's not tracked here."""
+    if alert.error.value() != 0 or alert.size <= 0 or alert.buffer is None:
+        return None
+    shm = SharedMemory(create=True, size=alert.size)
+    buf = shm.buf
+    assert buf is not None
+    buf[: alert.size] = alert.buffer
+    resource_tracker.unregister(shm._name, "shared_memory")  # pyright: ignore[reportAttributeAccessIssue]
+    shm.close()
+    return shm.name
+
+
+def record_alert(alert: Alert) -> AlertRecord | None:
+    if isinstance(alert, ReadPieceAlert):
+        return ReadPieceRecord(
+            alert.piece,
+            alert.size,
+            ErrorCode(alert.error.value()),
+            share_piece(alert),
+        )
+    if isinstance(alert, BlockFinishedAlert):
+        return BlockFinishedRecord(alert.piece_index, alert.block_index)
+    if isinstance(alert, PieceFinishedAlert):
+        return PieceFinishedRecord(alert.piece_index)
+    if isinstance(alert, HashFailedAlert):
+        return HashFailedRecord(alert.piece_index)
+    if isinstance(alert, FileCompletedAlert):
+        return FileCompletedRecord(alert.index)
+    return None
+
+
+def torrent_status(torrent: TorrentInfo) -> TorrentStatusRecord:
+    """Everything the web process asks about a torrent, in three queries"""
+    th = torrent.th
+    status = th.status(lt.torrent_handle.query_pieces)
+    downloading_peers: dict[int, set[str]] = {}
+    for peer in th.get_peer_info():
+        if peer.downloading_piece_index >= 0:
+            downloading_peers.setdefault(peer.downloading_piece_index, set()).add(
+                peer.ip[0]
+            )
+    return TorrentStatusRecord(
+        list(status.pieces),
+        list(th.get_piece_priorities()),
+        status.num_peers,
+        status.download_payload_rate,
+        downloading_peers,
+    )
+
+
+def handle_request(torrents: dict[int, TorrentInfo], request: tuple) -> Any:
+    kind, _, torrent_id, *args = request
+    if kind == ADD:
+        torrent_path, save_path = args
+        torrents[torrent_id] = TorrentInfo(torrent_path, save_path)
+        return None
+    if kind == REMOVE:
+        (delete_files,) = args
+        torrent = torrents.pop(torrent_id, None)
+        if torrent is not None:
+            torrent.cleanup(delete_files)
+        return None
+    if kind == CALL:
+        method, method_args = args
+        return getattr(torrents[torrent_id], method)(*method_args)
+    raise RuntimeError(f"Unknown request {kind}")
+
+
+def send_alerts(conn: Connection, torrents: dict[int, TorrentInfo]):
+    for torrent_id, torrent in torrents.items():
+        records = [
+            record
+            for record in map(record_alert, torrent.pop_alerts())
+            if record is not None
+        ]
+        if records:
+            conn.send((ALERTS, torrent_id, records))
+
+
+def send_statuses(conn: Connection, torrents: dict[int, TorrentInfo]):
+    for torrent_id, torrent in torrents.items():
+        conn.send((STATUS, torrent_id, torrent_status(torrent)))
+
+
+def run_worker(conn: Connection):
+    """Owns libtorrent sessions of all torrents of the web process"""
+    torrents: dict[int, TorrentInfo] = {}
+    logger.info("Torrent engine worker started")
+    status_sent = 0.0
+    while True:
+        if conn.poll(WORKER_POLL_S):
+            try:
+                request = conn.recv()
+            except EOFError:
+                logger.info("Web process is gone, stopping")
+                break
+            if request[0] == STOP:
+                break
+            call_id = request[1]
+            try:
+                conn.send((REPLY, call_id, True, handle_request(torrents, request)))
+            except Exception as exc:
+                logger.exception(f"Request {request[0]} {request[3:4]} failed")
+                conn.send((REPLY, call_id, False, f"{type(exc).__name__}: {exc}"))
+            if request[0] == ADD:
+                # Queries of a new torrent are answered from its first status
+                status_sent = 0.0
+        send_alerts(conn, torrents)
+        if monotonic() - status_sent >= WORKER_STATUS_S:
+            send_statuses(conn, torrents)
+            status_sent = monotonic()
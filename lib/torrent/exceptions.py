@@ -5,3 +5,6 @@ class PieceHaveTimeoutException(PieceTimeoutException): ...
 
 
 class PieceReadTimeoutException(PieceTimeoutException): ...
+
+
+class PieceHashFailedException(Exception): ...
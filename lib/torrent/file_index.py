@@ -0,0 +1,142 @@
+import re
+from collections import Counter, OrderedDict
+from collections.abc import Callable, Hashable, Iterable
+from dataclasses import dataclass
+from enum import Enum
+from pathlib import PurePosixPath
+
+import config
+
+VIDEO_EXTENSIONS = frozenset(
+    {
+        ".3gp", ".avi", ".flv", ".m2ts", ".m4v", ".mkv", ".mov", ".mp4",
+        ".mpeg", ".mpg", ".ogv", ".ts", ".webm", ".wmv",
+    }
+)  # fmt: skip
+SUBTITLE_EXTENSIONS = frozenset(
+    {".ass", ".idx", ".smi", ".srt", ".ssa", ".sub", ".sup", ".vtt"}
+)
+
+_DIGITS = re.compile(r"(\d+)")
+# Short clips season torrents ship next to the episodes
+_SAMPLE = re.compile(r"(?<![a-z])sample(?![a-z])")
+
+
+class MediaKind(str, Enum):
+    video = "video"
+    subtitle = "subtitle"
+    other = "other"
+
+
+def media_kind(name: str) -> MediaKind:
+    suffix = PurePosixPath(name).suffix.lower()
+    if suffix in VIDEO_EXTENSIONS:
+        return MediaKind.video
+    if suffix in SUBTITLE_EXTENSIONS:
+        return MediaKind.subtitle
+    return MediaKind.other
+
+
+def is_episode(name: str) -> bool:
+    """A video that is not a sample clip"""
+    return media_kind(name) == MediaKind.video and not _SAMPLE.search(name.casefold())
+
+
+def natural_key(name: str) -> tuple[str | int, ...]:
+    """Sort key putting episode 2 before episode 10, case is ignored"""
+    # Splitting by a group keeps text at even positions and numbers at odd ones
+    parts = _DIGITS.split(name.casefold())
+    return tuple(int(part) if i % 2 else part for i, part in enumerate(parts))
+
+
+def sort_files(files: Iterable[tuple[int, str]]) -> list[int]:
+    """File indexes of (file_index, name) pairs in the order rooms show them"""
+    ordered = sorted(files, key=lambda f: (natural_key(f[1]), f[1], f[0]))
+    return [file_index for file_index, _ in ordered]
+
+
+@dataclass(frozen=True)
+class IndexedFile:
+    index: int  # position in the sorted list, what rooms and video urls use
+    name: str
+    size: int
+    kind: MediaKind
+
+
+class FileIndex:
+    """Files of a room in display order, built once per torrent"""
+
+    PAGE_CACHE_SIZE: int = 32
+
+    def __init__(self, files: Iterable[IndexedFile]) -> None:
+        self.files: list[IndexedFile] = sorted(files, key=lambda f: f.index)
+        self.kinds: Counter[MediaKind] = Counter(f.kind for f in self.files)
+        self._pages: OrderedDict[Hashable, bytes] = OrderedDict()
+
+    @classmethod
+    def from_sorted(cls, files: Iterable[tuple[int, str, int]]) -> "FileIndex":
+        """Builds the index from (sorted_index, name, size) rows"""
+        return cls(
+            IndexedFile(index, name, size, media_kind(name))
+            for index, name, size in files
+        )
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def select(
+        self, kind: MediaKind | None = None, query: str | None = None
+    ) -> list[IndexedFile]:
+        if kind is None and not query:
+            return self.files
+        needle = (query or "").casefold()
+        return [
+            f
+            for f in self.files
+            if (kind is None or f.kind == kind) and needle in f.name.casefold()
+        ]
+
+    def page(
+        self,
+        offset: int,
+        limit: int,
+        kind: MediaKind | None = None,
+        query: str | None = None,
+    ) -> tuple[int, list[IndexedFile]]:
+        """Total count of matching files and the requested slice of them"""
+        selected = self.select(kind, query)
+        return len(selected), selected[offset : offset + limit]
+
+    def serialized(self, key: Hashable, serialize: Callable[[], bytes]) -> bytes:
+        """Memoizes a serialized response, keeping the latest few"""
+        body = self._pages.get(key)
+        if body is not None:
+            self._pages.move_to_end(key)
+            return body
+        body = self._pages[key] = serialize()
+        if len(self._pages) > self.PAGE_CACHE_SIZE:
+            _ = self._pages.popitem(last=False)
+        return body
+
+
+class FileIndexStorage:
+    """Least recently used file indexes, by torrent file path. Torrent files
+    are named by infohash, so an index never goes stale."""
+
+    MAX_INDEXES: int = config.FILE_INDEX_CACHE_SIZE
+    indexes: OrderedDict[str, FileIndex] = OrderedDict()
+
+    @classmethod
+    def get(cls, torrent_path: str) -> FileIndex | None:
+        index = cls.indexes.get(torrent_path)
+        if index is not None:
+            cls.indexes.move_to_end(torrent_path)
+        return index
+
+    @classmethod
+    def put(cls, torrent_path: str, index: FileIndex) -> FileIndex:
+        cls.indexes[torrent_path] = index
+        cls.indexes.move_to_end(torrent_path)
+        while len(cls.indexes) > cls.MAX_INDEXES:
+            _ = cls.indexes.popitem(last=False)
+        return index
@@ -0,0 +1,59 @@
+from dataclasses import dataclass
+
+import libtorrent as lt
+
+from lib.torrent.file_index import sort_files
+
+
+@dataclass
+class ManifestFile:
+    file_index: int
+    sorted_index: int
+    name: str
+    path: str
+    size: int
+    offset: int
+
+
+@dataclass
+class TorrentManifest:
+    """Torrent metadata needed to list and address files, read from the
+    .torrent itself, so no session or handle is involved."""
+
+    infohash: str
+    name: str
+    piece_length: int
+    pieces_count: int
+    total_size: int
+    files: list[ManifestFile]
+
+    @classmethod
+    def parse(cls, torrent: bytes | str) -> "TorrentManifest":
+        ti = lt.torrent_info(torrent)
+        fs = ti.files()
+        order = sort_files((i, fs.file_name(i)) for i in range(ti.num_files()))
+        sorted_index = {file_index: i for i, file_index in enumerate(order)}
+        return cls(
+            infohash=str(ti.info_hashes().get_best()),
+            name=ti.name(),
+            piece_length=ti.piece_length(),
+            pieces_count=ti.num_pieces(),
+            total_size=ti.total_size(),
+            files=[
+                ManifestFile(
+                    file_index=i,
+                    sorted_index=sorted_index[i],
+                    name=fs.file_name(i),
+                    path=fs.file_path(i),
+                    size=fs.file_size(i),
+                    offset=fs.file_offset(i),
+                )
+                for i in range(ti.num_files())
+            ],
+        )
+
+    def sorted_files(self) -> list[tuple[int, str]]:
+        return [
+            (f.sorted_index, f.name)
+            for f in sorted(self.files, key=lambda f: f.sorted_index)
+        ]
@@ -0,0 +1,157 @@
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from dataclasses import dataclass
+from time import time
+
+import config
+
+# Piece bytes, a view when they stay in memory shared with the engine process
+PieceData = bytes | memoryview
+
+
+class PieceCache:
+    """Verified pieces kept in memory, evicted in least recently used order.
+    Counts lookups, so policies can be compared by hit rate."""
+
+    def __init__(self, capacity: int, clock: Callable[[], float] = time) -> None:
+        self.capacity: int = capacity
+        self.clock: Callable[[], float] = clock
+        self.pieces: OrderedDict[int, PieceData] = OrderedDict()
+        self.playheads: dict[Hashable, int] = {}
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def __contains__(self, piece_id: int) -> bool:
+        return piece_id in self.pieces
+
+    def __getitem__(self, piece_id: int) -> PieceData:
+        return self.pieces[piece_id]
+
+    def __len__(self) -> int:
+        return len(self.pieces)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, piece_id: int) -> PieceData | None:
+        """Looks the piece up on behalf of a reader, counting a hit or a miss"""
+        self.touch(piece_id)
+        buf = self.pieces.get(piece_id)
+        if buf is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return buf
+
+    def peek(self, piece_id: int) -> PieceData | None:
+        return self.pieces.get(piece_id)
+
+    def put(self, piece_id: int, buf: PieceData) -> None:
+        self.pieces[piece_id] = buf
+        self.pieces.move_to_end(piece_id)
+        while len(self.pieces) > self.capacity:
+            _ = self.pieces.pop(self.victim())
+
+    def touch(self, piece_id: int) -> None:
+        if piece_id in self.pieces:
+            self.pieces.move_to_end(piece_id)
+
+    def victim(self) -> int:
+        return next(iter(self.pieces))
+
+    def set_playhead(self, owner: Hashable, piece_id: int) -> None:
+        self.playheads[owner] = piece_id
+
+    def clear_playhead(self, owner: Hashable) -> None:
+        _ = self.playheads.pop(owner, None)
+
+
+@dataclass
+class PieceAccess:
+    frequency: float
+    at: float
+
+
+class PopularityPieceCache(PieceCache):
+    """Keeps pieces many viewers come back to: openings, chapter starts, the
+    container index, the part just behind each playhead where people rewind
+    and the part ahead of it, which viewers trailing someone read soon. A
+    piece's retention is its access count decayed with age, raised near a
+    playhead. Counts outlive eviction for a while, so a popular piece read
+    again is recognised."""
+
+    HALF_LIFE_S: float = 2 * 60
+    REWIND_PIECES: int = 8  # behind a playhead
+    AHEAD_PIECES: int = 128
+    PLAYHEAD_WEIGHT: float = 4
+    HISTORY_FACTOR: int = 8  # remembered pieces, in cache capacities
+
+    def __init__(self, capacity: int, clock: Callable[[], float] = time) -> None:
+        super().__init__(capacity, clock)
+        self.accesses: dict[int, PieceAccess] = {}
+
+    def frequency(self, piece_id: int, now: float) -> float:
+        access = self.accesses.get(piece_id)
+        if access is None:
+            return 0.0
+        return access.frequency * 0.5 ** ((now - access.at) / self.HALF_LIFE_S)
+
+    def closeness(self, piece_id: int) -> float:
+        """1 at a playhead, falling to 0 at the edges of its window"""
+        best = 0.0
+        for playhead in self.playheads.values():
+            distance = playhead - piece_id
+            window = self.REWIND_PIECES if distance >= 0 else self.AHEAD_PIECES
+            best = max(best, 1 - abs(distance) / (window + 1))
+        return best
+
+    def retention(self, piece_id: int, now: float) -> float:
+        return self.frequency(piece_id, now) * (
+            1 + self.PLAYHEAD_WEIGHT * self.closeness(piece_id)
+        )
+
+    def touch(self, piece_id: int) -> None:
+        super().touch(piece_id)
+        now = self.clock()
+        self.accesses[piece_id] = PieceAccess(self.frequency(piece_id, now) + 1, now)
+        if len(self.accesses) > self.HISTORY_FACTOR * self.capacity * 2:
+            self._forget_rare(now)
+
+    def put(self, piece_id: int, buf: PieceData) -> None:
+        if piece_id not in self.accesses:
+            # Read without a lookup, e.g. for another owner's deadline
+            self.accesses[piece_id] = PieceAccess(0, self.clock())
+        super().put(piece_id, buf)
+
+    def victim(self) -> int:
+        now = self.clock()
+        newest = next(reversed(self.pieces))
+        # Ties go to the least recently used, the newest piece is never
+        # evicted right away
+        return min(
+            (piece_id for piece_id in self.pieces if piece_id != newest),
+            key=lambda piece_id: (
+                self.retention(piece_id, now),
+                self.accesses[piece_id].at,
+            ),
+        )
+
+    def _forget_rare(self, now: float) -> None:
+        kept = sorted(
+            (p for p in self.accesses if p not in self.pieces),
+            key=lambda p: self.frequency(p, now),
+            reverse=True,
+        )[: self.HISTORY_FACTOR * self.capacity]
+        self.accesses = {p: self.accesses[p] for p in [*self.pieces, *kept]}
+
+
+piece_cache_policies: dict[str, type[PieceCache]] = {
+    "lru": PieceCache,
+    "popularity": PopularityPieceCache,
+}
+
+
+def create_piece_cache(capacity: int) -> PieceCache:
+    return piece_cache_policies[config.PIECE_CACHE_POLICY](capacity)
@@ -1,15 +1,18 @@
 from asyncio import sleep
-from collections import OrderedDict
+from collections.abc import Hashable
 from time import time
 
 import libtorrent as lt
 
 from lib.torrent.alert_observer import AlertObserver
+from lib.torrent.alert_records import ReadPieceRecord
+from lib.torrent.deadline_scheduler import DeadlineScheduler
 from lib.torrent.exceptions import (
     PieceHaveTimeoutException,
     PieceReadTimeoutException,
     PieceTimeoutException,
 )
+from lib.torrent.piece_cache import PieceCache, PieceData, create_piece_cache
 from lib.torrent.torrent_info import (
     Alert,
     ReadPieceAlert,
@@ -25,12 +28,19 @@ PIECE_CACHE_SIZE = 64
 
 
 class PieceGetter:
-    def __init__(self, torrent: TorrentInfo, alert_observer: AlertObserver) -> None:
+    def __init__(
+        self,
+        torrent: TorrentInfo,
+        alert_observer: AlertObserver,
+        scheduler: DeadlineScheduler | None = None,
+    ) -> None:
         self.piece_wait_count: dict[int, int] = {}
-        self.piece_buffer: dict[int, bytes] = {}
-        self.piece_cache: OrderedDict[int, bytes] = OrderedDict()
+        self.piece_required_at: dict[int, tuple[float, int]] = {}
+        self.piece_buffer: dict[int, PieceData] = {}
+        self.piece_cache: PieceCache = create_piece_cache(PIECE_CACHE_SIZE)
         self.torrent: TorrentInfo = torrent
         self.alert_observer: AlertObserver = alert_observer
+        self.scheduler: DeadlineScheduler = scheduler or DeadlineScheduler(torrent)
         self.alert_observer.add_alert_observer(
             lt.read_piece_alert, self.handle_read_piece_alert
         )
@@ -45,13 +55,13 @@ class PieceGetter:
             raise PieceHaveTimeoutException(f"No piece {piece_id} in {timeout_s}")
 
     def handle_read_piece_alert(self, alert: Alert) -> None:
-        if not isinstance(alert, ReadPieceAlert):
+        if not isinstance(alert, (ReadPieceAlert, ReadPieceRecord)):
             raise RuntimeError(
                 f"Alert is not a type of read_piece_alert! Actual type: {type(alert)}"
             )
         if alert.error.value() != 0 or alert.size <= 0 or alert.buffer is None:
             return
-        buf = bytes(alert.buffer)
+        buf = alert.buffer
         self._cache_piece(alert.piece, buf)
         if alert.piece in self.piece_wait_count:
             self.piece_buffer[alert.piece] = buf
@@ -59,29 +69,37 @@ class PieceGetter:
     def is_waiting_for_piece(self, piece_id: int) -> bool:
         return piece_id in self.piece_wait_count
 
+    def is_cached(self, piece_id: int) -> bool:
+        return piece_id in self.piece_cache
+
     def _has_piece(self, piece_id: int) -> bool:
         return piece_id in self.piece_buffer or piece_id in self.piece_cache
 
-    def _cache_piece(self, piece_id: int, buf: bytes) -> None:
-        self.piece_cache[piece_id] = buf
-        self.piece_cache.move_to_end(piece_id)
-        while len(self.piece_cache) > PIECE_CACHE_SIZE:
-            self.piece_cache.popitem(last=False)
+    def is_read(self, piece_id: int) -> bool:
+        return self._has_piece(piece_id)
 
-    async def wait_piece_read(self, piece_id: int, timeout_s: int = 60, retries: int = 2):
-        for attempt in range(retries + 1):
-            if self._has_piece(piece_id):
-                return
-            finish = time() + timeout_s
-            while time() < finish:
-                if self._has_piece(piece_id):
-                    return
-                await sleep(WAIT_PIECE_READ_SLEEP)
+    def _cache_piece(self, piece_id: int, buf: PieceData) -> None:
+        self.piece_cache.put(piece_id, buf)
+
+    def set_playhead(self, owner: Hashable, piece_id: int):
+        """Pieces around an owner's playhead are kept longer"""
+        self.piece_cache.set_playhead(owner, piece_id)
+
+    def clear_playhead(self, owner: Hashable):
+        self.piece_cache.clear_playhead(owner)
+
+    async def wait_piece_read(self, piece_id: int, timeout_s: int = 15):
+        """Lost read alerts are asked for again by the stall detector"""
+        finish = time() + timeout_s
+        while time() < finish:
             if self._has_piece(piece_id):
                 return
+            await sleep(WAIT_PIECE_READ_SLEEP)
+        if self._has_piece(piece_id):
+            return
         raise PieceReadTimeoutException(
             (
-                f"Can't read {piece_id} in {timeout_s} after {retries} retries!\n"
+                f"Can't read {piece_id} in {timeout_s}!\n"
                 f"Piece priority: {self.torrent.get_piece_priority(piece_id)}\n"
                 f"Have piece: {self.torrent.have_piece(piece_id)}"
             )
@@ -90,10 +108,16 @@ class PieceGetter:
     def require_piece(self, piece_id: int, in_s: int = 0):
         count = self.piece_wait_count.get(piece_id, 0)
         self.piece_wait_count[piece_id] = count + 1
-        if count == 0:
-            self.torrent.set_piece_deadline(
-                piece_id, in_s, SetDeadlineFlags.ALERT_WHEN_AVAILABLE
-            )
+        now = time()
+        if count > 0:
+            required_at, required_in = self.piece_required_at[piece_id]
+            # Someone else (maybe another room) needs it sooner
+            if now + in_s / 1000 >= required_at + required_in / 1000:
+                return
+        self.piece_required_at[piece_id] = (now, in_s)
+        self.scheduler.set_piece_deadline(
+            self, piece_id, in_s, SetDeadlineFlags.ALERT_WHEN_AVAILABLE, now
+        )
 
     def not_require_piece(self, piece_id: int):
         self.piece_wait_count[piece_id] = max(
@@ -101,18 +125,20 @@ class PieceGetter:
         )
         if self.piece_wait_count.get(piece_id, 0) <= 0:
             _ = self.piece_wait_count.pop(piece_id, None)
+            _ = self.piece_required_at.pop(piece_id, None)
             _ = self.piece_buffer.pop(piece_id, None)
+            _ = self.scheduler.forget(self, piece_id)
 
-    async def get_piece(self, piece_id: int) -> bytes:
+    async def get_piece(self, piece_id: int) -> PieceData:
         try:
-            if piece_id in self.piece_cache:
-                self.piece_cache.move_to_end(piece_id)
-                return self.piece_cache[piece_id]
+            cached = self.piece_cache.get(piece_id)
+            if cached is not None:
+                return cached
             await self.wait_piece_have(piece_id)
             await self.wait_piece_read(piece_id)
-            if piece_id in self.piece_cache:
-                self.piece_cache.move_to_end(piece_id)
-                return self.piece_cache[piece_id]
+            cached = self.piece_cache.peek(piece_id)
+            if cached is not None:
+                return cached
             return self.piece_buffer[piece_id]
         except PieceTimeoutException as exc:
             raise exc
@@ -0,0 +1,388 @@
+import multiprocessing as mp
+import pickle
+import queue
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Iterable
+from multiprocessing.connection import Connection
+from multiprocessing.process import BaseProcess
+from typing import Any, override
+
+import config
+from lib.logger import Logging
+from lib.torrent.alert_records import (
+    AlertRecord,
+    PieceFinishedRecord,
+    TorrentStatusRecord,
+)
+from lib.torrent.engine_worker import (
+    ADD,
+    ALERTS,
+    CALL,
+    REMOVE,
+    REPLY,
+    STATUS,
+    STOP,
+    run_worker,
+)
+from lib.torrent.torrent_info import Alert, PiecePriority, TorrentInfo, TorrentMetadata
+
+ENGINE_MODE_LOCAL = "local"
+ENGINE_MODE_PROCESS = "process"
+
+STOP_TIMEOUT_S = 5
+# An engine not answering a call for this long is considered hung
+CALL_TIMEOUT_S = 10
+
+# Pipe errors mean the engine process is gone, BrokenPipeError is an OSError
+EngineDownErrors = (EOFError, OSError)
+# Starting the worker pickles its arguments for the spawned process
+EngineStartErrors = (*EngineDownErrors, pickle.PickleError)
+
+
+class RemoteEngine(Logging):
+    """Runs libtorrent in a separate process. The event loop never touches
+    the pipe: calls are queued for a writer thread, and a reader thread
+    buffers alerts, keeps the latest status of every torrent for queries
+    and settles replies by call id. A call left unanswered for
+    CALL_TIMEOUT_S means the engine hung. When the engine dies or hangs
+    it's restarted and every torrent is added back with its priorities,
+    deadlines and limits."""
+
+    def __init__(self) -> None:
+        self.torrents: dict[int, "RemoteTorrentInfo"] = {}
+        self.inbox: defaultdict[int, list[AlertRecord]] = defaultdict(list)
+        self.statuses: dict[int, TorrentStatusRecord] = {}
+        # Unanswered calls by call id, with the time they were sent
+        self.pending: dict[int, tuple[float, str]] = {}
+        self.lock: threading.Lock = threading.Lock()
+        self.next_torrent_id: int = 0
+        self.next_call_id: int = 0
+        self.broken: bool = False
+        self.process: BaseProcess | None = None
+        self.conn: Connection | None = None
+        self.outbox: queue.SimpleQueue[tuple | None] = queue.SimpleQueue()
+        self.start()
+
+    def start(self):
+        ctx = mp.get_context("spawn")
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=run_worker, args=(child_conn,), daemon=True, name="torrent-engine"
+        )
+        self.process.start()
+        child_conn.close()
+        self.outbox = queue.SimpleQueue()
+        for target, args in (
+            (self._read_loop, (self.conn,)),
+            (self._write_loop, (self.conn, self.outbox)),
+        ):
+            threading.Thread(
+                target=target, args=args, daemon=True, name="torrent-engine-pipe"
+            ).start()
+        self.logger.info(f"Torrent engine started, pid {self.process.pid}")
+
+    def kill(self):
+        self.outbox.put(None)
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if self.process is not None and self.process.is_alive():
+            self.process.kill()
+            self.process.join(STOP_TIMEOUT_S)
+        with self.lock:
+            for records in self.inbox.values():
+                for record in records:
+                    record.release()
+            self.inbox.clear()
+            self.pending.clear()
+
+    def restart(self):
+        self.logger.error("Torrent engine is down, restarting")
+        self.kill()
+        self.start()
+        for torrent in self.torrents.values():
+            self._send(ADD, torrent.torrent_id, torrent.torrent_path, torrent.save_path)
+            for method, args in torrent.replay_calls():
+                self._send(CALL, torrent.torrent_id, method, args)
+        self.broken = False
+
+    def _hung_call(self) -> str | None:
+        with self.lock:
+            oldest = min(self.pending.values(), default=None)
+        if oldest is not None and time.monotonic() - oldest[0] > CALL_TIMEOUT_S:
+            return oldest[1]
+        return None
+
+    def ensure_running(self):
+        if self.process is None or not self.process.is_alive():
+            self.broken = True
+        elif (hung := self._hung_call()) is not None:
+            self.logger.error(
+                f"Torrent engine did not answer {hung} in {CALL_TIMEOUT_S}s"
+            )
+            self.broken = True
+        if self.broken:
+            self.restart()
+
+    def _write_loop(self, conn: Connection, outbox: "queue.SimpleQueue[tuple | None]"):
+        while (message := outbox.get()) is not None:
+            try:
+                conn.send(message)
+            except EngineDownErrors as exc:
+                self._lost(conn, exc)
+                return
+
+    def _read_loop(self, conn: Connection):
+        while True:
+            try:
+                message = conn.recv()
+            except EngineDownErrors as exc:
+                self._lost(conn, exc)
+                return
+            self._receive(message)
+
+    def _receive(self, message: tuple):
+        with self.lock:
+            if message[0] == ALERTS:
+                self._store_alerts(message)
+            elif message[0] == STATUS:
+                _, torrent_id, status = message
+                if torrent_id in self.torrents:
+                    self.statuses[torrent_id] = status
+            elif message[0] == REPLY:
+                _, call_id, ok, value = message
+                _, what = self.pending.pop(call_id, (0, "call"))
+                if not ok:
+                    self.logger.error(f"Torrent engine failed on {what}: {value}")
+
+    def _lost(self, conn: Connection, exc: BaseException):
+        # A pipe closed by kill() is not news
+        if conn is self.conn:
+            self.logger.error(f"Torrent engine pipe failed: {exc!r}")
+            self.broken = True
+
+    def _store_alerts(self, message: tuple):
+        _, torrent_id, records = message
+        torrent = self.torrents.get(torrent_id)
+        if torrent is None:
+            for record in records:
+                record.release()
+            return
+        for record in records:
+            if isinstance(record, PieceFinishedRecord):
+                torrent.finished.add(record.piece_index)
+        self.inbox[torrent_id].extend(records)
+
+    def _send(self, kind: str, torrent_id: int, *args: Any):
+        self.next_call_id += 1
+        call_id = self.next_call_id
+        with self.lock:
+            self.pending[call_id] = (time.monotonic(), f"{kind} {args[:1]}")
+        self.outbox.put((kind, call_id, torrent_id, *args))
+
+    def request(self, kind: str, torrent_id: int, *args: Any):
+        """Queues a request, replies only report failures"""
+        self.ensure_running()
+        self._send(kind, torrent_id, *args)
+
+    def call(self, torrent_id: int, method: str, *args: Any):
+        self.request(CALL, torrent_id, method, args)
+
+    def add(self, torrent: "RemoteTorrentInfo") -> int:
+        self.next_torrent_id += 1
+        torrent_id = self.next_torrent_id
+        self.torrents[torrent_id] = torrent
+        self.request(ADD, torrent_id, torrent.torrent_path, torrent.save_path)
+        return torrent_id
+
+    def remove(self, torrent_id: int, delete_files: bool = True):
+        with self.lock:
+            _ = self.torrents.pop(torrent_id, None)
+            _ = self.statuses.pop(torrent_id, None)
+            records = self.inbox.pop(torrent_id, [])
+        for record in records:
+            record.release()
+        self.request(REMOVE, torrent_id, delete_files)
+
+    def status(self, torrent_id: int) -> TorrentStatusRecord | None:
+        return self.statuses.get(torrent_id)
+
+    def pop_alerts(self, torrent_id: int) -> list[AlertRecord]:
+        try:
+            self.ensure_running()
+        except EngineStartErrors as exc:
+            self.logger.error(f"Torrent engine can't be restarted: {exc!r}")
+        with self.lock:
+            return self.inbox.pop(torrent_id, [])
+
+    def stop(self):
+        # Detached first, so the pipe closing behind the worker is not a failure
+        conn, self.conn = self.conn, None
+        if conn is not None and self.process is not None and self.process.is_alive():
+            self.outbox.put((STOP, 0, 0))
+            self.process.join(STOP_TIMEOUT_S)
+        if conn is not None:
+            conn.close()
+        self.kill()
+
+
+class RemoteTorrentInfo(TorrentInfo):
+    """TorrentInfo with the handle living in the engine process. Torrent
+    metadata is parsed locally and queries are answered from the last status
+    pushed by the engine, so only calls changing the handle cross the
+    process boundary."""
+
+    def __init__(self, engine: RemoteEngine, torrent_path: str, save_path: str):
+        TorrentMetadata.__init__(self, torrent_path)
+        self.engine: RemoteEngine = engine
+        self.torrent_path: str = torrent_path
+        self.save_path: str = save_path
+        self.blocked_ips: dict[str, float] = {}
+        # Replayed if the engine has to be restarted
+        self.priorities: dict[int, PiecePriority] = {}
+        self.deadlines: dict[int, tuple[int, int]] = {}
+        self.download_limit: int = 0
+        # Finished pieces seen in alerts since the last status
+        self.finished: set[int] = set()
+        self.torrent_id: int = engine.add(self)
+
+    def _call(self, method: str, *args: Any):
+        self.engine.call(self.torrent_id, method, *args)
+
+    def _status(self) -> TorrentStatusRecord | None:
+        return self.engine.status(self.torrent_id)
+
+    def _priority(
+        self, piece_id: int, status: TorrentStatusRecord | None
+    ) -> PiecePriority:
+        # A deadline raises the priority of a piece to the top in libtorrent
+        if piece_id in self.deadlines:
+            return PiecePriority.TOP
+        if piece_id in self.priorities:
+            return self.priorities[piece_id]
+        if status is None:
+            return PiecePriority.DEFAULT
+        return PiecePriority(status.priorities[piece_id])
+
+    def replay_calls(self) -> list[tuple[str, tuple]]:
+        calls: list[tuple[str, tuple]] = []
+        if self.priorities:
+            calls.append(("set_pieces_priority", (list(self.priorities.items()),)))
+        calls.extend(
+            ("set_piece_deadline", (piece_id, deadline, flags))
+            for piece_id, (deadline, flags) in self.deadlines.items()
+        )
+        if self.download_limit:
+            calls.append(("set_download_limit", (self.download_limit,)))
+        if self.blocked_ips:
+            calls.append(("set_ip_filter", (list(self.blocked_ips),)))
+        return calls
+
+    @override
+    def cleanup(self, delete_files: bool = True):
+        self.logger.debug(f"Removing remote torrent handle for {self.save_path}")
+        self.engine.remove(self.torrent_id, delete_files)
+
+    @override
+    def set_pieces_priority(self, pieces: Iterable[tuple[int, PiecePriority]]):
+        pieces = list(pieces)
+        self.priorities.update(pieces)
+        self._call("set_pieces_priority", pieces)
+
+    @override
+    def piece_priorities(self) -> list[PiecePriority]:
+        status = self._status()
+        return [
+            self._priority(piece_id, status) for piece_id in range(self.pieces_count())
+        ]
+
+    @override
+    def set_piece_deadline(self, piece_id: int, deadline_s: int, flags: int = 0):
+        self.deadlines[piece_id] = (deadline_s, flags)
+        self._call("set_piece_deadline", piece_id, deadline_s, flags)
+
+    @override
+    def reset_piece_deadline(self, piece_id: int):
+        _ = self.deadlines.pop(piece_id, None)
+        self._call("reset_piece_deadline", piece_id)
+
+    @override
+    def clear_deadlines(self):
+        self.deadlines.clear()
+        self._call("clear_deadlines")
+
+    @override
+    def pop_alerts(self) -> list[Alert]:
+        return self.engine.pop_alerts(self.torrent_id)  # pyright: ignore[reportReturnType]
+
+    @override
+    def read_piece(self, piece_id: int):
+        self._call("read_piece", piece_id)
+
+    @override
+    def get_piece_priority(self, piece_id: int) -> PiecePriority:
+        return self._priority(piece_id, self._status())
+
+    @override
+    def have_piece(self, piece_id: int) -> bool:
+        if piece_id in self.finished:
+            return True
+        status = self._status()
+        return status is not None and status.pieces[piece_id]
+
+    @override
+    def peers_count(self) -> int:
+        status = self._status()
+        return status.peers if status else 0
+
+    @override
+    def download_rate(self) -> int:
+        status = self._status()
+        return status.download_rate if status else 0
+
+    @override
+    def set_download_limit(self, bytes_per_s: int):
+        self.download_limit = bytes_per_s
+        self._call("set_download_limit", bytes_per_s)
+
+    @override
+    def have_pieces(self) -> list[bool]:
+        status = self._status()
+        have = list(status.pieces) if status else [False] * self.pieces_count()
+        for piece_id in list(self.finished):
+            have[piece_id] = True
+        return have
+
+    @override
+    def peers_downloading(self, piece_id: int) -> set[str]:
+        status = self._status()
+        return set(status.downloading_peers.get(piece_id, ())) if status else set()
+
+    @override
+    def set_ip_filter(self, ips: list[str]):
+        self._call("set_ip_filter", ips)
+
+
+_engine: RemoteEngine | None = None
+
+
+def get_engine() -> RemoteEngine:
+    global _engine
+    if _engine is None:
+        _engine = RemoteEngine()
+    return _engine
+
+
+def shutdown_engine():
+    global _engine
+    if _engine is not None:
+        _engine.stop()
+        _engine = None
+
+
+def create_torrent(torrent_path: str, save_path: str) -> TorrentInfo:
+    if config.TORRENT_ENGINE_MODE == ENGINE_MODE_PROCESS:
+        return RemoteTorrentInfo(get_engine(), torrent_path, save_path)
+    return TorrentInfo(torrent_path, save_path)
@@ -0,0 +1,149 @@
+from asyncio import sleep
+from dataclasses import dataclass
+from enum import Enum
+from time import time
+
+from lib.logger import Logging
+from lib.torrent.block_tracker import BlockTracker
+from lib.torrent.deadline_scheduler import DeadlineScheduler
+from lib.torrent.piece_getter import PieceGetter
+from lib.torrent.torrent_info import SetDeadlineFlags, TorrentInfo
+
+STALL_CHECK_SLEEP = 1
+STALL_PROGRESS_TIMEOUT_S = 5
+DEADLINE_GRACE_S = 2
+
+
+class StallLevel(int, Enum):
+    NONE = 0
+    TIGHTEN_DEADLINE = 1
+    REREQUEST = 2
+    DROP_PEERS = 3
+
+
+@dataclass
+class PieceProgress:
+    deadline_at: float
+    blocks: int
+    progress_at: float
+    level: StallLevel = StallLevel.NONE
+
+
+class StallDetector(Logging):
+    """Watches pieces with deadlines and escalates the ones that fall behind:
+    tighter deadline, then a fresh request, then dropping peers holding it
+    once. Its deadlines go through the scheduler as those of one more owner,
+    released once the piece is no longer needed. Pieces downloaded but
+    never read are read again."""
+
+    def __init__(
+        self,
+        torrent: TorrentInfo,
+        piece_getter: PieceGetter,
+        block_tracker: BlockTracker,
+        scheduler: DeadlineScheduler,
+    ) -> None:
+        self.torrent: TorrentInfo = torrent
+        self.piece_getter: PieceGetter = piece_getter
+        self.block_tracker: BlockTracker = block_tracker
+        self.scheduler: DeadlineScheduler = scheduler
+        self.pieces: dict[int, PieceProgress] = {}
+        # Downloaded pieces waiting for their data, with the time of the last read
+        self.reads: dict[int, float] = {}
+        self.watch: bool = True
+
+    @property
+    def at_risk(self) -> bool:
+        return any(p.level != StallLevel.NONE for p in self.pieces.values())
+
+    def _blocks_done(self, piece_id: int) -> int:
+        return len(self.block_tracker.finished_blocks.get(piece_id, ()))
+
+    def check(self, now: float | None = None):
+        now = time() if now is None else now
+        self.torrent.unblock_expired_peers(now)
+        required = self.piece_getter.piece_required_at
+        for piece_id in list(self.pieces):
+            if piece_id not in required or self.torrent.have_piece(piece_id):
+                _ = self.pieces.pop(piece_id)
+                self.scheduler.reset_piece_deadline(self, piece_id)
+        for piece_id in list(self.reads):
+            if piece_id not in required:
+                _ = self.reads.pop(piece_id)
+        for piece_id, (required_at, deadline_ms) in list(required.items()):
+            if self.torrent.have_piece(piece_id):
+                self.check_read(piece_id, now)
+                continue
+            blocks = self._blocks_done(piece_id)
+            progress = self.pieces.get(piece_id)
+            if progress is None:
+                self.pieces[piece_id] = PieceProgress(
+                    required_at + deadline_ms / 1000 + DEADLINE_GRACE_S, blocks, now
+                )
+                continue
+            if blocks > progress.blocks:
+                progress.blocks = blocks
+                progress.progress_at = now
+                continue
+            # Peers holding it were dropped already, the rest is up to libtorrent
+            if progress.level == StallLevel.DROP_PEERS:
+                continue
+            if (
+                now - progress.progress_at >= STALL_PROGRESS_TIMEOUT_S
+                or now >= progress.deadline_at
+            ):
+                self.escalate(piece_id, progress, now)
+
+    def check_read(self, piece_id: int, now: float):
+        if self.piece_getter.is_read(piece_id):
+            _ = self.reads.pop(piece_id, None)
+            return
+        read_at = self.reads.setdefault(piece_id, now)
+        if now - read_at >= STALL_PROGRESS_TIMEOUT_S:
+            self.logger.info(f"Piece {piece_id} was not read, reading it again")
+            self.torrent.read_piece(piece_id)
+            self.reads[piece_id] = now
+
+    def escalate(self, piece_id: int, progress: PieceProgress, now: float):
+        progress.level = StallLevel(
+            min(progress.level + 1, StallLevel.DROP_PEERS.value)
+        )
+        progress.progress_at = now
+        progress.deadline_at = now + STALL_PROGRESS_TIMEOUT_S
+        self.logger.info(
+            f"Piece {piece_id} stalled, escalating to {progress.level.name}"
+        )
+        match progress.level:
+            case StallLevel.TIGHTEN_DEADLINE:
+                self.scheduler.set_piece_deadline(
+                    self, piece_id, 0, SetDeadlineFlags.ALERT_WHEN_AVAILABLE, now
+                )
+            case StallLevel.REREQUEST:
+                self.scheduler.rerequest(
+                    self, piece_id, 0, SetDeadlineFlags.ALERT_WHEN_AVAILABLE, now
+                )
+            case StallLevel.DROP_PEERS:
+                self.drop_slow_peers(piece_id)
+                self.scheduler.rerequest(
+                    self, piece_id, 0, SetDeadlineFlags.ALERT_WHEN_AVAILABLE, now
+                )
+
+    def drop_slow_peers(self, piece_id: int):
+        slow = self.torrent.peers_downloading(piece_id)
+        # Never cut the torrent off from the whole swarm.
+        if not slow or len(slow) >= self.torrent.peers_count():
+            return
+        self.logger.info(f"Dropping peers {slow} stalling piece {piece_id}")
+        self.torrent.block_peers(slow)
+
+    async def watch_stalls(self):
+        while self.watch:
+            try:
+                self.check()
+            except Exception:
+                self.logger.exception("Error while checking stalled pieces")
+            await sleep(STALL_CHECK_SLEEP)
+
+    def cleanup(self):
+        self.watch = False
+        self.scheduler.clear(self)
@@ -1,25 +1,54 @@
 from asyncio import sleep
-from collections.abc import AsyncGenerator
+from collections.abc import AsyncGenerator, Iterable
+from contextlib import aclosing
+from dataclasses import dataclass
 import os
 from time import time
 
+import anyio
+
+import config
 from lib.logger import Logging
 from lib.torrent.alert_observer import AlertObserver
+from lib.torrent.block_tracker import BlockTracker
+from lib.torrent.deadline_scheduler import DeadlineScheduler
+from lib.torrent.exceptions import (
+    PieceHashFailedException,
+    PieceHaveTimeoutException,
+)
+from lib.torrent.piece_cache import PieceData
 from lib.torrent.piece_getter import PieceGetter
+from lib.torrent.stall_detector import StallDetector
 from lib.torrent.torrent_info import PiecePriority, TorrentInfo
+from lib.torrent.torrent_registry import SharedTorrent
 
 WAIT_FILE_READY_SLEEP = 0.1
 
 
+@dataclass
+class PieceChunk:
+    piece_id: int
+    data: PieceData
+    verified: bool
+
+
 class FileTorrentHandler(Logging):
     PIECE_PRELOAD: int = 50
+    PREFETCH_HEAD_BYTES: int = 16 * 1024 * 1024
+    PREFETCH_TAIL_BYTES: int = 4 * 1024 * 1024
+    BLOCK_WAIT_TIMEOUT_S: int = 60
 
-    def __init__(self, torrent: TorrentInfo, file_index: int) -> None:
-        self.torrent: TorrentInfo = torrent
-        self.dont_download_everything()
-        self.alert_observer: AlertObserver = AlertObserver(self.torrent)
+    def __init__(self, shared: SharedTorrent, file_index: int) -> None:
+        # Everything but the file selection and own deadlines is shared with
+        # other rooms streaming the same torrent
+        self.torrent: TorrentInfo = shared.torrent
+        self.alert_observer: AlertObserver = shared.alert_observer
+        self.piece_getter: PieceGetter = shared.piece_getter
+        self.block_tracker: BlockTracker = shared.block_tracker
+        self.stall_detector: StallDetector = shared.stall_detector
+        self.scheduler: DeadlineScheduler = shared.scheduler
+        self.completed_files: set[int] = shared.completed_files
         self.file_index: int = file_index
-        self.piece_getter: PieceGetter = PieceGetter(self.torrent, self.alert_observer)
         self.init_download()
 
     def init_download(self):
@@ -27,13 +56,17 @@ class FileTorrentHandler(Logging):
         piece_end, _ = self.torrent.piece_bytes_offset(
             self.file_index, self.torrent.file_size(self.file_index)
         )
-        self.torrent.set_piece_deadline(piece_start, 0)
-        self.torrent.set_piece_deadline(piece_end, 0)
+        self.scheduler.set_piece_deadline(self, piece_start, 0)
+        self.scheduler.set_piece_deadline(self, piece_end, 0)
 
     @property
     def file_path(self):
         return self.torrent.file_path(self.file_index)
 
+    @property
+    def file_completed(self) -> bool:
+        return self.file_index in self.completed_files
+
     async def wait_file_ready(self, timeout_s: int = 30) -> str:
         finish = time() + timeout_s
         while time() < finish and not os.path.exists(self.file_path):
@@ -48,24 +81,192 @@ class FileTorrentHandler(Logging):
             for file_id in range(self.torrent.files_count())
         ]
 
-    def dont_download_everything(self):
+    def available_bytes(self, byte_start: int, limit: int) -> int:
+        """Returns how many bytes from byte_start (up to limit) are downloaded
+        without gaps."""
+        byte_end = min(self.torrent.file_size(self.file_index), byte_start + limit)
+        if byte_start >= byte_end:
+            return 0
+        piece_id, offset = self.torrent.piece_bytes_offset(self.file_index, byte_start)
+        available = 0
+        while byte_start + available < byte_end and self.torrent.have_piece(piece_id):
+            available += self.torrent.piece_size(piece_id) - offset
+            offset = 0
+            piece_id += 1
+        return min(available, byte_end - byte_start)
+
+    def downloaded_ranges(self) -> list[tuple[int, int]]:
+        """Merged byte ranges of the current file that are fully downloaded"""
+        file_size = self.torrent.file_size(self.file_index)
+        if file_size == 0:
+            return []
+        file_offset = self.torrent.file_offset(self.file_index)
+        piece_length = self.torrent.piece_length()
+        piece_start, _ = self.torrent.piece_bytes_offset(self.file_index, 0)
+        piece_end, _ = self.torrent.piece_bytes_offset(self.file_index, file_size - 1)
+        have = self.torrent.have_pieces()
+        ranges: list[tuple[int, int]] = []
+        for piece_id in range(piece_start, piece_end + 1):
+            if not have[piece_id]:
+                continue
+            start = max(0, piece_id * piece_length - file_offset)
+            end = min(file_size, (piece_id + 1) * piece_length - file_offset)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return ranges
+
+    def prefetch_file(self, file_index: int):
+        """Downloads head and tail of a file (where containers keep their
+        index) at low priority, leaving pieces with deadlines untouched."""
+        file_size = self.torrent.file_size(file_index)
+        head = self.torrent.file_pieces(
+            file_index, 0, min(file_size, self.PREFETCH_HEAD_BYTES)
+        )
+        tail = self.torrent.file_pieces(
+            file_index, max(0, file_size - self.PREFETCH_TAIL_BYTES), file_size
+        )
+        self.logger.debug(f"Prefetching head and tail of file {file_index}")
+        _ = self.download_in_background(sorted(set(head) | set(tail)))
+
+    def download_in_background(self, pieces: Iterable[int]) -> list[int]:
+        """Sets low priority on pieces nobody asked for yet, leaving pieces with
+        deadlines untouched. Returns pieces that priority was changed for."""
+        have = self.torrent.have_pieces()
+        priorities = self.torrent.piece_priorities()
+        pieces = [
+            piece_id
+            for piece_id in pieces
+            if piece_id not in self.piece_getter.piece_required_at
+            and not have[piece_id]
+            and priorities[piece_id] == PiecePriority.DONT_DOWNLOAD
+        ]
+        if pieces:
+            self.torrent.set_pieces_priority(
+                (piece_id, PiecePriority.LOW) for piece_id in pieces
+            )
+        return pieces
+
+    def stop_background_download(self, pieces: Iterable[int]):
+        have = self.torrent.have_pieces()
+        priorities = self.torrent.piece_priorities()
         self.torrent.set_pieces_priority(
-            (piece_id, PiecePriority.DONT_DOWNLOAD)  # pyright: ignore[reportUndefinedVariable]
-            for piece_id in range(self.torrent.pieces_count())
+            (piece_id, PiecePriority.DONT_DOWNLOAD)
+            for piece_id in pieces
+            if piece_id not in self.piece_getter.piece_required_at
+            and not have[piece_id]
+            and priorities[piece_id] == PiecePriority.LOW
         )
 
+    def downloaded_of(self, pieces: Iterable[int]) -> tuple[int, int]:
+        """Downloaded and total bytes of the given pieces"""
+        have = self.torrent.have_pieces()
+        downloaded, total = 0, 0
+        for piece_id in pieces:
+            size = self.torrent.piece_size(piece_id)
+            total += size
+            if have[piece_id]:
+                downloaded += size
+        return downloaded, total
+
+    def prefetch_range(self, byte_start: int, byte_end: int):
+        """Puts deadlines on pieces of the current file range that nobody
+        requires yet, so they are already coming when the player asks."""
+        file_size = self.torrent.file_size(self.file_index)
+        byte_start = max(0, byte_start)
+        byte_end = min(file_size, byte_end)
+        if byte_start >= byte_end:
+            return
+        pieces = [
+            piece_id
+            for piece_id in self.torrent.file_pieces(
+                self.file_index, byte_start, byte_end
+            )
+            if piece_id not in self.piece_getter.piece_required_at
+            and not self.torrent.have_piece(piece_id)
+        ]
+        self.logger.debug(f"Prefetching {len(pieces)} pieces from {byte_start}")
+        for order, piece_id in enumerate(pieces):
+            self.scheduler.set_piece_deadline(self, piece_id, order * 10)
+
     def set_file_index(self, file_index: int):
         self.file_index = file_index
-        self.torrent.clear_deadlines()
+        self.scheduler.clear(self)
+        self.piece_getter.clear_playhead(self)
         self.init_download()
 
+    def set_playhead(self, byte: int):
+        piece_id, _ = self.torrent.piece_bytes_offset(self.file_index, byte)
+        self.piece_getter.set_playhead(self, piece_id)
+
     def cleanup(self):
-        self.torrent.cleanup()
-        self.alert_observer.cleanup()
+        self.scheduler.clear(self)
+        self.piece_getter.clear_playhead(self)
 
-    async def iter_pieces(
+    def piece_file_offset(self, piece_id: int, offset: int) -> int:
+        return (
+            piece_id * self.torrent.piece_length()
+            + offset
+            - self.torrent.file_offset(self.file_index)
+        )
+
+    async def read_from_disk(self, piece_id: int, start: int, end: int) -> bytes:
+        async with await anyio.open_file(self.file_path, mode="rb") as file:
+            _ = await file.seek(self.piece_file_offset(piece_id, start))
+            return await file.read(end - start)
+
+    async def _iter_piece_blocks(
+        self, piece_id: int, start: int, end: int
+    ) -> AsyncGenerator[PieceChunk]:
+        """Streams contiguous finished blocks of a piece as they land on disk.
+        Falls back to the whole verified piece as soon as it is available."""
+        pos = start
+        released = False
+        try:
+            finish = time() + self.BLOCK_WAIT_TIMEOUT_S
+            while pos < end:
+                if self.piece_getter.is_cached(piece_id) or self.torrent.have_piece(
+                    piece_id
+                ):
+                    released = True
+                    piece = await self.piece_getter.get_piece(piece_id)
+                    yield PieceChunk(piece_id, piece[pos:end], True)
+                    return
+                readable = min(self.block_tracker.readable_until(piece_id, pos), end)
+                if readable > pos:
+                    data = await self.read_from_disk(piece_id, pos, readable)
+                    if data:
+                        pos += len(data)
+                        finish = time() + self.BLOCK_WAIT_TIMEOUT_S
+                        yield PieceChunk(piece_id, data, False)
+                        continue
+                if time() >= finish:
+                    raise PieceHaveTimeoutException(
+                        f"No blocks of {piece_id} after {pos} in {self.BLOCK_WAIT_TIMEOUT_S}"
+                    )
+                await self.block_tracker.wait_change(piece_id, finish - time())
+        finally:
+            if not released:
+                self.piece_getter.not_require_piece(piece_id)
+
+    async def _iter_piece(
+        self, piece_id: int, start: int, end: int
+    ) -> AsyncGenerator[PieceChunk]:
+        if (
+            not config.SUB_PIECE_STREAMING
+            or self.piece_getter.is_cached(piece_id)
+            or self.torrent.have_piece(piece_id)
+        ):
+            piece = await self.piece_getter.get_piece(piece_id)
+            yield PieceChunk(piece_id, piece[start:end], True)
+            return
+        async for chunk in self._iter_piece_blocks(piece_id, start, end):
+            yield chunk
+
+    async def iter_chunks(
         self, byte_start: int, byte_end: int = -1
-    ) -> AsyncGenerator[bytes]:
+    ) -> AsyncGenerator[PieceChunk]:
         if byte_end == -1:
             byte_end = self.torrent.file_size(self.file_index)
 
@@ -85,24 +286,46 @@ class FileTorrentHandler(Logging):
             piece_end -= 1
             end_offset = self.torrent.piece_size(piece_end)
 
-        for piece_id in range(
-            piece_start, min(piece_start + self.PIECE_PRELOAD, piece_end + 1)
-        ):
+        last_required = min(piece_start + self.PIECE_PRELOAD, piece_end + 1) - 1
+        for piece_id in range(piece_start, last_required + 1):
             self.piece_getter.require_piece(piece_id, (piece_id - piece_start) * 10)
 
-        if piece_start == piece_end:
-            yield (await self.piece_getter.get_piece(piece_start))[
-                start_offset:end_offset
-            ]
-            return
-
-        yield (await self.piece_getter.get_piece(piece_start))[start_offset:]
+        # Pieces this stream sent before their hash check that failed it
+        failed: list[int] = []
+        current = piece_start
+        try:
+            for piece_id in range(piece_start, piece_end + 1):
+                current = piece_id
+                start = start_offset if piece_id == piece_start else 0
+                end = (
+                    end_offset
+                    if piece_id == piece_end
+                    else self.torrent.piece_size(piece_id)
+                )
+                async with aclosing(self._iter_piece(piece_id, start, end)) as chunks:
+                    async for chunk in chunks:
+                        if not chunk.verified:
+                            self.block_tracker.mark_served(piece_id, failed.append)
+                        yield chunk
+                        if failed:
+                            # The receiver got corrupt data, it must not
+                            # take the rest as a valid response
+                            raise PieceHashFailedException(
+                                f"Streamed piece {failed[0]} failed its hash check"
+                            )
+                if piece_start < piece_id and last_required < piece_end:
+                    last_required += 1
+                    self.piece_getter.require_piece(
+                        last_required, self.PIECE_PRELOAD * 10
+                    )
+        finally:
+            # Pieces required ahead are never reached when the response
+            # is cancelled, release them so they don't stay wanted forever.
+            for piece_id in range(current + 1, last_required + 1):
+                self.piece_getter.not_require_piece(piece_id)
 
-        for piece_id in range(piece_start + 1, piece_end):
-            yield await self.piece_getter.get_piece(piece_id)
-            self.piece_getter.require_piece(
-                piece_id + self.PIECE_PRELOAD - 1, self.PIECE_PRELOAD * 10
-            )
-
-        if piece_end != piece_start:
-            yield (await self.piece_getter.get_piece(piece_end))[:end_offset]
+    async def iter_pieces(
+        self, byte_start: int, byte_end: int = -1
+    ) -> AsyncGenerator[PieceData]:
+        async for chunk in self.iter_chunks(byte_start, byte_end):
+            yield chunk.data
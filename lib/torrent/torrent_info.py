@@ -1,18 +1,41 @@
 from collections.abc import Iterable
 from enum import Enum
 from pathlib import Path
+from time import time
 
 import libtorrent as lt
 
+import config
 from lib.logger import Logging
 
 Alert = lt.alert
 TorrentAlert = lt.torrent_alert
 ReadPieceAlert = lt.read_piece_alert
+BlockFinishedAlert = lt.block_finished_alert
+PieceFinishedAlert = lt.piece_finished_alert
+HashFailedAlert = lt.hash_failed_alert
+FileCompletedAlert = lt.file_completed_alert
+
+BLOCK_SIZE = 16 * 1024
+
+# Dropped peers may come back after a while, and only so many are kept out
+PEER_BAN_S = 300
+PEER_BAN_MAX = 64
 
 
 EXTENSIONS = ()
 
+ALERT_MASK = (
+    lt.alert.category_t.error_notification
+    | lt.alert.category_t.storage_notification
+    | lt.alert.category_t.status_notification
+    | lt.alert.category_t.piece_progress_notification
+    | lt.alert.category_t.file_progress_notification
+)
+# An alert for every block is only needed to stream blocks of unverified pieces
+if config.SUB_PIECE_STREAMING:
+    ALERT_MASK |= lt.alert.category_t.block_progress_notification
+
 DEFAULT_SESSION_ARGS = {
     "request_timeout": 10,
     "peer_timeout": 10,
@@ -25,6 +48,7 @@ DEFAULT_SESSION_ARGS = {
     "auto_sequential": False,
     "aio_threads": 1,
     "torrent_connect_boost": 100,
+    "alert_mask": ALERT_MASK,
 }
 
 
@@ -40,6 +64,7 @@ class PiecePriority(int, Enum):
     DEFAULT = 4
     HIGH = 5
     HIGHEST = 6
+    TOP = 7
 
 
 def create_torrent_session() -> lt.session:
@@ -49,19 +74,13 @@ def create_torrent_session() -> lt.session:
     return session
 
 
-class TorrentInfo(Logging):
-    def __init__(self, torrent_path: str, save_path: str):
-        self.session: lt.session = create_torrent_session()
+class TorrentMetadata:
+    """Parsed .torrent file, reading it needs no session or handle"""
+
+    def __init__(self, torrent_path: str):
         self.ti: lt.torrent_info = lt.torrent_info(torrent_path)
-        self.th: lt.torrent_handle = self.session.add_torrent(
-            {"ti": self.ti, "save_path": save_path}
-        )
-        self.save_path: str = save_path
         self.files: lt.file_storage = self.ti.files()
-
-    def cleanup(self):
-        self.logger.debug(f"Removing torrent handle for {self.save_path}")
-        self.session.remove_torrent(self.th, lt.session.delete_files)
+        self.infohash: str = str(self.ti.info_hashes().get_best())
 
     def piece_bytes_offset(self, file_id: int, bytes_offset: int) -> tuple[int, int]:
         pr = self.ti.map_file(file_id, bytes_offset, 0)
@@ -70,6 +89,51 @@ class TorrentInfo(Logging):
     def piece_size(self, piece_id: int) -> int:
         return self.ti.piece_size(piece_id)
 
+    def piece_length(self) -> int:
+        return self.ti.piece_length()
+
+    def file_offset(self, file_id: int) -> int:
+        return self.files.file_offset(file_id)
+
+    def pieces_count(self) -> int:
+        return self.ti.num_pieces()
+
+    def file_pieces(self, file_id: int, byte_start: int, byte_end: int) -> range:
+        """Pieces covering bytes [byte_start, byte_end) of the file"""
+        if byte_end <= byte_start:
+            return range(0)
+        piece_start, _ = self.piece_bytes_offset(file_id, byte_start)
+        piece_end, _ = self.piece_bytes_offset(file_id, byte_end - 1)
+        return range(piece_start, piece_end + 1)
+
+    def get_file_name(self, file_id: int) -> str:
+        return self.files.file_name(file_id)
+
+    def files_count(self) -> int:
+        return self.ti.num_files()
+
+    def file_size(self, file_ind: int) -> int:
+        return self.files.file_size(file_ind)
+
+
+class TorrentInfo(TorrentMetadata, Logging):
+    def __init__(self, torrent_path: str, save_path: str):
+        super().__init__(torrent_path)
+        self.session: lt.session = create_torrent_session()
+        self.th: lt.torrent_handle = self.session.add_torrent(
+            {"ti": self.ti, "save_path": save_path}
+        )
+        self.save_path: str = save_path
+        # Banned peers with the time their ban ends
+        self.blocked_ips: dict[str, float] = {}
+
+    def cleanup(self, delete_files: bool = True):
+        self.logger.debug(f"Removing torrent handle for {self.save_path}")
+        if delete_files:
+            self.session.remove_torrent(self.th, lt.session.delete_files)
+        else:
+            self.session.remove_torrent(self.th)
+
     def set_pieces_priority(self, pieces: Iterable[tuple[int, PiecePriority]]):
         self.th.prioritize_pieces(
             (piece_id, priority.value) for piece_id, priority in pieces
@@ -79,13 +143,14 @@ class TorrentInfo(Logging):
         self.logger.debug(f"Setting deadline for piece {piece_id} to {deadline_s}")
         self.th.set_piece_deadline(piece_id, deadline_s, flags)
 
+    def reset_piece_deadline(self, piece_id: int):
+        self.logger.debug(f"Resetting deadline for piece {piece_id}")
+        self.th.reset_piece_deadline(piece_id)
+
     def clear_deadlines(self):
         self.logger.debug(f"Clearing deadlines for {self.save_path}")
         self.th.clear_piece_deadlines()
 
-    def pieces_count(self) -> int:
-        return self.ti.num_pieces()
-
     def pop_alerts(self) -> list[Alert]:
         return self.session.pop_alerts()
 
@@ -95,17 +160,60 @@ class TorrentInfo(Logging):
     def get_piece_priority(self, piece_id: int) -> PiecePriority:
         return PiecePriority(self.th.piece_priority(piece_id))
 
+    def piece_priorities(self) -> list[PiecePriority]:
+        return [PiecePriority(p) for p in self.th.get_piece_priorities()]
+
     def have_piece(self, piece_id: int) -> bool:
         return self.th.have_piece(piece_id)
 
-    def get_file_name(self, file_id: int) -> str:
-        return self.files.file_name(file_id)
-
-    def files_count(self) -> int:
-        return self.ti.num_files()
+    def peers_count(self) -> int:
+        return self.th.status().num_peers
+
+    def download_rate(self) -> int:
+        return self.th.status().download_payload_rate
+
+    def set_download_limit(self, bytes_per_s: int):
+        """Zero removes the limit"""
+        self.logger.debug(f"Download limit for {self.save_path}: {bytes_per_s}")
+        self.th.set_download_limit(bytes_per_s or -1)
+
+    def have_pieces(self) -> list[bool]:
+        return list(self.th.status(lt.torrent_handle.query_pieces).pieces)
+
+    def peers_downloading(self, piece_id: int) -> set[str]:
+        return {
+            peer.ip[0]
+            for peer in self.th.get_peer_info()
+            if peer.downloading_piece_index == piece_id
+        }
+
+    def block_peers(self, ips: Iterable[str], now: float | None = None):
+        """Bans peers for PEER_BAN_S, new ones are ignored once PEER_BAN_MAX
+        are banned"""
+        now = time() if now is None else now
+        for ip in ips:
+            if ip in self.blocked_ips or len(self.blocked_ips) < PEER_BAN_MAX:
+                self.blocked_ips[ip] = now + PEER_BAN_S
+        self.logger.debug(
+            f"Blocking peers {list(self.blocked_ips)} for {self.save_path}"
+        )
+        self.set_ip_filter(list(self.blocked_ips))
+
+    def unblock_expired_peers(self, now: float | None = None):
+        now = time() if now is None else now
+        expired = [ip for ip, until in self.blocked_ips.items() if until <= now]
+        if not expired:
+            return
+        for ip in expired:
+            del self.blocked_ips[ip]
+        self.logger.debug(f"Unblocking peers {expired} for {self.save_path}")
+        self.set_ip_filter(list(self.blocked_ips))
+
+    def set_ip_filter(self, ips: list[str]):
+        ip_filter = lt.ip_filter()
+        for ip in ips:
+            ip_filter.add_rule(ip, ip, 1)
+        self.session.set_ip_filter(ip_filter)
 
     def file_path(self, file_id: int) -> str:
         return self.files.file_path(file_id, self.save_path)
-
-    def file_size(self, file_ind: int) -> int:
-        return self.files.file_size(file_ind)
@@ -0,0 +1,147 @@
+import asyncio
+from collections.abc import Hashable
+import os
+from pathlib import Path
+import shutil
+
+import libtorrent as lt
+
+import config
+from lib.logger import Logging
+from lib.torrent.alert_observer import AlertObserver
+from lib.torrent.alert_records import FileCompletedRecord
+from lib.torrent.block_tracker import BlockTracker
+from lib.torrent.deadline_scheduler import DeadlineScheduler
+from lib.torrent.piece_getter import PieceGetter
+from lib.torrent.remote_engine import create_torrent
+from lib.torrent.stall_detector import StallDetector
+from lib.torrent.torrent_info import (
+    Alert,
+    FileCompletedAlert,
+    PiecePriority,
+    TorrentInfo,
+)
+
+
+class SharedTorrent(Logging):
+    """One torrent handle with its payload directory, piece cache and
+    deadline scheduler, shared by every room streaming the torrent."""
+
+    def __init__(self, infohash: str, torrent: TorrentInfo) -> None:
+        self.infohash: str = infohash
+        self.torrent: TorrentInfo = torrent
+        self.dont_download_everything()
+        self.alert_observer: AlertObserver = AlertObserver(self.torrent)
+        self.scheduler: DeadlineScheduler = DeadlineScheduler(self.torrent)
+        self.piece_getter: PieceGetter = PieceGetter(
+            self.torrent, self.alert_observer, self.scheduler
+        )
+        self.block_tracker: BlockTracker = BlockTracker(
+            self.torrent, self.alert_observer
+        )
+        self.stall_detector: StallDetector = StallDetector(
+            self.torrent, self.piece_getter, self.block_tracker, self.scheduler
+        )
+        # Files with every piece downloaded and verified
+        self.completed_files: set[int] = set()
+        self.alert_observer.add_alert_observer(
+            lt.file_completed_alert, self.handle_file_completed_alert
+        )
+        self.owners: set[Hashable] = set()
+        self.download_limits: dict[Hashable, int] = {}
+        self._alert_task: asyncio.Task | None = None
+        self._stall_task: asyncio.Task | None = None
+
+    def dont_download_everything(self):
+        self.torrent.set_pieces_priority(
+            (piece_id, PiecePriority.DONT_DOWNLOAD)
+            for piece_id in range(self.torrent.pieces_count())
+        )
+
+    def handle_file_completed_alert(self, alert: Alert) -> None:
+        if not isinstance(alert, (FileCompletedAlert, FileCompletedRecord)):
+            raise RuntimeError(
+                f"Alert is not a type of file_completed_alert! Actual type: {type(alert)}"
+            )
+        self.logger.info(f"File {alert.index} of {self.infohash} completed")
+        self.completed_files.add(alert.index)
+
+    def start(self):
+        os.makedirs(self.torrent.save_path, exist_ok=True)
+        if self._alert_task is None:
+            self._alert_task = asyncio.create_task(self.alert_observer.observe_alerts())
+        if self._stall_task is None:
+            self._stall_task = asyncio.create_task(self.stall_detector.watch_stalls())
+
+    def set_download_limit(self, owner: Hashable, bytes_per_s: int):
+        """Zero removes the owner's limit. The handle is limited only when
+        every owner asks for a limit, the loosest one wins."""
+        if owner not in self.owners:
+            return
+        self.download_limits[owner] = bytes_per_s
+        self.apply_download_limit()
+
+    def apply_download_limit(self):
+        limits = [self.download_limits.get(owner, 0) for owner in self.owners]
+        limit = 0 if not limits or 0 in limits else max(limits)
+        self.torrent.set_download_limit(limit)
+
+    def cleanup(self, delete_files: bool = True):
+        cache = self.piece_getter.piece_cache
+        self.logger.info(
+            f"Piece cache of {self.infohash}: {cache.hit_rate:.1%} hit rate "
+            + f"over {cache.hits + cache.misses} lookups"
+        )
+        self.alert_observer.cleanup()
+        self.stall_detector.cleanup()
+        for task in (self._alert_task, self._stall_task):
+            if task is not None:
+                _ = task.cancel()
+        self._alert_task = None
+        self._stall_task = None
+        self.torrent.cleanup(delete_files)
+
+
+class TorrentRegistry:
+    """Torrents being streamed, keyed by infohash and reference counted by
+    their owners, so rooms watching the same torrent download it once."""
+
+    SAVE_PATH: Path = config.TORRENT_SAVE_PATH
+    torrents: dict[str, SharedTorrent] = {}
+
+    @classmethod
+    def acquire(cls, torrent_path: str, owner: Hashable) -> SharedTorrent:
+        infohash = str(lt.torrent_info(torrent_path).info_hashes().get_best())
+        shared = cls.torrents.get(infohash)
+        if shared is None:
+            save_path = cls.SAVE_PATH / infohash
+            os.makedirs(save_path, exist_ok=True)
+            shared = SharedTorrent(
+                infohash, create_torrent(torrent_path, str(save_path))
+            )
+            cls.torrents[infohash] = shared
+        shared.owners.add(owner)
+        shared.logger.debug(f"{infohash} is used by {len(shared.owners)} owners")
+        return shared
+
+    @classmethod
+    def release(cls, shared: SharedTorrent, owner: Hashable, delete_files: bool = True):
+        """The last owner decides whether downloaded files are kept"""
+        if owner not in shared.owners:
+            return
+        shared.owners.discard(owner)
+        _ = shared.download_limits.pop(owner, None)
+        if shared.owners:
+            shared.apply_download_limit()
+            return
+        if cls.torrents.get(shared.infohash) is shared:
+            del cls.torrents[shared.infohash]
+        shared.cleanup(delete_files)
+
+    @classmethod
+    def remove_payload(cls, infohash: str):
+        """Deletes downloaded files of a torrent whose engine is stopped,
+        files of a torrent someone still streams are kept"""
+        if infohash in cls.torrents:
+            return
+        shutil.rmtree(cls.SAVE_PATH / infohash, ignore_errors=True)
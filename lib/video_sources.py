@@ -1,42 +1,119 @@
 import abc
 import asyncio
-import os
-from pathlib import Path
+from pathlib import PurePosixPath
 from typing import override
-from uuid import UUID, uuid1
+from urllib.parse import unquote, urlsplit
+from uuid import uuid4
 
 from fastapi import Request, Response
 from fastapi.responses import RedirectResponse
 
 import config
-from lib.custom_responses import LoadingTorrentFileResponse
-from lib.torrent.torrent_info import TorrentInfo
-from models.room_model import RoomModel, VideoSourcesEnum
+from lib.containers.exceptions import ContainerParseException
+from lib.containers.hls import HlsPlaylist, HlsPlaylistStorage, build_hls_playlist
+from lib.containers.index_builder import build_seek_index
+from lib.containers.seek_index import ByteReader, SeekIndex
+from lib.custom_responses import (
+    CompletedFileResponse,
+    FileValidators,
+    LinkProxyResponse,
+    LoadingTorrentFileResponse,
+    file_validators,
+    needs_body,
+)
+from lib.http_exceptions import BadGateway, UnprocessableEntity
+from lib.link_proxy import LINK_MODE_PROXY, LinkProxy
+from lib.logger import Logging
+from lib.response_registry import ResponseRegistry, client_key
+from lib.send_pacer import SendPacer
+from lib.torrent.exceptions import PieceTimeoutException
+from lib.torrent.file_index import is_episode, sort_files
 from lib.torrent.torrent_handler import FileTorrentHandler
+from lib.torrent.torrent_info import TorrentInfo, TorrentMetadata
+from lib.torrent.torrent_registry import SharedTorrent, TorrentRegistry
+from models.room_model import RoomModel, VideoSourcesEnum
+from schemas.buffer_schemas import BufferStateSchema
 
 
-class VideoSource(abc.ABC):
+class VideoSource(abc.ABC, Logging):
+    DEFAULT_BITRATE: int = 1024 * 1024  # bytes per second, ~8 Mbit/s
     data_field: str
     enum: VideoSourcesEnum
 
     def __init__(self, data: str, file_index: int) -> None:
         super().__init__()
         self.file_index: int = file_index
+        self._hls_lock: asyncio.Lock = asyncio.Lock()
+        self.seek_index: SeekIndex | None = None
+        # File the default bitrate was last assumed for, logged once per file
+        self._assumed_bitrate_of: int | None = None
 
     @abc.abstractmethod
     def get_available_files(self) -> list[tuple[int, str]]: ...
 
+    def bitrate_of(self, file_size: int) -> int:
+        """Bytes per second of a file of file_size as long as the current
+        video. The duration comes from its container, until that is read
+        DEFAULT_BITRATE is assumed."""
+        if self.seek_index is not None:
+            bitrate = self.seek_index.bitrate(file_size)
+            if bitrate:
+                return bitrate
+        if self._assumed_bitrate_of != self.file_index:
+            self._assumed_bitrate_of = self.file_index
+            self.logger.info(
+                f"Duration of file {self.file_index} unknown,"
+                + f" assuming {self.DEFAULT_BITRATE} bytes/s"
+            )
+        return self.DEFAULT_BITRATE
+
     @abc.abstractmethod
     def set_file_index(self, fi: int) -> bool: ...
 
-    def start(self): ...
+    def start(self):
+        """Starts the video engine if it is idle"""
+
+    def stop(self):
+        """Returns the video engine to idle, start brings it back"""
+
+    @property
+    def busy(self) -> bool:
+        """Whether video responses are still being sent"""
+        return False
+
+    @property
+    def at_risk(self) -> bool:
+        """Whether playback is about to stall because of slow data"""
+        return False
+
+    def seconds_buffered(self, video_time: float) -> float | None:
+        """Seconds of video available ahead of video_time, None if unknown"""
+        return None
+
+    def buffer_state(self, video_time: float) -> BufferStateSchema | None:
+        return None
+
+    def prefetch_next(self, video_time: float): ...
+
+    def track_playhead(self, video_time: float):
+        """Called with the room's video time on every buffer check"""
+
+    def prefetch_at(self, video_time: float):
+        """Called when someone seeks, before the player asks for data"""
 
     @abc.abstractmethod
     def cancel_current_requests(self): ...
 
-    def cleanup(self):
+    def cleanup(self, delete_files: bool = True):
+        """delete_files=False keeps downloaded data for a room reloaded with
+        the same video"""
         self.cancel_current_requests()
 
+    def same_video(self, other: "VideoSource") -> bool:
+        return self.enum == other.enum and getattr(self, self.data_field) == getattr(
+            other, other.data_field
+        )
+
     @classmethod
     def from_model(cls, model: RoomModel) -> "VideoSource":
         cls = enum_to_source.get(model.video_source)
@@ -49,17 +126,59 @@ class VideoSource(abc.ABC):
         model.video_source_data = getattr(self, self.data_field)
         return model
 
+    def conditional_response(self, request: Request) -> Response | None:
+        """Response needing no video data (HEAD, 304), the engine stays idle"""
+        return None
+
     @abc.abstractmethod
-    async def get_video_response(self, request: Request) -> Response: ...
+    async def get_video_response(self, request: Request, user: str) -> Response: ...
+
+    async def hls_source(self) -> tuple[str, ByteReader, int] | None:
+        """Cache key, reader and size of the current file, None when the
+        server can't read the video"""
+        return None
+
+    def hls_scannable(self) -> bool:
+        """Whether the file may be read whole to find segment boundaries"""
+        return True
+
+    async def hls_playlist(self) -> HlsPlaylist:
+        source = await self.hls_source()
+        if source is None:
+            raise UnprocessableEntity("HLS is not available for this video")
+        key, read, size = source
+        scan = self.hls_scannable()
+        # An estimated playlist is replaced once the file can be scanned
+        key = f"{key}/{'scanned' if scan else 'estimated'}"
+        async with self._hls_lock:
+            playlist = HlsPlaylistStorage.get(key)
+            if playlist is not None:
+                return playlist
+            try:
+                playlist = await build_hls_playlist(read, size, scan)
+            except ContainerParseException as exc:
+                raise UnprocessableEntity(f"No HLS for this video: {exc}")
+            return HlsPlaylistStorage.put(key, playlist)
 
 
 class HttpLinkVideoSource(VideoSource):
+    """Viewers are redirected to the link, or in proxy mode served from a
+    range cache the server fills ahead of the room's playhead"""
+
     data_field: str = "link"
     enum: VideoSourcesEnum = VideoSourcesEnum.link
 
     def __init__(self, link: str, file_index: int) -> None:
         super().__init__(link, file_index)
         self.link: str = link
+        self.proxy: LinkProxy | None = None
+        self._proxy_lock: asyncio.Lock = asyncio.Lock()
+        self._index_task: asyncio.Task | None = None
+        self.responses: ResponseRegistry = ResponseRegistry()
+
+    @property
+    def proxied(self) -> bool:
+        return config.LINK_MODE == LINK_MODE_PROXY
 
     @override
     def get_available_files(self) -> list[tuple[int, str]]:
@@ -69,30 +188,121 @@ class HttpLinkVideoSource(VideoSource):
     def set_file_index(self, fi: int) -> bool:
         return False
 
+    async def open_proxy(self) -> LinkProxy:
+        async with self._proxy_lock:
+            if self.proxy is None:
+                self.proxy = await LinkProxy.open(
+                    self.link,
+                    config.LINK_CACHE_PATH / uuid4().hex,
+                    config.LINK_CACHE_MAX_BYTES,
+                )
+                self._index_task = asyncio.create_task(self.load_seek_index())
+            return self.proxy
+
+    async def load_seek_index(self):
+        if self.proxy is None:
+            return
+        try:
+            self.seek_index = await build_seek_index(self.proxy.read, self.proxy.size)
+        except (ContainerParseException, BadGateway) as exc:
+            self.logger.warning(f"No seek index for {self.link}: {exc}")
+
+    @property
+    def bitrate(self) -> int:
+        return self.bitrate_of(0 if self.proxy is None else self.proxy.size)
+
+    def byte_at(self, video_time: float) -> int:
+        if self.seek_index is not None and self.seek_index.points:
+            return self.seek_index.byte_at(video_time)
+        return max(0, int(video_time * self.bitrate))
+
     @override
-    def cancel_current_requests(self): ...
+    def track_playhead(self, video_time: float):
+        if self.proxy is not None:
+            self.proxy.set_playhead(self.byte_at(video_time))
+
+    @override
+    def prefetch_at(self, video_time: float):
+        self.track_playhead(video_time)
+
+    @property
+    @override
+    def busy(self) -> bool:
+        return self.responses.busy
+
+    @override
+    def cancel_current_requests(self):
+        self.responses.cancel_all()
+
+    @override
+    def cleanup(self, delete_files: bool = True):
+        self.cancel_current_requests()
+        if self._index_task is not None:
+            _ = self._index_task.cancel()
+            self._index_task = None
+        if self.proxy is not None:
+            self.proxy.close()
+            self.proxy = None
+
+    @property
+    def file_name(self) -> str:
+        return PurePosixPath(unquote(urlsplit(self.link).path)).name or "video"
+
+    def validators(self, proxy: LinkProxy) -> FileValidators:
+        return file_validators(f"{self.link} {proxy.info.etag}", 0, proxy.size)
+
+    @override
+    def conditional_response(self, request: Request) -> Response | None:
+        if self.proxy is None or needs_body(request, self.validators(self.proxy)):
+            return None
+        return LinkProxyResponse(
+            self.proxy, self.validators(self.proxy), request, self.file_name
+        )
+
+    @override
+    async def hls_source(self) -> tuple[str, ByteReader, int] | None:
+        if not self.proxied:
+            return None
+        proxy = await self.open_proxy()
+        return self.validators(proxy).etag, proxy.read, proxy.size
 
     @override
-    async def get_video_response(self, request: Request) -> RedirectResponse:
-        return RedirectResponse(self.link, 303)
+    async def get_video_response(self, request: Request, user: str) -> Response:
+        if not self.proxied:
+            return RedirectResponse(self.link, 303)
+        proxy = await self.open_proxy()
+        conditional = self.conditional_response(request)
+        if conditional is not None:
+            return conditional
+        r = LinkProxyResponse(proxy, self.validators(proxy), request, self.file_name)
+        self.responses.add(client_key(request), r)
+        return r
 
 
 class SortedToTorrentFileIndex:
-    def __init__(self, torrent: TorrentInfo) -> None:
-        files: list[tuple[int, str]] = [
-            (i, torrent.get_file_name(i)) for i in range(torrent.files_count())
+    def __init__(self, torrent: TorrentMetadata) -> None:
+        names = {i: torrent.get_file_name(i) for i in range(torrent.files_count())}
+        self.sorted: list[tuple[int, str]] = [
+            (i, names[i]) for i in sort_files(names.items())
+        ]
+        self.pairs: list[tuple[int, str]] = [
+            (i, filename) for i, (_, filename) in enumerate(self.sorted)
         ]
-        self.sorted: list[tuple[int, str]] = sorted(files, key=lambda x: x[1])
 
     def get_sorted(self) -> list[tuple[int, str]]:
-        return [(i, filename) for i, (_, filename) in enumerate(self.sorted)]
+        return self.pairs
 
     def sorted_to_original(self, ind: int) -> int:
         return self.sorted[ind][0]
 
 
 class TorrentVideoSource(VideoSource):
-    SAVE_PATH: Path = config.TORRENT_SAVE_PATH
+    """Torrent metadata is read on creation, the engine (handle, alerts and
+    piece downloads) is started only when video is needed and can go back
+    to idle while the room stays loaded."""
+
+    MAX_BUFFER_RANGES: int = 32
+    SEEK_PREFETCH_S: int = 10
     data_field: str = "torrent_path"
     enum: VideoSourcesEnum = VideoSourcesEnum.torrent
 
@@ -102,24 +312,24 @@ class TorrentVideoSource(VideoSource):
         file_index: int,
     ):
         super().__init__("", file_index)
-        self.folder_id: UUID = uuid1()
-        os.makedirs(self.save_path, exist_ok=True)
         self.torrent_path: str = torrent_path
-        self.torrent: TorrentInfo = TorrentInfo(self.torrent_path, self.save_path)
-        self.torrent_manager: FileTorrentHandler = FileTorrentHandler(
-            self.torrent, self.file_index
-        )
-        self.resps: list[LoadingTorrentFileResponse] = []
+        self.metadata: TorrentMetadata = TorrentMetadata(self.torrent_path)
+        self.shared: SharedTorrent | None = None
+        self.torrent: TorrentInfo | None = None
+        self.torrent_manager: FileTorrentHandler | None = None
+        self.responses: ResponseRegistry = ResponseRegistry()
         self.file_mapping: SortedToTorrentFileIndex = SortedToTorrentFileIndex(
-            self.torrent
+            self.metadata
         )
         self.file_index = -1
-        self._alert_task: asyncio.Task | None = None
+        self._index_task: asyncio.Task | None = None
+        self.prefetched: set[int] = set()
+        self.playhead_byte: int | None = None
         _ = self.set_file_index(file_index)
 
     @property
-    def save_path(self) -> str:
-        return str(self.SAVE_PATH / str(self.folder_id))
+    def torrent_file_index(self) -> int:
+        return self.file_mapping.sorted_to_original(self.file_index)
 
     @override
     def set_file_index(self, fi: int) -> bool:
@@ -127,39 +337,265 @@ class TorrentVideoSource(VideoSource):
         if fi == self.file_index:
             return False
         torrent_ind = self.file_mapping.sorted_to_original(fi)
-        self.torrent_manager.set_file_index(torrent_ind)
         self.file_index: int = fi
+        self.seek_index = None
+        self.playhead_byte = None
+        self.prefetched.clear()
+        if self.torrent_manager is not None:
+            self.torrent_manager.set_file_index(torrent_ind)
+        if self._index_task is not None:
+            _ = self._index_task.cancel()
+            self._index_task = asyncio.create_task(self.load_seek_index())
         return True
 
-    def cleanup(self):
-        self.torrent_manager.cleanup()
-        if self._alert_task is not None:
-            _ = self._alert_task.cancel()
-            self._alert_task = None
+    async def read_bytes(self, start: int, length: int) -> bytes:
+        if length <= 0:
+            return b""
+        handler = self.engine()
+        return b"".join(
+            [data async for data in handler.iter_pieces(start, start + length)]
+        )
+
+    async def load_seek_index(self):
+        try:
+            self.seek_index = await build_seek_index(self.read_bytes, self.file_size)
+        except (ContainerParseException, PieceTimeoutException) as exc:
+            self.logger.warning(f"No seek index for file {self.file_index}: {exc}")
+            return
+        self.logger.info(
+            f"Seek index for file {self.file_index}: "
+            + f"{len(self.seek_index.points)} points, {self.seek_index.duration:.0f}s"
+        )
+
+    def engine(self) -> FileTorrentHandler:
+        """Returns the torrent handler, starting the engine if it is idle"""
+        if self.torrent_manager is not None:
+            return self.torrent_manager
+        self.logger.info(f"Starting torrent engine for {self.torrent_path}")
+        self.shared = TorrentRegistry.acquire(self.torrent_path, self)
+        self.torrent = self.shared.torrent
+        self.torrent_manager = FileTorrentHandler(self.shared, self.torrent_file_index)
+        self.shared.start()
+        if self.seek_index is None and self._index_task is None:
+            self._index_task = asyncio.create_task(self.load_seek_index())
+        return self.torrent_manager
 
     @override
     def start(self):
-        os.makedirs(self.save_path, exist_ok=True)
-        if self._alert_task is None:
-            self._alert_task = asyncio.create_task(
-                self.torrent_manager.alert_observer.observe_alerts()
-            )
+        _ = self.engine()
+
+    @override
+    def stop(self):
+        self.release_engine(delete_files=False)
+
+    def release_engine(self, delete_files: bool):
+        if self.torrent_manager is None or self.shared is None:
+            return
+        self.logger.info(f"Stopping torrent engine for {self.torrent_path}")
+        self.cancel_current_requests()
+        if self._index_task is not None:
+            _ = self._index_task.cancel()
+            self._index_task = None
+        self.torrent_manager.cleanup()
+        TorrentRegistry.release(self.shared, self, delete_files)
+        # A restarted engine has none of the prefetches
+        self.prefetched.clear()
+        self.shared = None
+        self.torrent = None
+        self.torrent_manager = None
+
+    @override
+    def cleanup(self, delete_files: bool = True):
+        if self.torrent_manager is not None:
+            self.release_engine(delete_files)
+        elif delete_files:
+            # Stopped while idle, the files were kept for a restart
+            TorrentRegistry.remove_payload(self.metadata.infohash)
+
+    @property
+    @override
+    def busy(self) -> bool:
+        return self.responses.busy
+
+    @property
+    @override
+    def at_risk(self) -> bool:
+        if self.torrent_manager is None:
+            return False
+        return self.torrent_manager.stall_detector.at_risk
+
+    def set_download_limit(self, bytes_per_s: int):
+        if self.shared is not None:
+            self.shared.set_download_limit(self, bytes_per_s)
+
+    @property
+    def bitrate(self) -> int:
+        return self.bitrate_of(self.file_size)
+
+    @property
+    def file_size(self) -> int:
+        return self.metadata.file_size(self.torrent_file_index)
+
+    def byte_at(self, video_time: float) -> int:
+        if self.seek_index is not None and self.seek_index.points:
+            return min(self.file_size, self.seek_index.byte_at(video_time))
+        return min(self.file_size, max(0, int(video_time * self.bitrate)))
+
+    @override
+    def seconds_buffered(self, video_time: float) -> float | None:
+        if self.torrent_manager is None:
+            return None
+        byte = self.byte_at(video_time)
+        left = self.file_size - byte
+        available = self.torrent_manager.available_bytes(byte, left)
+        if available >= left:
+            return float("inf")
+        return available / self.bitrate
+
+    @override
+    def buffer_state(self, video_time: float) -> BufferStateSchema | None:
+        if self.torrent_manager is None or self.torrent is None:
+            return None
+        byte = self.byte_at(video_time)
+        ranges = [
+            (start, end)
+            for start, end in self.torrent_manager.downloaded_ranges()
+            if end > byte
+        ]
+        return BufferStateSchema(
+            file_size=self.file_size,
+            ranges=ranges[: self.MAX_BUFFER_RANGES],
+            download_rate=self.torrent.download_rate(),
+            peers=self.torrent.peers_count(),
+            at_risk=self.at_risk,
+        )
+
+    @override
+    def next_episode(self) -> int | None:
+        """Sorted index of the first episode after the current file,
+        subtitles, extras and samples in between are skipped"""
+        files = self.file_mapping.get_sorted()
+        for fi, name in files[self.file_index + 1 :]:
+            if is_episode(name):
+                return fi
+        return None
+
+    def prefetch_next(self, video_time: float):
+        if self.torrent_manager is None:
+            return
+        next_fi = self.next_episode()
+        if next_fi is None or next_fi in self.prefetched:
+            return
+        if self.byte_at(video_time) < self.file_size * config.NEXT_FILE_PREFETCH_AT:
+            return
+        self.prefetched.add(next_fi)
+        self.torrent_manager.prefetch_file(
+            self.file_mapping.sorted_to_original(next_fi)
+        )
+
+    def file_byte_at(self, fi: int, video_time: float) -> int:
+        """Like byte_at, but for any file. Other files have no seek index
+        loaded, their offset is estimated as if they were as long as the
+        current one."""
+        if fi == self.file_index:
+            return self.byte_at(video_time)
+        file_size = self.metadata.file_size(self.file_mapping.sorted_to_original(fi))
+        return min(file_size, max(0, int(video_time * self.bitrate_of(file_size))))
+
+    def file_span_pieces(self, fi: int, byte_start: int, byte_end: int | None) -> range:
+        torrent_ind = self.file_mapping.sorted_to_original(fi)
+        file_size = self.metadata.file_size(torrent_ind)
+        byte_end = file_size if byte_end is None else min(file_size, byte_end)
+        if byte_start >= byte_end:
+            return range(0)
+        return self.metadata.file_pieces(torrent_ind, byte_start, byte_end)
+
+    @override
+    def track_playhead(self, video_time: float):
+        if self.torrent_manager is None:
+            return
+        self.playhead_byte = self.byte_at(video_time)
+        self.torrent_manager.set_playhead(self.playhead_byte)
+
+    def pacing_rate(self, byte: int) -> float | None:
+        """A multiple of the bitrate, bytes the room is about to play are
+        not paced"""
+        if self.playhead_byte is not None:
+            free_end = self.playhead_byte + self.bitrate * config.PACING_FREE_AHEAD_S
+            if self.playhead_byte <= byte < free_end:
+                return None
+        return self.bitrate * config.PACING_BITRATE_MULTIPLE
+
+    def pacer(self) -> SendPacer | None:
+        if config.PACING_BITRATE_MULTIPLE <= 0:
+            return None
+        return SendPacer(self.pacing_rate, config.PACING_BURST_BYTES)
+
+    @override
+    def prefetch_at(self, video_time: float):
+        if self.torrent_manager is None:
+            return
+        byte = self.byte_at(video_time)
+        self.torrent_manager.prefetch_range(
+            byte, byte + self.bitrate * self.SEEK_PREFETCH_S
+        )
 
     @override
     def cancel_current_requests(self):
-        for r in self.resps:
-            r.cancel()
-        self.resps.clear()
+        self.responses.cancel_all()
 
     @override
     def get_available_files(self) -> list[tuple[int, str]]:
         return self.file_mapping.get_sorted()
 
+    @property
+    def validators(self) -> FileValidators:
+        return file_validators(
+            self.metadata.infohash, self.torrent_file_index, self.file_size
+        )
+
+    @property
+    def file_name(self) -> str:
+        return self.metadata.get_file_name(self.torrent_file_index)
+
+    @override
+    async def hls_source(self) -> tuple[str, ByteReader, int] | None:
+        return self.validators.etag, self.read_bytes, self.file_size
+
     @override
-    async def get_video_response(self, request: Request) -> LoadingTorrentFileResponse:
-        _ = await self.torrent_manager.wait_file_ready()
-        r = LoadingTorrentFileResponse(self.torrent_manager, request)
-        self.resps.append(r)
+    def hls_scannable(self) -> bool:
+        # Scanning a file still downloading would fetch all of it
+        return self.engine().file_completed
+
+    @override
+    def conditional_response(
+        self, request: Request
+    ) -> LoadingTorrentFileResponse | None:
+        if needs_body(request, self.validators):
+            return None
+        return LoadingTorrentFileResponse(
+            None, self.validators, request, self.file_name
+        )
+
+    @override
+    async def get_video_response(
+        self, request: Request, user: str
+    ) -> LoadingTorrentFileResponse:
+        conditional = self.conditional_response(request)
+        if conditional is not None:
+            return conditional
+        handler = self.engine()
+        if handler.file_completed:
+            r = CompletedFileResponse(
+                handler.file_path, self.validators, request, self.file_name
+            )
+        else:
+            _ = await handler.wait_file_ready()
+            r = LoadingTorrentFileResponse(
+                handler, self.validators, request, self.file_name
+            )
+        r.pacer = self.pacer()
+        self.responses.add(client_key(request), r)
         return r
 
 
@@ -6,17 +6,27 @@ from fastapi.middleware.cors import CORSMiddleware
 from config import ENV
 from exception_handlers import register_exception_handlers
 from lib.engine import create_users
+from lib.link_proxy import clear_link_cache, close_client
+from lib.prebuffer import PrebufferStorage
 from lib.room import RoomStorage, monitor_rooms
+from lib.torrent.remote_engine import shutdown_engine
 from routes.auth import auth_router
 from routes.rooms import rooms_router
+from services.torrent_store import TorrentStore
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await create_users()
+    clear_link_cache()
     monitor_rooms()
+    await TorrentStore.collect_garbage()
+    await PrebufferStorage.resume_jobs()
     yield
+    PrebufferStorage.stop_all()
     await RoomStorage.full_cleanup()
+    shutdown_engine()
+    await close_client()
 
 
 app = FastAPI(lifespan=lifespan)
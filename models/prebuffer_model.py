@@ -0,0 +1,117 @@
+from enum import Enum
+from time import time
+from uuid import UUID, uuid1
+
+from sqlalchemy import BigInteger, ForeignKey, String, Uuid, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Mapped, MappedAsDataclass, mapped_column
+
+from lib.http_exceptions import NotFound
+from models.base import BaseModel
+
+
+class PrebufferStatusEnum(str, Enum):
+    queued = "queued"
+    running = "running"
+    done = "done"
+    cancelled = "cancelled"
+    failed = "failed"
+
+
+UNFINISHED_STATUSES = (PrebufferStatusEnum.queued, PrebufferStatusEnum.running)
+
+
+class PrebufferJobModel(MappedAsDataclass, BaseModel):
+    __tablename__ = "prebuffer_jobs"
+
+    room_id: Mapped[UUID] = mapped_column(
+        Uuid, ForeignKey("rooms.room_id", ondelete="CASCADE"), index=True
+    )
+    file_index: Mapped[int]
+    byte_start: Mapped[int] = mapped_column(BigInteger)
+    byte_end: Mapped[int | None] = mapped_column(BigInteger)
+    status: Mapped[PrebufferStatusEnum] = mapped_column(
+        default=PrebufferStatusEnum.queued
+    )
+    downloaded: Mapped[int] = mapped_column(BigInteger, default=0)
+    total: Mapped[int] = mapped_column(BigInteger, default=0)
+    error: Mapped[str] = mapped_column(String(256), default="")
+    created_at: Mapped[float] = mapped_column(default_factory=time)
+    job_id: Mapped[UUID] = mapped_column(Uuid, primary_key=True, default_factory=uuid1)
+
+    @classmethod
+    async def get_job_id(
+        cls, session: AsyncSession, job_id: UUID
+    ) -> "PrebufferJobModel":
+        stmt = select(PrebufferJobModel).where(PrebufferJobModel.job_id == job_id)
+        result = (await session.execute(stmt)).first()
+        if not result:
+            raise NotFound("Pre-buffer job not found!")
+        return result[0]
+
+    @classmethod
+    async def get_room_jobs(
+        cls, session: AsyncSession, room_id: UUID
+    ) -> list["PrebufferJobModel"]:
+        stmt = (
+            select(PrebufferJobModel)
+            .where(PrebufferJobModel.room_id == room_id)
+            .order_by(PrebufferJobModel.created_at)
+        )
+        result = await session.execute(stmt)
+        return [m[0] for m in result.all()]
+
+    @classmethod
+    async def get_unfinished(cls, session: AsyncSession) -> list["PrebufferJobModel"]:
+        stmt = select(PrebufferJobModel).where(
+            PrebufferJobModel.status.in_(UNFINISHED_STATUSES)
+        )
+        result = await session.execute(stmt)
+        return [m[0] for m in result.all()]
+
+    @classmethod
+    async def update(
+        cls,
+        session: AsyncSession,
+        job_id: UUID,
+        status: PrebufferStatusEnum | None = None,
+        downloaded: int | None = None,
+        total: int | None = None,
+        error: str | None = None,
+    ):
+        values = {}
+        if status is not None:
+            values["status"] = status
+        if downloaded is not None:
+            values["downloaded"] = downloaded
+        if total is not None:
+            values["total"] = total
+        if error is not None:
+            values["error"] = error
+        stmt = (
+            update(PrebufferJobModel)
+            .where(PrebufferJobModel.job_id == job_id)
+            .values(**values)
+        )
+        _ = await session.execute(stmt)
+
+    @classmethod
+    async def create(
+        cls,
+        session: AsyncSession,
+        room_id: UUID,
+        file_index: int,
+        byte_start: int,
+        byte_end: int | None,
+        total: int,
+    ) -> "PrebufferJobModel":
+        job = PrebufferJobModel(
+            room_id=room_id,
+            file_index=file_index,
+            byte_start=byte_start,
+            byte_end=byte_end,
+            total=total,
+        )
+        session.add(job)
+        await session.flush()
+        return job
@@ -48,6 +48,16 @@ class RoomModel(MappedAsDataclass, BaseModel):
             raise NotFound("Room not found!")
         return result[0]
 
+    @classmethod
+    async def get_sources_data(
+        cls, session: AsyncSession, vs_enum: VideoSourcesEnum
+    ) -> set[str]:
+        stmt = select(RoomModel.video_source_data).where(
+            RoomModel.video_source == vs_enum
+        )
+        result = await session.execute(stmt)
+        return {m[0] for m in result.all()}
+
     @classmethod
     async def exists_with_name(cls, session: AsyncSession, name: str) -> bool:
         stmt = exists(RoomModel).where(RoomModel.name == name)
@@ -0,0 +1,119 @@
+from sqlalchemy import BigInteger, ForeignKey, String, delete, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Mapped, MappedAsDataclass, mapped_column
+
+from lib.torrent.manifest import ManifestFile, TorrentManifest
+from models.base import BaseModel
+
+
+class TorrentManifestModel(MappedAsDataclass, BaseModel):
+    __tablename__ = "torrent_manifests"
+
+    infohash: Mapped[str] = mapped_column(String(64), primary_key=True)
+    torrent_path: Mapped[str] = mapped_column(String(256), unique=True)
+    name: Mapped[str] = mapped_column(String(1024))
+    piece_length: Mapped[int]
+    pieces_count: Mapped[int]
+    total_size: Mapped[int] = mapped_column(BigInteger)
+
+    @classmethod
+    async def get_sorted_files(
+        cls, session: AsyncSession, torrent_path: str
+    ) -> list[tuple[int, str, int]]:
+        """(sorted_index, name, size) of the torrent's files"""
+        stmt = (
+            select(
+                TorrentManifestFileModel.sorted_index,
+                TorrentManifestFileModel.name,
+                TorrentManifestFileModel.size,
+            )
+            .join(
+                TorrentManifestModel,
+                TorrentManifestModel.infohash == TorrentManifestFileModel.infohash,
+            )
+            .where(TorrentManifestModel.torrent_path == torrent_path)
+            .order_by(TorrentManifestFileModel.sorted_index)
+        )
+        result = await session.execute(stmt)
+        return [(m[0], m[1], m[2]) for m in result.all()]
+
+    @classmethod
+    async def exists_with_infohash(cls, session: AsyncSession, infohash: str) -> bool:
+        return await session.get(TorrentManifestModel, infohash) is not None
+
+    @classmethod
+    async def create(
+        cls, session: AsyncSession, manifest: TorrentManifest, torrent_path: str
+    ) -> None:
+        """Stores the manifest once per infohash"""
+        if await cls.exists_with_infohash(session, manifest.infohash):
+            return
+        try:
+            # Another request may store the same torrent in the meantime
+            async with session.begin_nested():
+                session.add(
+                    TorrentManifestModel(
+                        infohash=manifest.infohash,
+                        torrent_path=torrent_path,
+                        name=manifest.name,
+                        piece_length=manifest.piece_length,
+                        pieces_count=manifest.pieces_count,
+                        total_size=manifest.total_size,
+                    )
+                )
+                session.add_all(
+                    TorrentManifestFileModel.from_manifest_file(manifest.infohash, f)
+                    for f in manifest.files
+                )
+        except IntegrityError:
+            pass
+
+    @classmethod
+    async def delete_paths(cls, session: AsyncSession, torrent_paths: list[str]):
+        stmt = select(TorrentManifestModel.infohash).where(
+            TorrentManifestModel.torrent_path.in_(torrent_paths)
+        )
+        infohashes = [m[0] for m in (await session.execute(stmt)).all()]
+        if not infohashes:
+            return
+        _ = await session.execute(
+            delete(TorrentManifestFileModel).where(
+                TorrentManifestFileModel.infohash.in_(infohashes)
+            )
+        )
+        _ = await session.execute(
+            delete(TorrentManifestModel).where(
+                TorrentManifestModel.infohash.in_(infohashes)
+            )
+        )
+
+
+class TorrentManifestFileModel(MappedAsDataclass, BaseModel):
+    __tablename__ = "torrent_manifest_files"
+
+    infohash: Mapped[str] = mapped_column(
+        String(64),
+        ForeignKey("torrent_manifests.infohash", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    file_index: Mapped[int] = mapped_column(primary_key=True)
+    sorted_index: Mapped[int]
+    name: Mapped[str] = mapped_column(String(1024))
+    path: Mapped[str] = mapped_column(String(4096))
+    size: Mapped[int] = mapped_column(BigInteger)
+    offset: Mapped[int] = mapped_column(BigInteger)
+
+    @classmethod
+    def from_manifest_file(
+        cls, infohash: str, f: ManifestFile
+    ) -> "TorrentManifestFileModel":
+        return TorrentManifestFileModel(
+            infohash=infohash,
+            file_index=f.file_index,
+            sorted_index=f.sorted_index,
+            name=f.name,
+            path=f.path,
+            size=f.size,
+            offset=f.offset,
+        )
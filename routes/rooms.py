@@ -8,6 +8,7 @@ from fastapi import (
     Depends,
     Form,
     Path,
+    Query,
     Request,
     Response,
     WebSocket,
@@ -15,15 +16,22 @@ from fastapi import (
 )
 from starlette import status
 
-from lib.auth import current_user
+from config import FILES_PAGE_MAX_LIMIT
+from lib.auth import current_user, sign_video_query, video_user
 from lib.connections import Connection
 from lib.engine import async_session_maker
 from lib.logger import create_logger
+from lib.prebuffer import PrebufferStorage
+from lib.response_registry import PLAYER_PARAM
 from lib.room import RoomStorage
+from lib.torrent.file_index import MediaKind
+from models.prebuffer_model import PrebufferJobModel
 from models.room_model import RoomModel
+from schemas.prebuffer_schemas import CreatePrebufferJobSchema, GetPrebufferJobSchema
 from schemas.room_schemas import (
     CreateRoomLinkSchema,
     CreateRoomTorrentSchema,
+    GetRoomFilesSchema,
     GetRoomSchema,
     GetRoomWatchingSchema,
     UpdateRoomLinkSchema,
@@ -31,11 +39,13 @@ from schemas.room_schemas import (
 )
 from schemas.user_schemas import GetUserSchema
 from services.room_service import RoomService
+from services.torrent_store import TorrentStore
 
 rooms_router = APIRouter(prefix="/rooms")
 logger = create_logger("rooms-ws")
 
 CurrentUserDep = Annotated[GetUserSchema, Depends(current_user)]
+VideoUserDep = Annotated[str, Depends(video_user)]
 
 
 @rooms_router.post("/link", status_code=status.HTTP_201_CREATED)
@@ -65,10 +75,11 @@ async def update_room_to_torrent(
     _: CurrentUserDep,
 ) -> GetRoomSchema:
     async with async_session_maker.begin() as session:
-        await RoomService.update_room(session, room_id, room_data)
+        released = await RoomService.update_room(session, room_id, room_data)
+    await TorrentStore.release(released)
     async with async_session_maker.begin() as session:
-        room = await RoomStorage.get_room(session, room_id)
-    return GetRoomSchema.model_validate(room, from_attributes=True)
+        room = await RoomModel.get_room_id(session, room_id)
+        return GetRoomSchema.model_validate(room, from_attributes=True)
 
 
 @rooms_router.put("/{room_id}/link")
@@ -78,22 +89,50 @@ async def update_room_to_link(
     _: CurrentUserDep,
 ) -> GetRoomSchema:
     async with async_session_maker.begin() as session:
-        await RoomService.update_room(session, room_id, room_data)
+        released = await RoomService.update_room(session, room_id, room_data)
+    await TorrentStore.release(released)
     async with async_session_maker.begin() as session:
-        room = await RoomStorage.get_room(session, room_id)
-    return GetRoomSchema.model_validate(room, from_attributes=True)
+        room = await RoomModel.get_room_id(session, room_id)
+        return GetRoomSchema.model_validate(room, from_attributes=True)
 
 
-@rooms_router.get("/files/{room_id}/{fi}")
+@rooms_router.api_route("/files/{room_id}/{fi}", methods=["GET", "HEAD"])
 async def get_video_file(
     room_id: UUID,
     fi: Annotated[int, Path()],
     request: Request,
-    _: CurrentUserDep,
+    user: VideoUserDep,
+) -> Response:
+    async with async_session_maker.begin() as session:
+        room = await RoomStorage.get_room(session, room_id)
+    room.check_file(fi)
+    response = room.video_source.conditional_response(request)
+    if response is not None:
+        return response
+    room.start_video()
+    return await room.video_source.get_video_response(request, user)
+
+
+@rooms_router.get("/files/{room_id}/{fi}/playlist.m3u8")
+async def get_video_playlist(
+    room_id: UUID,
+    fi: Annotated[int, Path()],
+    user: VideoUserDep,
+    player: int | None = None,
 ) -> Response:
+    """HLS playlist of byte ranges of the video file, for fMP4 and MPEG-TS.
+    player is the websocket conn_id of the player, passed on to segments."""
     async with async_session_maker.begin() as session:
         room = await RoomStorage.get_room(session, room_id)
-    return await room.video_source.get_video_response(request)
+    room.check_file(fi)
+    room.start_video()
+    playlist = await room.video_source.hls_playlist()
+    # Relative to the playlist, so it points at /files/{room_id}/{fi}. Signed,
+    # players do not send tokens with segment requests.
+    uri = f"../{fi}?{sign_video_query(room_id, fi, user)}"
+    if player is not None:
+        uri += f"&{PLAYER_PARAM}={player}"
+    return Response(playlist.render(uri), media_type="application/vnd.apple.mpegurl")
 
 
 @rooms_router.delete("/{room_id}", status_code=status.HTTP_204_NO_CONTENT)
@@ -102,17 +141,82 @@ async def delete_room_end(
     _: CurrentUserDep,
 ) -> None:
     async with async_session_maker.begin() as session:
-        await RoomStorage.delete_room(session, room_id)
+        await PrebufferStorage.cancel_room_jobs(session, room_id)
+        released = await RoomService.delete_room(session, room_id)
+    await TorrentStore.release(released)
+
+
+@rooms_router.post("/{room_id}/prebuffer", status_code=status.HTTP_201_CREATED)
+async def start_prebuffer(
+    room_id: UUID,
+    job_data: Annotated[CreatePrebufferJobSchema, Form()],
+    _: CurrentUserDep,
+) -> GetPrebufferJobSchema:
+    async with async_session_maker.begin() as session:
+        job = await PrebufferStorage.create_job(session, room_id, job_data)
+    PrebufferStorage.start_job(job.job_id)
+    return GetPrebufferJobSchema.model_validate(job, from_attributes=True)
+
+
+@rooms_router.get("/{room_id}/prebuffer")
+async def list_prebuffer_jobs(
+    room_id: UUID,
+    _: CurrentUserDep,
+) -> list[GetPrebufferJobSchema]:
+    async with async_session_maker.begin() as session:
+        jobs = await PrebufferJobModel.get_room_jobs(session, room_id)
+        return [
+            GetPrebufferJobSchema.model_validate(job, from_attributes=True)
+            for job in jobs
+        ]
+
+
+@rooms_router.get("/{room_id}/prebuffer/{job_id}")
+async def get_prebuffer_job(
+    room_id: UUID,
+    job_id: UUID,
+    _: CurrentUserDep,
+) -> GetPrebufferJobSchema:
+    async with async_session_maker.begin() as session:
+        job = await PrebufferStorage.get_job(session, room_id, job_id)
+        return GetPrebufferJobSchema.model_validate(job, from_attributes=True)
+
+
+@rooms_router.delete("/{room_id}/prebuffer/{job_id}")
+async def cancel_prebuffer_job(
+    room_id: UUID,
+    job_id: UUID,
+    _: CurrentUserDep,
+) -> GetPrebufferJobSchema:
+    async with async_session_maker.begin() as session:
+        job = await PrebufferStorage.cancel_job(session, room_id, job_id)
+        return GetPrebufferJobSchema.model_validate(job, from_attributes=True)
+
+
+@rooms_router.get("/{room_id}/files", response_model=GetRoomFilesSchema)
+async def list_room_files(
+    room_id: UUID,
+    _: CurrentUserDep,
+    offset: Annotated[int, Query(ge=0)] = 0,
+    limit: Annotated[int, Query(ge=1, le=FILES_PAGE_MAX_LIMIT)] = 100,
+    kind: MediaKind | None = None,
+    q: Annotated[str | None, Query(max_length=255)] = None,
+) -> Response:
+    """Files of the room in display order, filtered by media kind and name"""
+    async with async_session_maker.begin() as session:
+        body = await RoomService.get_files_page(
+            session, room_id, offset, limit, kind, q or None
+        )
+    return Response(body, media_type="application/json")
 
 
 @rooms_router.get("/{room_id}")
 async def inside_room(
     room_id: UUID,
-    _: CurrentUserDep,
+    user: CurrentUserDep,
 ) -> GetRoomWatchingSchema:
     async with async_session_maker.begin() as session:
-        room = await RoomStorage.get_room(session, room_id)
-    return GetRoomWatchingSchema.model_validate(room, from_attributes=True)
+        return await RoomService.get_watching(session, room_id, user.name)
 
 
 @rooms_router.get("")
@@ -138,6 +242,7 @@ async def syncing(
 ) -> None:
     async with async_session_maker.begin() as session:
         room = await RoomStorage.get_room(session, room_id)
+    room.start_video()
     conn = Connection(websocket)
     room_user = await room.add_connection(conn, current_user)
     while True:
@@ -0,0 +1,9 @@
+from schemas.base_schema import BaseSchema
+
+
+class BufferStateSchema(BaseSchema):
+    file_size: int
+    ranges: list[tuple[int, int]]
+    download_rate: int
+    peers: int
+    at_risk: bool = False
@@ -0,0 +1,52 @@
+from typing import Annotated
+from uuid import UUID
+
+from pydantic import Field, computed_field, model_validator
+
+from lib.http_exceptions import UnprocessableEntity
+from models.prebuffer_model import PrebufferStatusEnum
+from schemas.base_schema import BaseSchema
+
+NonNegativeInt = Annotated[int, Field(ge=0)]
+NonNegativeFloat = Annotated[float, Field(ge=0)]
+
+
+class CreatePrebufferJobSchema(BaseSchema):
+    """Span is either in bytes or in seconds of video, a missing end means
+    the end of the file."""
+
+    file_index: NonNegativeInt
+    byte_start: NonNegativeInt | None = None
+    byte_end: NonNegativeInt | None = None
+    start_s: NonNegativeFloat | None = None
+    end_s: NonNegativeFloat | None = None
+
+    @model_validator(mode="after")
+    def validate_span(self):
+        by_bytes = self.byte_start is not None or self.byte_end is not None
+        by_time = self.start_s is not None or self.end_s is not None
+        if by_bytes and by_time:
+            raise UnprocessableEntity("Give either a byte or a time span, not both")
+        start, end = (
+            (self.start_s, self.end_s) if by_time else (self.byte_start, self.byte_end)
+        )
+        if start is not None and end is not None and start >= end:
+            raise UnprocessableEntity("Span end must be after its start")
+        return self
+
+
+class GetPrebufferJobSchema(BaseSchema):
+    job_id: UUID
+    room_id: UUID
+    file_index: int
+    byte_start: int
+    byte_end: int | None
+    status: PrebufferStatusEnum
+    downloaded: int
+    total: int
+    error: str
+
+    @computed_field
+    @property
+    def progress(self) -> float:
+        return self.downloaded / self.total if self.total else 0
@@ -10,6 +10,7 @@ from pydantic_core import core_schema
 
 from config import MAX_TORRENT_FILE_SIZE
 from lib.http_exceptions import ContentTooLarge, UnprocessableEntity
+from lib.torrent.file_index import MediaKind
 from schemas.base_schema import BaseSchema
 
 RoomNameField = Annotated[
@@ -19,6 +20,9 @@ RoomNameField = Annotated[
     ),
 ]
 LinkField = Annotated[str, StringConstraints(min_length=3, max_length=255)]
+VideoLinkField = Annotated[
+    str, StringConstraints(min_length=3, max_length=255, pattern=r"^https?://")
+]
 TorrentType = str | bytes
 
 
@@ -57,14 +61,14 @@ class CreateRoomSchema(BaseSchema, ABC):
 
 
 class CreateRoomLinkSchema(CreateRoomSchema):
-    video_link: LinkField
+    video_link: VideoLinkField
 
 
 class UpdateRoomSchema(CreateRoomSchema, ABC): ...
 
 
 class UpdateRoomLinkSchema(UpdateRoomSchema):
-    video_link: LinkField | None = None
+    video_link: VideoLinkField | None = None
 
 
 class WithTorrentFileSchema(BaseSchema):
@@ -96,6 +100,20 @@ class GetRoomSchema(CreateRoomSchema):
 
 
 class GetRoomWatchingSchema(GetRoomSchema):
-    files: list[tuple[int, str]]
+    files_count: int
     curr_fi: int
     video: str | None
+
+
+class GetRoomFileSchema(BaseSchema):
+    index: int
+    name: str
+    size: int
+    kind: MediaKind
+
+
+class GetRoomFilesSchema(BaseSchema):
+    total: int
+    offset: int
+    limit: int
+    files: list[GetRoomFileSchema]
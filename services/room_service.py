@@ -1,22 +1,26 @@
 from abc import ABC, abstractmethod
-import os
 from typing import override
-from uuid import UUID, uuid1
+from uuid import UUID
 from pathlib import Path
-import anyio
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from config import TORRENT_FILES_SAVE_PATH
-from lib.room import RoomStorage
+from lib.room import RoomStorage, signed_video_url
+from lib.torrent.file_index import FileIndex, FileIndexStorage, MediaKind
+from lib.torrent.manifest import TorrentManifest
 from models.room_model import RoomModel, VideoSourcesEnum
+from models.torrent_manifest_model import TorrentManifestModel
 from schemas.room_schemas import (
     CreateRoomLinkSchema,
     CreateRoomSchema,
     CreateRoomTorrentSchema,
+    GetRoomFileSchema,
+    GetRoomFilesSchema,
+    GetRoomWatchingSchema,
     UpdateRoomLinkSchema,
     UpdateRoomSchema,
     UpdateRoomTorrentSchema,
 )
+from services.torrent_store import TorrentStore
 
 
 class RoomCreator(ABC):
@@ -59,11 +63,11 @@ class TorrentRoomCreator(RoomCreator):
     update_cls: type[UpdateRoomSchema] = UpdateRoomTorrentSchema
 
     @classmethod
-    async def create_torrent_file(cls, content: bytes) -> Path:
-        os.makedirs(TORRENT_FILES_SAVE_PATH, exist_ok=True)
-        torrent_path = TORRENT_FILES_SAVE_PATH / str(uuid1())
-        async with await anyio.open_file(torrent_path, mode="wb") as file:
-            _ = await file.write(content)
+    async def create_torrent_file(cls, session: AsyncSession, content: bytes) -> Path:
+        torrent_path = await TorrentStore.store(content)
+        await TorrentManifestModel.create(
+            session, TorrentManifest.parse(content), torrent_path.as_posix()
+        )
         return torrent_path
 
     @classmethod
@@ -71,7 +75,7 @@ class TorrentRoomCreator(RoomCreator):
     async def create(cls, session: AsyncSession, data: CreateRoomSchema) -> RoomModel:
         if not isinstance(data, CreateRoomTorrentSchema):
             raise TypeError("Given data is not a create torrent schema!")
-        torrent_fpth = await cls.create_torrent_file(data.file_content)
+        torrent_fpth = await cls.create_torrent_file(session, data.file_content)
         r = await RoomModel.create(
             session,
             data.name,
@@ -89,7 +93,9 @@ class TorrentRoomCreator(RoomCreator):
             raise TypeError("Given data is not a create torrent schema!")
         torrent_path: str | None = None
         if data.torrent_file:
-            torrent_path = (await cls.create_torrent_file(data.file_content)).as_posix()
+            torrent_path = (
+                await cls.create_torrent_file(session, data.file_content)
+            ).as_posix()
         await RoomModel.update(
             session,
             room_id,
@@ -153,7 +159,105 @@ class RoomService:
     @classmethod
     async def update_room(
         cls, session: AsyncSession, room_id: UUID, room_data: UpdateRoomSchema
-    ):
+    ) -> str | None:
+        """Returns the torrent file the room doesn't use anymore, if any"""
+        old_room = await RoomModel.get_room_id(session, room_id)
+        old_source = old_room.video_source, old_room.video_source_data
+        # The update below bypasses the ORM, don't let it see a stale object
+        session.expunge(old_room)
         updator = RoomFactory.get_room_factory(room_data)
         await updator.update(session, room_id, room_data)
-        await RoomStorage.load_room(session, room_id, ignore_if_loaded=False)
+        if RoomStorage.is_room_loaded(room_id):
+            await RoomStorage.load_room(session, room_id, ignore_if_loaded=False)
+        new_room = await RoomModel.get_room_id(session, room_id)
+        if old_source[0] == VideoSourcesEnum.torrent and (
+            new_room.video_source_data != old_source[1]
+        ):
+            return old_source[1]
+        return None
+
+    @classmethod
+    async def delete_room(cls, session: AsyncSession, room_id: UUID) -> str | None:
+        """Returns the torrent file the deleted room used, if any"""
+        room = await RoomModel.get_room_id(session, room_id)
+        torrent_path = (
+            room.video_source_data
+            if room.video_source == VideoSourcesEnum.torrent
+            else None
+        )
+        await RoomStorage.delete_room(session, room_id)
+        return torrent_path
+
+    @classmethod
+    async def get_file_index(cls, session: AsyncSession, room: RoomModel) -> FileIndex:
+        if room.video_source != VideoSourcesEnum.torrent:
+            return FileIndex.from_sorted([(0, room.video_source_data, 0)])
+        torrent_path = room.video_source_data
+        index = FileIndexStorage.get(torrent_path)
+        if index is not None:
+            return index
+        files = await TorrentManifestModel.get_sorted_files(session, torrent_path)
+        if not files:
+            # Torrent stored without a manifest, parse the file once
+            manifest = TorrentManifest.parse(torrent_path)
+            await TorrentManifestModel.create(session, manifest, torrent_path)
+            files = [(f.sorted_index, f.name, f.size) for f in manifest.files]
+        return FileIndexStorage.put(torrent_path, FileIndex.from_sorted(files))
+
+    @classmethod
+    async def get_files_page(
+        cls,
+        session: AsyncSession,
+        room_id: UUID,
+        offset: int,
+        limit: int,
+        kind: MediaKind | None = None,
+        query: str | None = None,
+    ) -> bytes:
+        """Serialized GetRoomFilesSchema, cached with the torrent's file index"""
+        room = await RoomModel.get_room_id(session, room_id)
+        index = await cls.get_file_index(session, room)
+
+        def serialize() -> bytes:
+            total, files = index.page(offset, limit, kind, query)
+            return (
+                GetRoomFilesSchema(
+                    total=total,
+                    offset=offset,
+                    limit=limit,
+                    files=[
+                        GetRoomFileSchema(
+                            index=f.index, name=f.name, size=f.size, kind=f.kind
+                        )
+                        for f in files
+                    ],
+                )
+                .model_dump_json()
+                .encode()
+            )
+
+        return index.serialized((offset, limit, kind, query), serialize)
+
+    @classmethod
+    async def get_watching(
+        cls, session: AsyncSession, room_id: UUID, user: str
+    ) -> GetRoomWatchingSchema:
+        """Room details from the database, the room is not loaded for them.
+        The video URL is signed for user. Files are listed page by page by
+        get_files_page, the details only count them."""
+        room = await RoomModel.get_room_id(session, room_id)
+        index = await cls.get_file_index(session, room)
+        curr_fi = (
+            RoomStorage.loaded_rooms[room_id].curr_fi
+            if RoomStorage.is_room_loaded(room_id)
+            else room.last_file_ind
+        )
+        return GetRoomWatchingSchema(
+            room_id=room.room_id,
+            name=room.name,
+            img_link=room.img_link,
+            description=room.description,
+            files_count=len(index),
+            curr_fi=curr_fi,
+            video=signed_video_url(room.room_id, curr_fi, user),
+        )
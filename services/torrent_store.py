@@ -0,0 +1,97 @@
+import os
+import time
+from asyncio import Lock
+from pathlib import Path
+
+import anyio
+import libtorrent as lt
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import TORRENT_FILES_SAVE_PATH
+from lib.engine import async_session_maker
+from lib.logger import create_logger
+from models.room_model import RoomModel, VideoSourcesEnum
+from models.torrent_manifest_model import TorrentManifestModel
+
+# Blobs touched recently may belong to a room whose transaction is not
+# committed yet, garbage collection leaves them alone.
+GC_GRACE_S = 60 * 60
+
+logger = create_logger("TorrentStore")
+
+
+def infohash(content: bytes) -> str:
+    return str(lt.torrent_info(content).info_hashes().get_best())
+
+
+class TorrentStore:
+    """Torrent files stored by infohash. Rooms reference blobs by path in
+    video_source_data, so these references are the reference counts."""
+
+    lock: Lock = Lock()
+    save_path: Path = TORRENT_FILES_SAVE_PATH
+
+    @classmethod
+    def path_for(cls, content: bytes) -> Path:
+        return cls.save_path / infohash(content)
+
+    @classmethod
+    async def store(cls, content: bytes) -> Path:
+        torrent_path = cls.path_for(content)
+        async with cls.lock:
+            if torrent_path.exists():
+                # Known torrent, just protect it from a concurrent collection
+                os.utime(torrent_path)
+                return torrent_path
+            os.makedirs(cls.save_path, exist_ok=True)
+            tmp_path = torrent_path.with_suffix(".tmp")
+            async with await anyio.open_file(tmp_path, mode="wb") as file:
+                _ = await file.write(content)
+            os.replace(tmp_path, torrent_path)
+        return torrent_path
+
+    @classmethod
+    async def referenced(cls, session: AsyncSession) -> set[str]:
+        return await RoomModel.get_sources_data(session, VideoSourcesEnum.torrent)
+
+    @classmethod
+    def remove_unreferenced(
+        cls, referenced: set[str], paths: list[Path], now: float | None = None
+    ) -> list[Path]:
+        now = time.time() if now is None else now
+        removed: list[Path] = []
+        for path in paths:
+            if path.as_posix() in referenced or not path.is_file():
+                continue
+            if now - path.stat().st_mtime < GC_GRACE_S:
+                continue
+            path.unlink(missing_ok=True)
+            removed.append(path)
+        return removed
+
+    @classmethod
+    async def release(cls, torrent_path: str | None):
+        """Removes the blob if no room references it anymore. Call it after
+        the transaction that dropped the reference is committed."""
+        if torrent_path is None or Path(torrent_path).parent != cls.save_path:
+            return
+        async with cls.lock, async_session_maker.begin() as session:
+            referenced = await cls.referenced(session)
+            removed = cls.remove_unreferenced(referenced, [Path(torrent_path)])
+            await TorrentManifestModel.delete_paths(
+                session, [path.as_posix() for path in removed]
+            )
+        if removed:
+            logger.info(f"Removed unreferenced torrent {torrent_path}")
+
+    @classmethod
+    async def collect_garbage(cls):
+        if not cls.save_path.exists():
+            return
+        async with cls.lock, async_session_maker.begin() as session:
+            referenced = await cls.referenced(session)
+            removed = cls.remove_unreferenced(referenced, list(cls.save_path.iterdir()))
+            await TorrentManifestModel.delete_paths(
+                session, [path.as_posix() for path in removed]
+            )
+        logger.info(f"Removed {len(removed)} unreferenced torrents")
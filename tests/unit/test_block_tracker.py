@@ -0,0 +1,197 @@
+import asyncio
+from contextlib import aclosing
+from dataclasses import dataclass
+
+import pytest
+
+import config
+import lib.torrent.block_tracker as bt_module
+from lib.torrent.block_tracker import BlockTracker
+from lib.torrent.exceptions import PieceHashFailedException
+from lib.torrent.torrent_handler import FileTorrentHandler, PieceChunk
+from lib.torrent.torrent_info import BLOCK_SIZE
+
+PIECE_SIZE = 4 * BLOCK_SIZE
+
+
+@dataclass
+class FakeBlockFinishedAlert:
+    piece_index: int
+    block_index: int
+
+
+@dataclass
+class FakePieceFinishedAlert:
+    piece_index: int
+
+
+@dataclass
+class FakeHashFailedAlert:
+    piece_index: int
+
+
+class FakeTorrent:
+    def __init__(self) -> None:
+        self.have_pieces: set[int] = set()
+
+    def have_piece(self, piece_id: int) -> bool:
+        return piece_id in self.have_pieces
+
+    def piece_size(self, piece_id: int) -> int:
+        return PIECE_SIZE
+
+    def file_size(self, file_index: int) -> int:
+        return 2 * PIECE_SIZE
+
+    def piece_bytes_offset(self, file_index: int, byte: int) -> tuple[int, int]:
+        return divmod(byte, PIECE_SIZE)
+
+
+class FakeAlertObserver:
+    def __init__(self) -> None:
+        self.observers: dict = {}
+
+    def add_alert_observer(self, alert_type, observer) -> None:
+        self.observers[alert_type] = observer
+
+    def deliver(self, alert_type, alert) -> None:
+        self.observers[alert_type](alert)
+
+
+class FakePieceGetter:
+    def is_cached(self, piece_id: int) -> bool:
+        return False
+
+    async def get_piece(self, piece_id: int) -> bytes:
+        return b"v" * PIECE_SIZE
+
+    def require_piece(self, piece_id: int, deadline_ms: int):
+        pass
+
+    def not_require_piece(self, piece_id: int):
+        pass
+
+
+@pytest.fixture
+def setup(monkeypatch):
+    monkeypatch.setattr(bt_module, "BlockFinishedAlert", FakeBlockFinishedAlert)
+    monkeypatch.setattr(bt_module, "PieceFinishedAlert", FakePieceFinishedAlert)
+    monkeypatch.setattr(bt_module, "HashFailedAlert", FakeHashFailedAlert)
+    torrent = FakeTorrent()
+    observer = FakeAlertObserver()
+    tracker = BlockTracker(torrent, observer)
+    return torrent, observer, tracker
+
+
+def _finish_block(observer, piece_id, block_id):
+    observer.deliver(
+        bt_module.lt.block_finished_alert, FakeBlockFinishedAlert(piece_id, block_id)
+    )
+
+
+def test_nothing_readable_without_blocks(setup):
+    _, _, tracker = setup
+    assert tracker.readable_until(3, 0) == 0
+
+
+def test_contiguous_blocks_are_readable(setup):
+    _, observer, tracker = setup
+    for block_id in (0, 1, 3):
+        _finish_block(observer, 3, block_id)
+    assert tracker.readable_until(3, 0) == 2 * BLOCK_SIZE
+    assert tracker.readable_until(3, 100) == 2 * BLOCK_SIZE
+    assert tracker.readable_until(3, 2 * BLOCK_SIZE) == 2 * BLOCK_SIZE
+    assert tracker.readable_until(3, 3 * BLOCK_SIZE) == PIECE_SIZE
+
+
+def test_hash_failure_resets_blocks(setup):
+    _, observer, tracker = setup
+    _finish_block(observer, 3, 0)
+    failed: list[int] = []
+    tracker.mark_served(3, failed.append)
+    tracker.mark_served(3, failed.append)
+    assert 3 in tracker.served_unverified
+    observer.deliver(bt_module.lt.hash_failed_alert, FakeHashFailedAlert(3))
+    assert tracker.readable_until(3, 0) == 0
+    assert 3 not in tracker.served_unverified
+    # Streams that sent the piece learn about the failure once
+    assert failed == [3]
+
+
+def test_piece_finished_marks_verified(setup):
+    _, observer, tracker = setup
+    _finish_block(observer, 3, 0)
+    tracker.mark_served(3, lambda piece_id: None)
+    observer.deliver(bt_module.lt.piece_finished_alert, FakePieceFinishedAlert(3))
+    assert tracker.is_verified(3)
+    assert 3 not in tracker.served_unverified
+    assert 3 not in tracker.finished_blocks
+
+
+def test_unverified_blocks_are_served_only_when_enabled(setup, monkeypatch):
+    torrent, observer, tracker = setup
+    _finish_block(observer, 3, 0)
+    handler = FileTorrentHandler.__new__(FileTorrentHandler)
+    handler.torrent = torrent
+    handler.block_tracker = tracker
+    handler.piece_getter = FakePieceGetter()
+
+    async def read_from_disk(piece_id: int, start: int, end: int) -> bytes:
+        return b"u" * (end - start)
+
+    handler.read_from_disk = read_from_disk
+
+    def first_chunk() -> PieceChunk:
+        async def first():
+            chunks = handler._iter_piece(3, 0, PIECE_SIZE)  # pyright: ignore[reportPrivateUsage]
+            async with aclosing(chunks):
+                return await anext(chunks)
+
+        return asyncio.run(first())
+
+    chunk = first_chunk()
+    assert chunk.verified and len(chunk.data) == PIECE_SIZE
+    assert not tracker.served_unverified
+
+    monkeypatch.setattr(config, "SUB_PIECE_STREAMING", True)
+    chunk = first_chunk()
+    assert not chunk.verified and len(chunk.data) == BLOCK_SIZE
+
+
+def test_waiting_ends_on_finished_block(setup):
+    _, observer, tracker = setup
+
+    async def scenario():
+        waiting = asyncio.create_task(tracker.wait_change(3, 10))
+        await asyncio.sleep(0)
+        _finish_block(observer, 3, 0)
+        await asyncio.wait_for(waiting, 1)
+
+    asyncio.run(scenario())
+
+
+def test_stream_of_failed_piece_is_aborted(setup, monkeypatch):
+    monkeypatch.setattr(config, "SUB_PIECE_STREAMING", True)
+    torrent, observer, tracker = setup
+    for block_id in range(4):
+        _finish_block(observer, 0, block_id)
+    handler = FileTorrentHandler.__new__(FileTorrentHandler)
+    handler.torrent = torrent
+    handler.block_tracker = tracker
+    handler.piece_getter = FakePieceGetter()
+    handler.file_index = 0
+
+    async def read_from_disk(piece_id: int, start: int, end: int) -> bytes:
+        return b"u" * (end - start)
+
+    handler.read_from_disk = read_from_disk
+
+    async def scenario():
+        async with aclosing(handler.iter_chunks(0)) as chunks:
+            chunk = await anext(chunks)
+            assert not chunk.verified and len(chunk.data) == PIECE_SIZE
+            observer.deliver(bt_module.lt.hash_failed_alert, FakeHashFailedAlert(0))
+            with pytest.raises(PieceHashFailedException):
+                _ = await anext(chunks)
+
+    asyncio.run(scenario())
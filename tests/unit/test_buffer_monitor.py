@@ -0,0 +1,117 @@
+from pytest import mark
+
+from lib.buffer_monitor import (
+    BUFFER_STATE_MAX_INTERVAL_S,
+    BUFFER_STATE_MIN_INTERVAL_S,
+    LOW_BUFFER_S,
+    RESUME_BUFFER_S,
+    SERVER_SUSPENDER_ID,
+    BufferAction,
+    BufferMonitor,
+    BufferStateThrottle,
+)
+from lib.video_status.status_storage import StatusHandler
+from lib.video_status.video_statuses import PauseStatus, PlayStatus, SuspendStatus
+from schemas.buffer_schemas import BufferStateSchema
+
+
+def _apply(handler: StatusHandler, action: BufferAction | None):
+    if action == BufferAction.SUSPEND:
+        _ = handler.add_suspend_by(SERVER_SUSPENDER_ID)
+    elif action == BufferAction.RESUME:
+        _ = handler.remove_suspend_by(SERVER_SUSPENDER_ID)
+
+
+@mark.parametrize(
+    "buffered_s,expected",
+    [
+        (0, BufferAction.SUSPEND),
+        (LOW_BUFFER_S - 0.1, BufferAction.SUSPEND),
+        (LOW_BUFFER_S, None),
+        (None, None),
+        (float("inf"), None),
+    ],
+)
+def test_playing_room(buffered_s, expected):
+    assert BufferMonitor().decide(PlayStatus(10, 0), buffered_s) == expected
+
+
+def test_paused_room_is_never_suspended():
+    assert BufferMonitor().decide(PauseStatus(10, 0), 0) is None
+
+
+def test_hysteresis():
+    monitor = BufferMonitor()
+    handler = StatusHandler(PlayStatus(10, 0))
+
+    _apply(handler, monitor.decide(handler.status, 1))
+    assert isinstance(handler.status, SuspendStatus)
+
+    # Above the suspend threshold but below the resume one: keep waiting.
+    action = monitor.decide(handler.status, (LOW_BUFFER_S + RESUME_BUFFER_S) / 2)
+    assert action is None
+
+    _apply(handler, monitor.decide(handler.status, RESUME_BUFFER_S))
+    assert isinstance(handler.status, PlayStatus)
+
+
+def test_resume_waits_for_viewers():
+    monitor = BufferMonitor()
+    handler = StatusHandler(PlayStatus(10, 0)).add_suspend_by(0)
+    _apply(handler, monitor.decide(handler.status, 1))
+    _apply(handler, monitor.decide(handler.status, RESUME_BUFFER_S))
+    assert isinstance(handler.status, SuspendStatus)
+    assert handler.status.suspend_by == {0}
+
+
+def test_pause_while_suspended_releases_server():
+    monitor = BufferMonitor()
+    handler = StatusHandler(PlayStatus(10, 0))
+    _apply(handler, monitor.decide(handler.status, 1))
+    _ = handler.set_pause_status()
+    _apply(handler, monitor.decide(handler.status, 1))
+    assert isinstance(handler.status, PauseStatus)
+
+
+def _state(ranges=((0, 100),), rate=0, peers=1, at_risk=False) -> BufferStateSchema:
+    return BufferStateSchema(
+        file_size=10_000,
+        ranges=list(ranges),
+        download_rate=rate,
+        peers=peers,
+        at_risk=at_risk,
+    )
+
+
+def test_throttle_sends_first_state():
+    assert BufferStateThrottle().should_send(_state(), 0)
+
+
+def test_throttle_skips_same_state():
+    throttle = BufferStateThrottle()
+    throttle.mark_sent(_state(), 0)
+    assert not throttle.should_send(_state(), BUFFER_STATE_MIN_INTERVAL_S)
+    assert throttle.should_send(_state(), BUFFER_STATE_MAX_INTERVAL_S)
+
+
+def test_throttle_respects_min_interval():
+    throttle = BufferStateThrottle()
+    throttle.mark_sent(_state(), 0)
+    assert not throttle.should_send(_state(peers=5), BUFFER_STATE_MIN_INTERVAL_S / 2)
+    assert throttle.should_send(_state(peers=5), BUFFER_STATE_MIN_INTERVAL_S)
+
+
+@mark.parametrize(
+    "state,expected",
+    [
+        (_state(ranges=((0, 101),)), False),
+        (_state(ranges=((0, 300),)), True),
+        (_state(rate=1024), False),
+        (_state(rate=1024 * 1024), True),
+        (_state(at_risk=True), True),
+    ],
+)
+def test_throttle_meaningful_change(state, expected):
+    throttle = BufferStateThrottle()
+    throttle.mark_sent(_state(), 0)
+    assert throttle.changed(state) == expected
@@ -0,0 +1,172 @@
+import asyncio
+from dataclasses import dataclass
+from typing import override
+from uuid import uuid4
+
+import pytest
+from fastapi import WebSocketDisconnect
+
+import config
+from lib.commands.server_commands import (
+    FileChangeCommand,
+    PauseServerCommand,
+    PlayServerCommand,
+    ServerCommand,
+    UsersListCommand,
+)
+from lib.connections import Connection, ConnectionsManager
+from lib.room import Room
+from lib.video_sources import HttpLinkVideoSource
+from lib.video_status.status_storage import StatusHandler
+from schemas.buffer_schemas import BufferStateSchema
+from schemas.user_schemas import GetUserSchema
+
+
+class FakeWebSocket:
+    def __init__(self) -> None:
+        self.sent: list[str] = []
+        self.blocked: asyncio.Event = asyncio.Event()
+        self.blocked.set()
+
+    async def accept(self):
+        pass
+
+    async def receive_text(self) -> str:
+        await asyncio.Event().wait()
+        return ""
+
+    async def send_text(self, text: str):
+        await self.blocked.wait()
+        self.sent.append(text)
+
+
+@dataclass
+class CountingCommand(FileChangeCommand):
+    encoded: int = 0
+
+    @override
+    def to_string(self) -> str:
+        self.encoded += 1
+        return super().to_string()
+
+
+async def _room(size: int) -> tuple[ConnectionsManager, list[FakeWebSocket]]:
+    manager = ConnectionsManager()
+    sockets = [FakeWebSocket() for _ in range(size)]
+    for i, ws in enumerate(sockets):
+        _ = await manager.add_connection(
+            Connection(ws),  # pyright: ignore[reportArgumentType]
+            GetUserSchema(name=f"user{i}"),
+        )
+    return manager, sockets
+
+
+async def _flush():
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+def test_broadcast_is_encoded_once():
+    cmd = CountingCommand(3)
+
+    async def scenario():
+        manager, sockets = await _room(5)
+        manager.send_room(cmd, exclude=[1])
+        await _flush()
+        return sockets
+
+    sockets = asyncio.run(scenario())
+
+    assert cmd.encoded == 1
+    assert [ws.sent for ws in sockets] == [["cf 3"], [], ["cf 3"], ["cf 3"], ["cf 3"]]
+
+
+def test_users_list_frame_is_cached_until_membership_changes():
+    async def scenario():
+        manager, _ = await _room(3)
+        frame = manager.users_list_frame()
+        assert manager.users_list_frame() is frame
+        assert frame == UsersListCommand(manager.get_users()).to_string()
+        manager.remove_connection(0)
+        assert "user0" not in manager.users_list_frame()
+        _ = await manager.add_connection(
+            Connection(FakeWebSocket()),  # pyright: ignore[reportArgumentType]
+            GetUserSchema(name="late"),
+        )
+        assert "late" in manager.users_list_frame()
+
+    asyncio.run(scenario())
+
+
+def test_slow_client_does_not_hold_up_others(monkeypatch):
+    monkeypatch.setattr(config, "WS_OUTBOX_MAX_FRAMES", 4)
+
+    async def scenario():
+        manager, (slow, fast) = await _room(2)
+        slow.blocked.clear()
+        commands: list[ServerCommand] = [FileChangeCommand(1)]
+        commands += [PlayServerCommand(time) for time in range(10)]
+        commands.append(PauseServerCommand(10))
+        for cmd in commands:
+            manager.send_room(cmd)
+            await _flush()
+        assert fast.sent == [cmd.to_string() for cmd in commands]
+        slow.blocked.set()
+        await _flush()
+        return slow
+
+    slow = asyncio.run(scenario())
+
+    # The first frame was in flight, the queued status frames were coalesced
+    assert slow.sent == ["cf 1", "pl 8", "pl 9", "pa 10"]
+
+
+def test_client_too_far_behind_is_dropped(monkeypatch):
+    monkeypatch.setattr(config, "WS_OUTBOX_MAX_FRAMES", 3)
+
+    async def scenario():
+        manager, (slow, _) = await _room(2)
+        slow.blocked.clear()
+        for fi in range(5):
+            manager.send_room(FileChangeCommand(fi))
+        conn = manager.conns[0]
+        assert conn.dropped
+        with pytest.raises(WebSocketDisconnect):
+            _ = await conn.receive()
+
+    asyncio.run(scenario())
+
+
+class BufferedLinkSource(HttpLinkVideoSource):
+    @override
+    def buffer_state(self, video_time: float) -> BufferStateSchema | None:
+        return BufferStateSchema(
+            file_size=100, ranges=[(0, 50)], download_rate=0, peers=1, at_risk=False
+        )
+
+
+def test_joining_viewer_alone_gets_buffer_state():
+    room = Room(
+        uuid4(),
+        "room",
+        "",
+        StatusHandler(),
+        BufferedLinkSource("http://x.test/v", 0),
+        "",
+    )
+    sockets = [FakeWebSocket(), FakeWebSocket()]
+
+    async def scenario():
+        for i, ws in enumerate(sockets):
+            _ = await room.add_connection(
+                Connection(ws),  # pyright: ignore[reportArgumentType]
+                GetUserSchema(name=f"user{i}"),
+            )
+            await _flush()
+
+    asyncio.run(scenario())
+
+    buffer_frames = [
+        [text for text in ws.sent if text.startswith("bs ")] for ws in sockets
+    ]
+    assert [len(frames) for frames in buffer_frames] == [1, 1]
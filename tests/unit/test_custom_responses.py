@@ -0,0 +1,239 @@
+import asyncio
+
+import pytest
+from starlette.datastructures import Headers
+from starlette.requests import Request
+
+from lib.custom_responses import (
+    CompletedFileResponse,
+    LoadingTorrentFileResponse,
+    coalesce_ranges,
+    file_validators,
+    is_not_modified,
+    is_range_allowed,
+)
+
+DATA = bytes(range(256)) * 40
+PIECE = 1024
+
+
+class FakeTorrent:
+    def piece_bytes_offset(self, file_id: int, byte: int) -> tuple[int, int]:
+        return byte // PIECE, byte % PIECE
+
+
+class FakeHandler:
+    def __init__(self) -> None:
+        self.torrent: FakeTorrent = FakeTorrent()
+        self.file_index: int = 0
+        self.reads: list[tuple[int, int]] = []
+
+    async def iter_pieces(self, start: int, end: int):
+        self.reads.append((start, end))
+        while start < end:
+            piece_end = min(end, (start // PIECE + 1) * PIECE)
+            yield DATA[start:piece_end]
+            start = piece_end
+
+
+def _scope(method: str, headers: dict[str, str]) -> dict:
+    return {
+        "type": "http",
+        "method": method,
+        "path": "/",
+        "headers": [(k.encode(), v.encode()) for k, v in headers.items()],
+    }
+
+
+def _call(
+    handler: FakeHandler | str | None,
+    method: str = "GET",
+    extensions: dict | None = None,
+    **headers: str,
+):
+    headers = {k.replace("_", "-"): v for k, v in headers.items()}
+    scope = _scope(method, headers)
+    if extensions is not None:
+        scope["extensions"] = extensions
+    validators = file_validators("abc", 0, len(DATA))
+    if isinstance(handler, str):
+        response = CompletedFileResponse(
+            handler, validators, Request(scope), "video.mkv"
+        )
+    else:
+        response = LoadingTorrentFileResponse(
+            handler,  # pyright: ignore[reportArgumentType]
+            validators,
+            Request(scope),
+            "video.mkv",
+        )
+    messages: list[dict] = []
+
+    async def receive():
+        return {"type": "http.request"}
+
+    async def send(message: dict):
+        messages.append(message)
+
+    asyncio.run(response(scope, receive, send))
+    start = messages[0]
+    body = b"".join(m.get("body", b"") for m in messages[1:])
+    if messages[-1]["type"] == "http.response.pathsend":
+        body = messages[-1]["path"].encode()
+    return start["status"], Headers(raw=start["headers"]), body
+
+
+def test_validators_are_memoized_and_stable():
+    validators = file_validators("abc", 0, 10)
+
+    assert file_validators("abc", 0, 10) is validators
+    assert file_validators("abc", 1, 10).etag != validators.etag
+
+
+def test_conditional_headers():
+    v = file_validators("abc", 0, 10)
+
+    assert is_not_modified(Headers({"if-none-match": f'"x", W/{v.etag}'}), v)
+    assert is_not_modified(Headers({"if-none-match": "*"}), v)
+    assert not is_not_modified(Headers({"if-none-match": '"x"'}), v)
+    assert is_not_modified(Headers({"if-modified-since": v.last_modified}), v)
+    assert not is_not_modified(Headers({}), v)
+
+    assert is_range_allowed(Headers({}), v)
+    assert is_range_allowed(Headers({"if-range": v.etag}), v)
+    assert is_range_allowed(Headers({"if-range": v.last_modified}), v)
+    assert not is_range_allowed(Headers({"if-range": f"W/{v.etag}"}), v)
+    assert not is_range_allowed(Headers({"if-range": '"other"'}), v)
+
+
+def test_not_modified_without_handler():
+    etag = file_validators("abc", 0, len(DATA)).etag
+
+    status, headers, body = _call(None, if_none_match=etag)
+
+    assert status == 304
+    assert headers["etag"] == etag
+    assert body == b""
+
+
+def test_head_without_handler():
+    status, headers, body = _call(None, "HEAD", range="bytes=10-19")
+
+    assert status == 206
+    assert headers["content-range"] == f"bytes 10-19/{len(DATA)}"
+    assert headers["content-length"] == "10"
+    assert body == b""
+
+
+def test_if_range_mismatch_sends_whole_file():
+    handler = FakeHandler()
+
+    status, headers, body = _call(handler, range="bytes=10-19", if_range='"old"')
+
+    assert status == 200
+    assert headers["content-length"] == str(len(DATA))
+    assert body == DATA
+    assert handler.reads == [(0, len(DATA))]
+
+
+def test_if_range_match_sends_range():
+    handler = FakeHandler()
+    validators = file_validators("abc", 0, len(DATA))
+
+    status, _, body = _call(handler, range="bytes=10-19", if_range=validators.etag)
+
+    assert status == 206
+    assert body == DATA[10:20]
+
+
+def test_coalesce_ranges():
+    assert coalesce_ranges([(50, 60), (0, 10), (10, 20), (5, 8), (55, 70)]) == [
+        (0, 20),
+        (50, 70),
+    ]
+
+
+def test_overlapping_ranges_become_single_range():
+    handler = FakeHandler()
+
+    status, headers, body = _call(handler, range="bytes=100-199,150-299,300-309")
+
+    assert status == 206
+    assert headers["content-range"] == f"bytes 100-309/{len(DATA)}"
+    assert body == DATA[100:310]
+    assert handler.reads == [(100, 310)]
+
+
+def test_multipart_byteranges():
+    handler = FakeHandler()
+
+    status, headers, body = _call(
+        handler, range="bytes=3000-3009,10-19,100-109,-5"
+    )
+
+    assert status == 206
+    content_type, boundary = headers["content-type"].split("; boundary=")
+    assert content_type == "multipart/byteranges"
+    assert "content-range" not in headers
+    assert headers["content-length"] == str(len(body))
+    total = len(DATA)
+    expected = b"".join(
+        f"--{boundary}\r\nContent-Type: video/x-matroska\r\n".encode()
+        + f"Content-Range: bytes {start}-{end - 1}/{total}\r\n\r\n".encode()
+        + DATA[start:end]
+        + b"\r\n"
+        for start, end in [(10, 20), (100, 110), (3000, 3010), (total - 5, total)]
+    ) + f"--{boundary}--\r\n".encode()
+    assert body == expected
+    # Both parts of the first piece come from one read
+    assert handler.reads == [(10, 110), (3000, 3010), (total - 5, total)]
+
+
+def test_multipart_head_has_length_without_handler():
+    status, headers, body = _call(None, "HEAD", range="bytes=0-9,20-29")
+
+    assert status == 206
+    assert headers["content-type"].startswith("multipart/byteranges; boundary=")
+    assert int(headers["content-length"]) > 20
+    assert body == b""
+
+
+@pytest.fixture
+def completed_file(tmp_path):
+    path = tmp_path / "video.mkv"
+    path.write_bytes(DATA)
+    return str(path)
+
+
+def test_completed_file_ranges(completed_file):
+    validators = file_validators("abc", 0, len(DATA))
+
+    status, headers, body = _call(
+        completed_file, range="bytes=10-19", if_range=validators.etag
+    )
+
+    assert status == 206
+    assert headers["etag"] == validators.etag
+    assert headers["content-range"] == f"bytes 10-19/{len(DATA)}"
+    assert body == DATA[10:20]
+
+    status, headers, body = _call(completed_file, range="bytes=0-9,3000-3009")
+
+    assert status == 206
+    assert headers["content-length"] == str(len(body))
+    assert DATA[:10] in body and DATA[3000:3010] in body
+
+
+def test_completed_file_uses_pathsend(completed_file):
+    status, headers, body = _call(
+        completed_file, extensions={"http.response.pathsend": {}}
+    )
+
+    assert status == 200
+    assert headers["content-length"] == str(len(DATA))
+    assert body == completed_file.encode()
+
+    status, _, body = _call(completed_file)
+
+    assert status == 200
+    assert body == DATA
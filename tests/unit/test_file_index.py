@@ -0,0 +1,90 @@
+from lib.torrent.file_index import (
+    FileIndex,
+    FileIndexStorage,
+    MediaKind,
+    media_kind,
+    sort_files,
+)
+
+
+def _index() -> FileIndex:
+    names = ["Show E10.mkv", "show e2.srt", "Show E2.mkv", "Show E1.mkv", "cover.jpg"]
+    order = sort_files(enumerate(names))
+    return FileIndex.from_sorted(
+        (sorted_index, names[file_index], 100 + file_index)
+        for sorted_index, file_index in enumerate(order)
+    )
+
+
+def test_natural_order():
+    names = ["e10.mkv", "E2.mkv", "e1.mkv", "e02.mkv", "a.mkv"]
+
+    order = sort_files(enumerate(names))
+
+    assert [names[i] for i in order] == [
+        "a.mkv",
+        "e1.mkv",
+        "E2.mkv",
+        "e02.mkv",
+        "e10.mkv",
+    ]
+
+
+def test_media_kinds():
+    assert media_kind("Movie.MKV") == MediaKind.video
+    assert media_kind("dir/movie.en.srt") == MediaKind.subtitle
+    assert media_kind("readme") == MediaKind.other
+
+    index = _index()
+
+    assert index.kinds == {
+        MediaKind.video: 3,
+        MediaKind.subtitle: 1,
+        MediaKind.other: 1,
+    }
+
+
+def test_page_and_filter():
+    index = _index()
+
+    total, files = index.page(1, 2)
+    assert total == 5
+    assert [(f.index, f.name) for f in files] == [(1, "Show E1.mkv"), (2, "Show E2.mkv")]
+
+    total, files = index.page(0, 10, MediaKind.video, "e2")
+    assert total == 1
+    assert files[0].name == "Show E2.mkv"
+    assert files[0].size == 102
+
+    assert index.page(10, 10) == (5, [])
+
+
+def test_serialized_pages_are_memoized():
+    index = _index()
+    index.PAGE_CACHE_SIZE = 2
+    calls: list[str] = []
+
+    def serialize(key: str) -> bytes:
+        return index.serialized(key, lambda: calls.append(key) or key.encode())
+
+    assert serialize("a") == b"a"
+    assert serialize("a") == b"a"
+    _ = serialize("b")
+    _ = serialize("c")
+    _ = serialize("a")
+
+    assert calls == ["a", "b", "c", "a"]
+
+
+def test_storage_keeps_recently_used(monkeypatch):
+    monkeypatch.setattr(FileIndexStorage, "MAX_INDEXES", 2)
+    monkeypatch.setattr(FileIndexStorage, "indexes", FileIndexStorage.indexes.copy())
+    FileIndexStorage.indexes.clear()
+    first = FileIndexStorage.put("a", _index())
+    _ = FileIndexStorage.put("b", _index())
+
+    assert FileIndexStorage.get("a") is first
+    _ = FileIndexStorage.put("c", _index())
+
+    assert FileIndexStorage.get("b") is None
+    assert FileIndexStorage.get("a") is first
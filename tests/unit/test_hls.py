@@ -0,0 +1,258 @@
+import asyncio
+import random
+import struct
+from collections import OrderedDict
+from itertools import pairwise
+
+import pytest
+
+from lib.containers.exceptions import ContainerParseException
+from lib.containers.hls import HlsPlaylistStorage, build_hls_playlist
+from lib.containers.ts import TS_PACKET_SIZE
+from lib.http_exceptions import UnprocessableEntity
+from lib.video_sources import HttpLinkVideoSource
+
+VIDEO_PID = 0x100
+PMT_PID = 0x1000
+FPS = 25
+GOP = 50
+
+
+def reader(data: bytes):
+    async def read(start: int, length: int) -> bytes:
+        return data[start : start + length]
+
+    return read
+
+
+def packet(
+    pid: int, payload: bytes, unit_start: bool, random_access: bool = False
+) -> bytes:
+    header = bytes([0x47, (0x40 if unit_start else 0) | pid >> 8, pid & 0xFF])
+    if random_access:
+        body = bytes([0x30, 1, 0x40]) + payload
+    else:
+        body = bytes([0x10]) + payload
+    return (header + body).ljust(TS_PACKET_SIZE, b"\xff")
+
+
+def section(table_id: int, body: bytes) -> bytes:
+    length = len(body) + 4
+    return bytes([0, table_id, 0xB0 | length >> 8, length & 0xFF]) + body + b"\0" * 4
+
+
+PAT = packet(
+    0, section(0, b"\x00\x01\xc1\x00\x00" + struct.pack(">HH", 1, 0xE000 | PMT_PID)), True
+)
+PMT = packet(
+    PMT_PID,
+    section(
+        2,
+        b"\x00\x01\xc1\x00\x00"
+        + struct.pack(">HH", 0xE000 | VIDEO_PID, 0xF000)
+        + bytes([0x0F, 0xE1, 0x01, 0xF0, 0x00])
+        + bytes([0x1B, 0xE0 | VIDEO_PID >> 8, VIDEO_PID & 0xFF, 0xF0, 0x00]),
+    ),
+    True,
+)
+
+
+def pes(pts: int) -> bytes:
+    return b"\x00\x00\x01\xe0\x00\x00\x80\x80\x05" + bytes(
+        [
+            0x21 | (pts >> 29) & 0x0E,
+            (pts >> 22) & 0xFF,
+            (pts >> 14) & 0xFE | 1,
+            (pts >> 7) & 0xFF,
+            (pts << 1) & 0xFE | 1,
+        ]
+    )
+
+
+def build_ts(frames: int) -> bytes:
+    """Frames of 10 packets at 25 fps, a keyframe every 2 seconds preceded
+    by the program tables"""
+    out = bytearray()
+    for frame in range(frames):
+        pts = 90000 + frame * 90000 // FPS
+        if frame % GOP == 0:
+            out += PAT + PMT
+        out += packet(VIDEO_PID, pes(pts), True, random_access=frame % GOP == 0)
+        out += packet(VIDEO_PID, b"", False) * 9
+    return bytes(out)
+
+
+def box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def build_fmp4(fragments: int) -> tuple[bytes, list[int]]:
+    """Fragments of 2 seconds indexed by a sidx, returns moof offsets"""
+    head = box(b"ftyp", b"isom") + box(b"moov", b"\0" * 100)
+    media = [
+        box(b"moof", b"\0" * 50) + box(b"mdat", b"\0" * (1000 + i))
+        for i in range(fragments)
+    ]
+    sidx = box(
+        b"sidx",
+        b"\0\0\0\0"
+        + struct.pack(">IIIIHH", 1, 1000, 0, 0, 0, fragments)
+        + b"".join(struct.pack(">III", len(m), 2000, 0x90000000) for m in media),
+    )
+    offsets: list[int] = []
+    offset = len(head) + len(sidx)
+    for m in media:
+        offsets.append(offset)
+        offset += len(m)
+    return head + sidx + b"".join(media), offsets
+
+
+def test_fmp4_segments_follow_sidx():
+    data, offsets = build_fmp4(10)
+
+    playlist = asyncio.run(build_hls_playlist(reader(data), len(data)))
+
+    assert playlist.init == (0, data.index(b"sidx") - 4)
+    assert [s.offset for s in playlist.segments] == offsets[::3]
+    assert [s.duration for s in playlist.segments] == [6, 6, 6, 2]
+    assert playlist.segments[-1].offset + playlist.segments[-1].size == len(data)
+    text = playlist.render("../0")
+    assert "#EXT-X-VERSION:6" in text
+    assert f'#EXT-X-MAP:URI="../0",BYTERANGE="{playlist.init[1]}@0"' in text
+    assert f"#EXT-X-BYTERANGE:{playlist.segments[1].size}@{offsets[3]}" in text
+    assert text.endswith("#EXT-X-ENDLIST\n")
+
+
+def test_progressive_mp4_is_rejected():
+    data = box(b"ftyp", b"isom") + box(b"moov", b"\0" * 100) + box(b"mdat", b"\0" * 100)
+
+    with pytest.raises(ContainerParseException, match="not fragmented"):
+        asyncio.run(build_hls_playlist(reader(data), len(data)))
+
+
+def test_ts_segments_start_at_keyframes():
+    data = build_ts(60 * FPS)
+
+    playlist = asyncio.run(build_hls_playlist(reader(data), len(data)))
+
+    assert playlist.init is None
+    assert playlist.segments[0].offset == 0
+    for segment, following in pairwise(playlist.segments):
+        assert segment.offset + segment.size == following.offset
+        # Every segment opens with the program tables and a keyframe
+        assert data[following.offset : following.offset + 2 * TS_PACKET_SIZE] == PAT + PMT
+        assert segment.duration % 2 == pytest.approx(0, abs=1e-6)
+    assert playlist.segments[-1].offset + playlist.segments[-1].size == len(data)
+    assert sum(s.duration for s in playlist.segments) == pytest.approx(59.96)
+    assert len(playlist.segments) == 6
+    assert "#EXT-X-VERSION:4" in playlist.render("../0")
+
+
+class FakeLinkSource(HttpLinkVideoSource):
+    def __init__(self, data: bytes) -> None:
+        super().__init__("http://origin.test/video.ts", 0)
+        self.data: bytes = data
+        self.reads: int = 0
+
+    async def hls_source(self):
+        async def read(start: int, length: int) -> bytes:
+            self.reads += 1
+            return self.data[start : start + length]
+
+        return "fake-etag", read, len(self.data)
+
+
+def test_playlists_are_cached(monkeypatch):
+    monkeypatch.setattr(HlsPlaylistStorage, "playlists", OrderedDict())
+    source = FakeLinkSource(build_ts(20 * FPS))
+
+    async def scenario():
+        return await asyncio.gather(source.hls_playlist(), source.hls_playlist())
+
+    first, second = asyncio.run(scenario())
+
+    assert first is second
+    reads = source.reads
+    asyncio.run(source.hls_playlist())
+    assert source.reads == reads
+
+
+def test_no_hls_for_redirected_links():
+    source = HttpLinkVideoSource("http://origin.test/video.ts", 0)
+
+    with pytest.raises(UnprocessableEntity):
+        asyncio.run(source.hls_playlist())
+
+
+def test_ts_playlist_is_estimated_without_scan():
+    data = build_ts(60 * FPS)
+    reads: list[tuple[int, int]] = []
+
+    async def read(start: int, length: int) -> bytes:
+        reads.append((start, length))
+        return data[start : start + length]
+
+    playlist = asyncio.run(build_hls_playlist(read, len(data), scan=False))
+
+    # The head and the tail only
+    assert len(reads) == 2
+    assert len(playlist.segments) == 6
+    for segment, following in pairwise(playlist.segments):
+        assert segment.offset + segment.size == following.offset
+        assert following.offset % TS_PACKET_SIZE == 0
+    assert playlist.segments[-1].offset + playlist.segments[-1].size == len(data)
+    assert sum(s.duration for s in playlist.segments) == pytest.approx(59.96)
+    assert "#EXT-X-INDEPENDENT-SEGMENTS" not in playlist.render("../0")
+
+
+class UnscannableLinkSource(FakeLinkSource):
+    def hls_scannable(self) -> bool:
+        return False
+
+
+def test_estimated_and_scanned_playlists_are_cached_apart(monkeypatch):
+    monkeypatch.setattr(HlsPlaylistStorage, "playlists", OrderedDict())
+    data = build_ts(20 * FPS)
+
+    estimated = asyncio.run(UnscannableLinkSource(data).hls_playlist())
+    scanned = asyncio.run(FakeLinkSource(data).hls_playlist())
+
+    assert not estimated.independent
+    assert scanned.independent
+
+
+def test_truncated_file_has_no_hls(monkeypatch):
+    monkeypatch.setattr(HlsPlaylistStorage, "playlists", OrderedDict())
+    data, _ = build_fmp4(10)
+    source = FakeLinkSource(data[: len(data) // 2])
+
+    async def hls_source():
+        return "truncated", reader(source.data), len(data)
+
+    monkeypatch.setattr(source, "hls_source", hls_source)
+
+    with pytest.raises(UnprocessableEntity):
+        asyncio.run(source.hls_playlist())
+
+
+@pytest.mark.parametrize(
+    "data", [build_fmp4(4)[0], build_ts(4 * FPS)], ids=["fmp4", "ts"]
+)
+def test_broken_files_fail_with_parse_errors(data):
+    rng = random.Random(46)
+    samples = [data[: rng.randrange(len(data))] for _ in range(200)]
+    for _ in range(200):
+        broken = bytearray(data)
+        for _ in range(rng.randint(1, 4)):
+            broken[rng.randrange(len(data))] = rng.randrange(256)
+        samples.append(bytes(broken))
+
+    async def scenario():
+        for sample in samples:
+            for size in {len(sample), len(data)}:
+                try:
+                    _ = await build_hls_playlist(reader(sample), size)
+                except ContainerParseException:
+                    pass
+
+    asyncio.run(scenario())
@@ -0,0 +1,210 @@
+import asyncio
+
+import httpx
+import pytest
+from starlette.requests import Request
+
+import config
+import lib.link_proxy as link_proxy_module
+from lib.custom_responses import LinkProxyResponse
+from lib.http_exceptions import BadGateway
+from lib.link_proxy import ChunkCache, LinkProxy, probe_link
+from lib.video_sources import HttpLinkVideoSource
+
+URL = "http://origin.test/movies/film%201.mp4"
+DATA = bytes(range(256)) * 64
+CHUNK = 1024
+
+
+class Origin:
+    """Stands in for an HTTP server answering range requests"""
+
+    def __init__(self, ranges: bool = True) -> None:
+        self.ranges: bool = ranges
+        self.requests: list[str] = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        http_range = request.headers.get("range")
+        self.requests.append(http_range)
+        if not self.ranges or http_range is None:
+            return httpx.Response(200, content=DATA)
+        start, end = map(int, http_range.removeprefix("bytes=").split("-"))
+        return httpx.Response(
+            206,
+            content=DATA[start : end + 1],
+            headers={
+                "content-range": f"bytes {start}-{end}/{len(DATA)}",
+                "content-type": "video/mp4",
+                "etag": '"v1"',
+            },
+        )
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(LinkProxy, "CHUNK_SIZE", CHUNK)
+    monkeypatch.setattr(LinkProxy, "READ_AHEAD_CHUNKS", 4)
+
+
+def _client(origin: Origin) -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.MockTransport(origin))
+
+
+async def _proxy(origin: Origin, path, max_chunks: int = 100) -> LinkProxy:
+    client = _client(origin)
+    info = await probe_link(client, URL)
+    return LinkProxy(URL, info, ChunkCache(path, max_chunks), client)
+
+
+def test_probe():
+    async def scenario():
+        return await probe_link(_client(Origin()), URL)
+
+    info = asyncio.run(scenario())
+
+    assert info.size == len(DATA)
+    assert info.content_type == "video/mp4"
+    assert info.etag == '"v1"'
+
+
+def test_origin_without_ranges_is_rejected():
+    async def scenario():
+        return await probe_link(_client(Origin(ranges=False)), URL)
+
+    with pytest.raises(BadGateway):
+        asyncio.run(scenario())
+
+
+def test_viewers_share_chunk_fetches(tmp_path):
+    origin = Origin()
+
+    async def scenario():
+        proxy = await _proxy(origin, tmp_path)
+        origin.requests.clear()
+        reads = await asyncio.gather(
+            *(proxy.read(1000, 3000) for _ in range(5)), proxy.read(1500, 10)
+        )
+        again = await proxy.read(1000, 3000)
+        return reads, again
+
+    reads, again = asyncio.run(scenario())
+
+    assert all(data == DATA[1000:4000] for data in reads[:5])
+    assert reads[5] == DATA[1500:1510]
+    assert again == DATA[1000:4000]
+    assert sorted(origin.requests) == [
+        f"bytes={i * CHUNK}-{(i + 1) * CHUNK - 1}" for i in range(4)
+    ]
+
+
+def test_cache_is_bounded(tmp_path):
+    async def scenario():
+        proxy = await _proxy(Origin(), tmp_path, max_chunks=2)
+        for chunk_id in range(5):
+            _ = await proxy.read_chunk(chunk_id)
+        return proxy
+
+    proxy = asyncio.run(scenario())
+
+    assert list(proxy.cache.chunks) == [3, 4]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["3", "4"]
+    proxy.close()
+    assert not tmp_path.exists()
+
+
+def test_read_ahead_follows_playhead(tmp_path):
+    origin = Origin()
+
+    async def scenario():
+        proxy = await _proxy(origin, tmp_path)
+        proxy.set_playhead(10 * CHUNK + 5)
+        assert proxy._read_ahead_task is not None
+        await proxy._read_ahead_task
+        return proxy
+
+    proxy = asyncio.run(scenario())
+
+    assert list(proxy.cache.chunks) == [10, 11, 12, 13]
+
+
+def test_link_room_proxy_mode(tmp_path, monkeypatch):
+    origin = Origin()
+    monkeypatch.setattr(config, "LINK_MODE", "proxy")
+    monkeypatch.setattr(config, "LINK_CACHE_PATH", tmp_path)
+    monkeypatch.setattr(link_proxy_module, "_client", _client(origin))
+    source = HttpLinkVideoSource(URL, 0)
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/",
+        "query_string": b"player=1",
+        "headers": [(b"range", b"bytes=5000-5999")],
+        "client": ("10.0.0.1", 5000),
+    }
+    messages: list[dict] = []
+
+    async def receive():
+        return {"type": "http.request"}
+
+    async def send(message: dict):
+        messages.append(message)
+
+    async def scenario():
+        response = await source.get_video_response(Request(scope), "bob")
+        assert isinstance(response, LinkProxyResponse)
+        await response(scope, receive, send)
+        source.cleanup()
+
+    asyncio.run(scenario())
+
+    assert messages[0]["status"] == 206
+    assert source.file_name == "film 1.mp4"
+    assert b"".join(m.get("body", b"") for m in messages[1:]) == DATA[5000:6000]
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "ftp://93.184.216.34/film.mp4",
+        "file:///etc/passwd",
+        "http://127.0.0.1:8000/admin",
+        "http://localhost/film.mp4",
+        "http://10.0.0.5/film.mp4",
+        "http://169.254.169.254/latest/meta-data",
+        "http://[::1]/film.mp4",
+        "http://[::ffff:192.168.0.1]/film.mp4",
+        "http://0.0.0.0/film.mp4",
+        "http://240.0.0.1/film.mp4",
+    ],
+)
+def test_private_targets_are_rejected(url):
+    async def scenario():
+        await link_proxy_module.check_origin(httpx.URL(url))
+
+    with pytest.raises(BadGateway):
+        asyncio.run(scenario())
+
+
+def test_public_target_is_allowed():
+    asyncio.run(link_proxy_module.check_origin(httpx.URL("https://93.184.216.34/a.mp4")))
+
+
+def test_every_redirect_hop_is_checked():
+    requests: list[str] = []
+
+    def origin(request: httpx.Request) -> httpx.Response:
+        requests.append(str(request.url))
+        return httpx.Response(302, headers={"location": "http://127.0.0.1/secret"})
+
+    async def scenario():
+        client = httpx.AsyncClient(
+            transport=httpx.MockTransport(origin),
+            follow_redirects=True,
+            event_hooks={"request": [link_proxy_module._check_request]},  # pyright: ignore[reportPrivateUsage]
+        )
+        return await probe_link(client, "http://93.184.216.34/film.mp4")
+
+    with pytest.raises(BadGateway) as exc_info:
+        asyncio.run(scenario())
+    assert "not a public address" in exc_info.value.msg
+    assert requests == ["http://93.184.216.34/film.mp4"]
@@ -0,0 +1,55 @@
+import libtorrent as lt
+
+from lib.torrent.manifest import TorrentManifest
+from lib.video_sources import SortedToTorrentFileIndex
+
+
+class FakeTorrent:
+    def __init__(self, ti: lt.torrent_info) -> None:
+        self.ti: lt.torrent_info = ti
+
+    def files_count(self) -> int:
+        return self.ti.num_files()
+
+    def get_file_name(self, file_id: int) -> str:
+        return self.ti.files().file_name(file_id)
+
+
+def _multi_file_torrent(tmp_path) -> bytes:
+    folder = tmp_path / "show"
+    folder.mkdir()
+    for name, size in (("b.mkv", 40_000), ("a.mkv", 20_000), ("c.srt", 1_000)):
+        (folder / name).write_bytes(b"x" * size)
+    fs = lt.file_storage()
+    lt.add_files(fs, str(folder))
+    ct = lt.create_torrent(fs, 16 * 1024)
+    lt.set_piece_hashes(ct, str(tmp_path))
+    return lt.bencode(ct.generate())
+
+
+def test_manifest_matches_torrent(tmp_path):
+    content = _multi_file_torrent(tmp_path)
+    ti = lt.torrent_info(content)
+
+    manifest = TorrentManifest.parse(content)
+
+    assert manifest.infohash == str(ti.info_hashes().get_best())
+    assert manifest.piece_length == 16 * 1024
+    assert manifest.pieces_count == ti.num_pieces()
+    assert manifest.total_size == ti.total_size()
+    assert [(f.name, f.size) for f in manifest.files] == [
+        (ti.files().file_name(i), ti.files().file_size(i))
+        for i in range(ti.num_files())
+    ]
+
+
+def test_files_sorted_like_rooms_show_them(tmp_path):
+    content = _multi_file_torrent(tmp_path)
+    manifest = TorrentManifest.parse(content)
+    mapping = SortedToTorrentFileIndex(FakeTorrent(lt.torrent_info(content)))  # pyright: ignore[reportArgumentType]
+
+    assert manifest.sorted_files() == mapping.get_sorted()
+    for f in manifest.files:
+        assert mapping.sorted_to_original(f.sorted_index) == f.file_index
+    names = [name for _, name in manifest.sorted_files()]
+    assert names.index("a.mkv") < names.index("b.mkv") < names.index("c.srt")
@@ -0,0 +1,72 @@
+from lib.torrent.piece_cache import PieceCache, PopularityPieceCache
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now: float = 0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _read(cache: PieceCache, piece_id: int):
+    if cache.get(piece_id) is None:
+        cache.put(piece_id, f"p{piece_id}".encode())
+
+
+def test_lru_counts_hits():
+    cache = PieceCache(2)
+
+    for piece_id in (1, 2, 1, 3, 2):
+        _read(cache, piece_id)
+
+    assert (cache.hits, cache.misses) == (1, 4)
+    assert cache.hit_rate == 0.2
+    assert 2 in cache and 3 in cache and 1 not in cache
+
+
+def test_popular_piece_outlives_recent_ones():
+    clock = FakeClock()
+    cache = PopularityPieceCache(3, clock)
+    for _ in range(5):
+        _read(cache, 0)
+        clock.now += 1
+
+    for piece_id in range(10, 20):
+        _read(cache, piece_id)
+        clock.now += 1
+
+    assert 0 in cache
+    assert 19 in cache
+    assert 10 not in cache
+
+
+def test_pieces_behind_playhead_are_kept():
+    clock = FakeClock()
+    cache = PopularityPieceCache(4, clock)
+    cache.set_playhead("room", 103)
+    for piece_id in (100, 101, 102, 103):
+        _read(cache, piece_id)
+        clock.now += 1
+
+    _read(cache, 500)
+
+    assert 100 not in cache
+    assert all(p in cache for p in (101, 102, 103, 500))
+
+    cache.clear_playhead("room")
+    _read(cache, 501)
+
+    assert 101 not in cache
+
+
+def test_access_history_is_bounded():
+    clock = FakeClock()
+    cache = PopularityPieceCache(2, clock)
+
+    for piece_id in range(1000):
+        _read(cache, piece_id)
+        clock.now += 1
+
+    assert len(cache) == 2
+    assert len(cache.accesses) <= cache.HISTORY_FACTOR * cache.capacity * 2
@@ -0,0 +1,121 @@
+import pytest
+
+from lib.http_exceptions import UnprocessableEntity
+from lib.torrent.torrent_handler import FileTorrentHandler
+from lib.torrent.torrent_info import PiecePriority
+from models.prebuffer_model import PrebufferStatusEnum
+from schemas.prebuffer_schemas import CreatePrebufferJobSchema, GetPrebufferJobSchema
+
+PIECE_SIZE = 100
+PIECES_COUNT = 10
+
+
+class FakeTorrent:
+    def __init__(self) -> None:
+        self.have: set[int] = set()
+        self.priorities: dict[int, PiecePriority] = {}
+
+    def have_piece(self, piece_id: int) -> bool:
+        return piece_id in self.have
+
+    def have_pieces(self) -> list[bool]:
+        return [i in self.have for i in range(PIECES_COUNT)]
+
+    def piece_priorities(self) -> list[PiecePriority]:
+        return [self.get_piece_priority(i) for i in range(PIECES_COUNT)]
+
+    def piece_size(self, piece_id: int) -> int:
+        return PIECE_SIZE
+
+    def get_piece_priority(self, piece_id: int) -> PiecePriority:
+        return self.priorities.get(piece_id, PiecePriority.DONT_DOWNLOAD)
+
+    def set_pieces_priority(self, pieces):
+        self.priorities.update(pieces)
+
+    def file_size(self, file_index: int) -> int:
+        return PIECE_SIZE * PIECES_COUNT
+
+    def file_pieces(self, file_index: int, byte_start: int, byte_end: int) -> range:
+        return range(byte_start // PIECE_SIZE, -(-byte_end // PIECE_SIZE))
+
+
+class FakePieceGetter:
+    def __init__(self) -> None:
+        self.piece_required_at: dict[int, tuple[float, int]] = {}
+
+
+@pytest.fixture
+def handler():
+    handler = FileTorrentHandler.__new__(FileTorrentHandler)
+    handler.torrent = FakeTorrent()
+    handler.piece_getter = FakePieceGetter()
+    return handler
+
+
+def test_background_download_skips_busy_pieces(handler):
+    handler.torrent.have.add(1)
+    handler.piece_getter.piece_required_at[2] = (0, 0)
+    handler.torrent.priorities[3] = PiecePriority.TOP
+
+    assert handler.download_in_background(range(5)) == [0, 4]
+    assert handler.torrent.priorities[0] == PiecePriority.LOW
+    assert handler.torrent.priorities[3] == PiecePriority.TOP
+
+
+def test_stop_background_download(handler):
+    _ = handler.download_in_background(range(3))
+    handler.torrent.have.add(0)
+    handler.piece_getter.piece_required_at[1] = (0, 0)
+
+    handler.stop_background_download(range(3))
+
+    assert handler.torrent.get_piece_priority(1) == PiecePriority.LOW
+    assert handler.torrent.get_piece_priority(2) == PiecePriority.DONT_DOWNLOAD
+
+
+def test_prefetch_file_downloads_head_and_tail(handler, monkeypatch):
+    monkeypatch.setattr(FileTorrentHandler, "PREFETCH_HEAD_BYTES", 2 * PIECE_SIZE)
+    monkeypatch.setattr(FileTorrentHandler, "PREFETCH_TAIL_BYTES", PIECE_SIZE)
+    handler.torrent.priorities[1] = PiecePriority.TOP
+
+    handler.prefetch_file(0)
+
+    assert handler.torrent.priorities == {
+        0: PiecePriority.LOW,
+        1: PiecePriority.TOP,
+        PIECES_COUNT - 1: PiecePriority.LOW,
+    }
+
+
+def test_downloaded_of(handler):
+    handler.torrent.have.update({0, 2})
+    assert handler.downloaded_of(range(4)) == (2 * PIECE_SIZE, 4 * PIECE_SIZE)
+
+
+@pytest.mark.parametrize(
+    "span",
+    [
+        {"byte_start": 0, "start_s": 10},
+        {"byte_start": 100, "byte_end": 100},
+        {"start_s": 20, "end_s": 10},
+    ],
+)
+def test_invalid_span(span):
+    with pytest.raises(UnprocessableEntity):
+        _ = CreatePrebufferJobSchema(file_index=0, **span)
+
+
+def test_job_progress():
+    job = GetPrebufferJobSchema(
+        job_id="6b8f9a4e-0f3c-11ef-9262-0242ac120002",
+        room_id="6b8f9a4e-0f3c-11ef-9262-0242ac120003",
+        file_index=0,
+        byte_start=0,
+        byte_end=None,
+        status=PrebufferStatusEnum.running,
+        downloaded=25,
+        total=100,
+        error="",
+    )
+    assert job.progress == 0.25
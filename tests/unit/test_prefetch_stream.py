@@ -0,0 +1,104 @@
+import asyncio
+import time
+from contextlib import aclosing
+
+import pytest
+
+from lib.prefetch_stream import PrefetchStream
+
+
+class FakeSource:
+    def __init__(self, chunks: int, size: int = 10, delay: float = 0) -> None:
+        self.chunks: int = chunks
+        self.size: int = size
+        self.delay: float = delay
+        self.produced: int = 0
+        self.closed: bool = False
+
+    async def iter(self):
+        try:
+            for i in range(self.chunks):
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                self.produced += 1
+                yield bytes([i]) * self.size
+        finally:
+            self.closed = True
+
+
+def test_reads_everything_in_order():
+    source = FakeSource(20)
+
+    async def scenario():
+        stream = PrefetchStream(source.iter(), 35)
+        return [data async for data in stream.read()]
+
+    chunks = asyncio.run(scenario())
+
+    assert chunks == [bytes([i]) * 10 for i in range(20)]
+    assert source.closed
+
+
+def test_slow_consumer_bounds_buffer():
+    source = FakeSource(100)
+
+    async def scenario():
+        stream = PrefetchStream(source.iter(), 35)
+        async with aclosing(stream.read()) as chunks:
+            async for _ in chunks:
+                await asyncio.sleep(0.01)
+                assert stream.buffered <= 35 + 10
+                break
+        return stream
+
+    stream = asyncio.run(scenario())
+
+    # One chunk sent, the buffer full and one chunk waiting in the reader
+    assert source.produced <= 6
+    assert source.closed
+    assert stream.task is not None and stream.task.done()
+
+
+def test_error_reaches_consumer():
+    async def failing():
+        yield b"a"
+        raise RuntimeError("piece timeout")
+
+    async def scenario():
+        return [data async for data in PrefetchStream(failing(), 100).read()]
+
+    with pytest.raises(RuntimeError, match="piece timeout"):
+        asyncio.run(scenario())
+
+
+def test_fetching_overlaps_sending():
+    source = FakeSource(10, delay=0.02)
+
+    async def scenario():
+        async for _ in PrefetchStream(source.iter(), 1000).read():
+            await asyncio.sleep(0.02)
+
+    started = time.monotonic()
+    asyncio.run(scenario())
+
+    # Sequential fetch and send would take 0.4s
+    assert time.monotonic() - started < 0.32
+
+
+def test_cancelling_reader_ends_stream():
+    source = FakeSource(100, delay=0.01)
+
+    async def scenario():
+        stream = PrefetchStream(source.iter(), 1000)
+        task = stream.start()
+        received: list[bytes] = []
+        async for data in stream.read():
+            received.append(data)
+            if len(received) == 2:
+                _ = task.cancel()
+        return received
+
+    received = asyncio.run(scenario())
+
+    assert 2 <= len(received) < 100
+    assert source.closed
@@ -0,0 +1,274 @@
+import asyncio
+import time
+from multiprocessing.shared_memory import SharedMemory
+
+import libtorrent as lt
+import pytest
+
+import lib.torrent.engine_worker as worker_module
+from lib.torrent.alert_observer import AlertObserver
+from lib.torrent.alert_records import (
+    ErrorCode,
+    FileCompletedRecord,
+    PieceFinishedRecord,
+    ReadPieceRecord,
+    TorrentStatusRecord,
+)
+from lib.torrent.engine_worker import ALERTS, REPLY, STATUS
+from lib.torrent.remote_engine import CALL_TIMEOUT_S, RemoteEngine, RemoteTorrentInfo
+from lib.torrent.torrent_info import (
+    PEER_BAN_MAX,
+    PEER_BAN_S,
+    PiecePriority,
+    SetDeadlineFlags,
+)
+
+
+class FakeReadPieceAlert:
+    def __init__(self, piece: int, buffer: bytes, error_code: int = 0) -> None:
+        self.piece: int = piece
+        self.buffer: bytes = buffer
+        self.size: int = len(buffer)
+        self.error: ErrorCode = ErrorCode(error_code)
+
+
+class FakeEngine:
+    def __init__(self) -> None:
+        self.calls: list[tuple[str, tuple]] = []
+        self.torrent_status: TorrentStatusRecord | None = None
+
+    def add(self, torrent) -> int:
+        return 1
+
+    def call(self, torrent_id: int, method: str, *args):
+        self.calls.append((method, args))
+
+    def status(self, torrent_id: int) -> TorrentStatusRecord | None:
+        return self.torrent_status
+
+
+class AliveProcess:
+    pid: int = 0
+
+    def is_alive(self) -> bool:
+        return True
+
+
+@pytest.fixture
+def idle_engine(monkeypatch):
+    """An engine without a process, messages are fed to it by the test"""
+    monkeypatch.setattr(RemoteEngine, "start", lambda self: None)
+    engine = RemoteEngine()
+    engine.process = AliveProcess()  # pyright: ignore[reportAttributeAccessIssue]
+    return engine
+
+
+@pytest.fixture
+def torrent_path(tmp_path):
+    (tmp_path / "video.mkv").write_bytes(b"x" * 100_000)
+    fs = lt.file_storage()
+    lt.add_files(fs, str(tmp_path / "video.mkv"))
+    ct = lt.create_torrent(fs, 16 * 1024)
+    lt.set_piece_hashes(ct, str(tmp_path))
+    path = tmp_path / "video.torrent"
+    path.write_bytes(lt.bencode(ct.generate()))
+    return str(path)
+
+
+def _is_unlinked(name: str) -> bool:
+    try:
+        SharedMemory(name).close()
+    except FileNotFoundError:
+        return True
+    return False
+
+
+def test_read_piece_goes_through_shared_memory(monkeypatch):
+    monkeypatch.setattr(worker_module, "ReadPieceAlert", FakeReadPieceAlert)
+    record = worker_module.record_alert(FakeReadPieceAlert(3, b"piece data"))
+
+    assert isinstance(record, ReadPieceRecord)
+    assert record.shm_name is not None
+    name = record.shm_name
+    view = record.buffer
+    assert isinstance(view, memoryview)
+    # Mapped without a copy, the name is gone and the view outlives the record
+    assert _is_unlinked(name)
+    record.release()
+    assert bytes(view[:5]) == b"piece"
+
+
+def test_unread_piece_is_unlinked_on_release(monkeypatch):
+    monkeypatch.setattr(worker_module, "ReadPieceAlert", FakeReadPieceAlert)
+    record = worker_module.record_alert(FakeReadPieceAlert(3, b"piece data"))
+
+    assert isinstance(record, ReadPieceRecord)
+    name = record.shm_name
+    assert name is not None
+    record.release()
+    assert _is_unlinked(name)
+
+
+def test_failed_read_has_no_buffer(monkeypatch):
+    monkeypatch.setattr(worker_module, "ReadPieceAlert", FakeReadPieceAlert)
+    record = worker_module.record_alert(FakeReadPieceAlert(3, b"data", error_code=5))
+
+    assert isinstance(record, ReadPieceRecord)
+    assert record.buffer is None
+    record.release()
+
+
+def test_file_completed_is_recorded(monkeypatch):
+    class FakeFileCompletedAlert:
+        index: int = 2
+
+    monkeypatch.setattr(worker_module, "FileCompletedAlert", FakeFileCompletedAlert)
+
+    assert worker_module.record_alert(FakeFileCompletedAlert()) == FileCompletedRecord(2)
+
+
+def test_observer_dispatches_records_by_libtorrent_type():
+    class Torrent:
+        def pop_alerts(self):
+            observer.cleanup()
+            return [PieceFinishedRecord(7)]
+
+    observer = AlertObserver(Torrent())  # pyright: ignore[reportArgumentType]
+    got = []
+    observer.add_alert_observer(lt.piece_finished_alert, got.append)
+
+    asyncio.run(observer.observe_alerts())
+    assert got == [PieceFinishedRecord(7)]
+
+
+def test_replay_restores_handle_state(torrent_path, tmp_path):
+    engine = FakeEngine()
+    torrent = RemoteTorrentInfo(engine, torrent_path, str(tmp_path))  # pyright: ignore[reportArgumentType]
+
+    torrent.set_pieces_priority((i, PiecePriority.DONT_DOWNLOAD) for i in range(3))
+    torrent.set_pieces_priority([(1, PiecePriority.LOW)])
+    torrent.set_piece_deadline(0, 0, SetDeadlineFlags.ALERT_WHEN_AVAILABLE)
+    torrent.set_piece_deadline(2, 10)
+    torrent.reset_piece_deadline(2)
+    torrent.set_download_limit(1024)
+    torrent.block_peers(["10.0.0.1"])
+
+    assert torrent.replay_calls() == [
+        (
+            "set_pieces_priority",
+            (
+                [
+                    (0, PiecePriority.DONT_DOWNLOAD),
+                    (1, PiecePriority.LOW),
+                    (2, PiecePriority.DONT_DOWNLOAD),
+                ],
+            ),
+        ),
+        ("set_piece_deadline", (0, 0, SetDeadlineFlags.ALERT_WHEN_AVAILABLE)),
+        ("set_download_limit", (1024,)),
+        ("set_ip_filter", (["10.0.0.1"],)),
+    ]
+    # Metadata is local, no round trips for it
+    assert torrent.pieces_count() == 7
+    assert not any(method == "pieces_count" for method, _ in engine.calls)
+
+
+def test_queries_are_answered_from_status(torrent_path, tmp_path):
+    engine = FakeEngine()
+    torrent = RemoteTorrentInfo(engine, torrent_path, str(tmp_path))  # pyright: ignore[reportArgumentType]
+    assert not torrent.have_piece(0)
+    assert torrent.peers_count() == 0
+
+    engine.torrent_status = TorrentStatusRecord(
+        pieces=[True, False, False, False, False, False, False],
+        priorities=[4] * 7,
+        peers=3,
+        download_rate=1000,
+        downloading_peers={1: {"10.0.0.2"}},
+    )
+    torrent.set_pieces_priority([(5, PiecePriority.LOW)])
+    torrent.set_piece_deadline(2, 0)
+    torrent.finished.add(3)
+
+    assert torrent.have_pieces() == [True, False, False, True, False, False, False]
+    assert torrent.have_piece(0) and not torrent.have_piece(1)
+    assert torrent.peers_downloading(1) == {"10.0.0.2"}
+    assert (torrent.peers_count(), torrent.download_rate()) == (3, 1000)
+    assert torrent.piece_priorities()[:6] == [
+        PiecePriority.DEFAULT,
+        PiecePriority.DEFAULT,
+        PiecePriority.TOP,
+        PiecePriority.DEFAULT,
+        PiecePriority.DEFAULT,
+        PiecePriority.LOW,
+    ]
+    assert [method for method, _ in engine.calls] == [
+        "set_pieces_priority",
+        "set_piece_deadline",
+    ]
+
+
+def test_engine_messages_are_settled_by_reader(idle_engine, torrent_path, tmp_path):
+    torrent = RemoteTorrentInfo(idle_engine, torrent_path, str(tmp_path))
+    call_id = max(idle_engine.pending)
+    status = TorrentStatusRecord([False] * 7, [4] * 7, 1, 0, {})
+
+    idle_engine._receive((REPLY, call_id, True, None))
+    idle_engine._receive((STATUS, torrent.torrent_id, status))
+    idle_engine._receive((ALERTS, torrent.torrent_id, [PieceFinishedRecord(4)]))
+
+    assert idle_engine.pending == {}
+    assert idle_engine.status(torrent.torrent_id) is status
+    assert torrent.have_piece(4)
+    assert torrent.pop_alerts() == [PieceFinishedRecord(4)]
+
+
+def test_unanswered_call_restarts_engine(idle_engine, monkeypatch):
+    restarts: list[bool] = []
+    monkeypatch.setattr(idle_engine, "restart", lambda: restarts.append(True))
+
+    idle_engine.call(1, "read_piece", 3)
+    idle_engine.ensure_running()
+    assert restarts == []
+
+    sent, what = idle_engine.pending[1]
+    idle_engine.pending[1] = (sent - CALL_TIMEOUT_S - 1, what)
+    idle_engine.ensure_running()
+    assert restarts == [True]
+
+
+def test_engine_process_serves_status_and_pieces(torrent_path, tmp_path):
+    engine = RemoteEngine()
+    try:
+        torrent = RemoteTorrentInfo(engine, torrent_path, str(tmp_path))
+        finish = time.monotonic() + 30
+        while not all(torrent.have_pieces()) and time.monotonic() < finish:
+            time.sleep(0.1)
+        assert all(torrent.have_pieces())
+
+        torrent.read_piece(1)
+        records: list = []
+        while not records and time.monotonic() < finish:
+            records = [r for r in torrent.pop_alerts() if isinstance(r, ReadPieceRecord)]
+            time.sleep(0.05)
+        assert records and records[0].buffer is not None
+        assert bytes(records[0].buffer) == b"x" * 16 * 1024
+        assert engine.pending == {}
+    finally:
+        engine.stop()
+
+
+def test_peer_bans_expire_and_are_capped(torrent_path, tmp_path):
+    engine = FakeEngine()
+    torrent = RemoteTorrentInfo(engine, torrent_path, str(tmp_path))  # pyright: ignore[reportArgumentType]
+
+    torrent.block_peers([f"10.0.0.{i}" for i in range(PEER_BAN_MAX + 5)], now=0)
+    assert len(torrent.blocked_ips) == PEER_BAN_MAX
+    torrent.block_peers(["10.0.1.1"], now=PEER_BAN_S / 2)
+    assert "10.0.1.1" not in torrent.blocked_ips
+
+    torrent.unblock_expired_peers(now=PEER_BAN_S / 2)
+    assert len(torrent.blocked_ips) == PEER_BAN_MAX
+    torrent.unblock_expired_peers(now=PEER_BAN_S)
+    assert torrent.blocked_ips == {}
+    assert engine.calls[-1] == ("set_ip_filter", ([],))
@@ -0,0 +1,134 @@
+import asyncio
+
+from starlette.requests import Request
+
+from lib.custom_responses import LoadingTorrentFileResponse, file_validators
+from lib.response_registry import ResponseRegistry, client_key
+
+SIZE = 10_000
+
+
+class FakeHandler:
+    def __init__(self) -> None:
+        self.release: asyncio.Event = asyncio.Event()
+
+    async def iter_pieces(self, start: int, end: int):
+        while start < end:
+            await self.release.wait()
+            yield b"x" * min(1000, end - start)
+            start += 1000
+
+
+def _request(player: str | None, http_range: str | None = None) -> Request:
+    headers = [] if http_range is None else [(b"range", http_range.encode())]
+    query = b"" if player is None else f"player={player}".encode()
+    return Request(
+        {
+            "type": "http",
+            "method": "GET",
+            "path": "/",
+            "query_string": query,
+            "headers": headers,
+            "client": ("10.0.0.1", 50000),
+        }
+    )
+
+
+def _response(handler: FakeHandler, request: Request) -> LoadingTorrentFileResponse:
+    return LoadingTorrentFileResponse(
+        handler,  # pyright: ignore[reportArgumentType]
+        file_validators("abc", 0, SIZE),
+        request,
+        "video.mkv",
+    )
+
+
+async def _serve(response: LoadingTorrentFileResponse) -> list[dict]:
+    messages: list[dict] = []
+
+    async def receive():
+        return {"type": "http.request"}
+
+    async def send(message: dict):
+        messages.append(message)
+
+    await response(response.request.scope, receive, send)
+    return messages
+
+
+def test_client_key():
+    assert client_key(_request("3")) == "3"
+    assert client_key(_request(None)) is None
+
+
+def _body_size(messages: list[dict]) -> int:
+    return sum(len(m.get("body", b"")) for m in messages)
+
+
+def test_new_range_supersedes_older_response():
+    registry = ResponseRegistry()
+
+    async def scenario():
+        handler = FakeHandler()
+
+        def start(player: str, http_range: str):
+            response = _response(handler, _request(player, http_range))
+            registry.add(client_key(response.request), response)
+            return response, asyncio.create_task(_serve(response))
+
+        first, first_task = start("1", "bytes=0-4999")
+        # Another player of the same user on the same host
+        other, other_task = start("2", "bytes=0-4999")
+        # Overlapping ranges of one player are fetched side by side
+        ahead, ahead_task = start("1", "bytes=4000-5999")
+        await asyncio.sleep(0.01)
+        assert registry.busy
+        assert not first.finished
+
+        # A range apart from both is a seek
+        seek, seek_task = start("1", "bytes=8000-")
+        _ = await asyncio.wait_for(asyncio.gather(first_task, ahead_task), 1)
+        assert registry.responses["1"] == [seek]
+        assert not other.finished
+
+        handler.release.set()
+        return await first_task, await seek_task, await other_task
+
+    first, seek, other = asyncio.run(scenario())
+
+    assert _body_size(first) < 5000
+    assert _body_size(seek) == 2000
+    assert _body_size(other) == 5000
+    assert len(registry) == 0
+    assert not registry.busy
+
+
+def test_players_without_id_are_never_superseded():
+    registry = ResponseRegistry()
+    first = _response(FakeHandler(), _request(None, "bytes=0-99"))
+    second = _response(FakeHandler(), _request(None, "bytes=5000-"))
+
+    registry.add(client_key(first.request), first)
+    registry.add(client_key(second.request), second)
+
+    assert not first._cancelled  # pyright: ignore[reportPrivateUsage]
+    assert len(registry) == 2
+
+
+def test_cancel_all():
+    registry = ResponseRegistry()
+
+    async def scenario():
+        handler = FakeHandler()
+        response = _response(handler, _request("1"))
+        registry.add(client_key(response.request), response)
+        task = asyncio.create_task(_serve(response))
+        await asyncio.sleep(0.01)
+        registry.cancel_all()
+        _ = await asyncio.wait_for(task, 1)
+        return response
+
+    response = asyncio.run(scenario())
+
+    assert response.finished
+    assert len(registry) == 0
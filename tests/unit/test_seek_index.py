@@ -0,0 +1,212 @@
+import asyncio
+import random
+import struct
+
+from pytest import mark, raises
+
+from lib.commands.client_commands import (
+    SEEK_THRESHOLD_S,
+    PauseClientCommand,
+    SuspendClientCommand,
+)
+from lib.commands.command_handlers import StateChangeCommandsHandler
+from lib.containers.exceptions import (
+    ContainerParseException,
+    UnknownContainerException,
+)
+from lib.containers.index_builder import build_seek_index
+from lib.containers.seek_index import SeekIndex, SeekPoint
+from lib.video_status.status_storage import StatusHandler
+from lib.video_status.video_statuses import PauseStatus
+
+
+def box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type: bytes, payload: bytes, version: int = 0) -> bytes:
+    return box(box_type, bytes([version, 0, 0, 0]) + payload)
+
+
+def table(fmt: str, entries: list[tuple[int, ...]]) -> bytes:
+    return struct.pack(">I", len(entries)) + b"".join(
+        struct.pack(fmt, *entry) for entry in entries
+    )
+
+
+def build_mp4(chunk_offsets: list[int]) -> bytes:
+    """10 samples of 100 bytes at 25 fps in timescale 1000, 5 per chunk,
+    keyframes are the 1st and the 6th samples."""
+    stbl = box(
+        b"stbl",
+        full_box(b"stts", table(">II", [(10, 40)]))
+        + full_box(b"stss", table(">I", [(1,), (6,)]))
+        + full_box(b"stsc", table(">III", [(1, 5, 1)]))
+        + full_box(b"stsz", struct.pack(">II", 0, 10) + struct.pack(">10I", *[100] * 10))
+        + full_box(b"stco", table(">I", [(o,) for o in chunk_offsets])),
+    )
+    mdia = box(
+        b"mdia",
+        full_box(b"mdhd", struct.pack(">IIII", 0, 0, 1000, 400) + b"\0" * 4)
+        + full_box(b"hdlr", struct.pack(">I4s", 0, b"vide") + b"\0" * 13)
+        + box(b"minf", stbl),
+    )
+    mvhd = full_box(b"mvhd", struct.pack(">IIII", 0, 0, 600, 240) + b"\0" * 80)
+    return box(b"moov", mvhd + box(b"trak", mdia))
+
+
+def ebml_size(size: int) -> bytes:
+    return (size | 1 << 56).to_bytes(8, "big")
+
+
+def element(element_id: int, payload: bytes) -> bytes:
+    id_bytes = element_id.to_bytes((element_id.bit_length() + 7) // 8, "big")
+    return id_bytes + ebml_size(len(payload)) + payload
+
+
+def uint(element_id: int, value: int) -> bytes:
+    return element(element_id, value.to_bytes(4, "big"))
+
+
+def build_mkv() -> bytes:
+    """Seconds 0, 2 and 4 in clusters at segment positions 100, 200, 300"""
+    info = element(
+        0x1549A966,
+        uint(0x2AD7B1, 1_000_000) + element(0x4489, struct.pack(">d", 6000.0)),
+    )
+    cues = element(
+        0x1C53BB6B,
+        b"".join(
+            element(
+                0xBB,
+                uint(0xB3, time) + element(0xB7, uint(0xF7, 1) + uint(0xF1, position)),
+            )
+            for time, position in [(0, 100), (2000, 200), (4000, 300)]
+        ),
+    )
+    cues_position = 2048
+    seek_head = element(
+        0x114D9B74,
+        element(0x4DBB, uint(0x53AB, 0x1C53BB6B) + uint(0x53AC, cues_position)),
+    )
+    segment_head = seek_head + info
+    void = element(0xEC, b"\0" * (cues_position - len(segment_head) - 9))
+    segment_data = segment_head + void + cues
+    header = element(0x1A45DFA3, uint(0x4282, 0))
+    return header + element(0x18538067, segment_data)
+
+
+def reader(data: bytes):
+    async def read(start: int, length: int) -> bytes:
+        return data[start : start + length]
+
+    return read
+
+
+def test_seek_index_lookup():
+    index = SeekIndex(10, [SeekPoint(5, 500), SeekPoint(0, 10)])
+    assert index.byte_at(0) == 10
+    assert index.byte_at(4.9) == 10
+    assert index.byte_at(7) == 500
+    assert index.bitrate(1000) == 100
+
+
+def test_mp4_faststart():
+    ftyp = box(b"ftyp", b"isom" + b"\0" * 4)
+    moov_size = len(build_mp4([0, 0]))
+    mdat_offset = len(ftyp) + moov_size + 8
+    moov = build_mp4([mdat_offset, mdat_offset + 500])
+    data = ftyp + moov + box(b"mdat", b"\0" * 1000)
+
+    index = asyncio.run(build_seek_index(reader(data), len(data)))
+
+    assert index.duration == 0.4
+    assert index.points == [
+        SeekPoint(0, mdat_offset),
+        SeekPoint(0.2, mdat_offset + 500),
+    ]
+
+
+def test_mp4_moov_at_end():
+    ftyp = box(b"ftyp", b"isom" + b"\0" * 4)
+    mdat_offset = len(ftyp) + 8
+    data = ftyp + box(b"mdat", b"\0" * 1000) + build_mp4([mdat_offset, mdat_offset + 500])
+
+    index = asyncio.run(build_seek_index(reader(data), len(data)))
+
+    assert index.byte_at(0.3) == mdat_offset + 500
+
+
+def test_mkv_cues():
+    data = build_mkv()
+
+    index = asyncio.run(build_seek_index(reader(data), len(data)))
+
+    segment_start = data.index((0x18538067).to_bytes(4, "big")) + 12
+    assert index.duration == 6
+    assert index.byte_at(3) == segment_start + 200
+    assert index.byte_at(10) == segment_start + 300
+
+
+def _mp4_faststart() -> bytes:
+    ftyp = box(b"ftyp", b"isom" + b"\0" * 4)
+    mdat_offset = len(ftyp) + len(build_mp4([0, 0])) + 8
+    moov = build_mp4([mdat_offset, mdat_offset + 500])
+    return ftyp + moov + box(b"mdat", b"\0" * 1000)
+
+
+def _broken_copies(data: bytes, rng: random.Random) -> list[tuple[bytes, int]]:
+    """Files cut at every byte, alone and with their original size, and
+    files with a few random bytes changed"""
+    samples = [(data[:cut], size) for cut in range(len(data)) for size in (cut, len(data))]
+    for _ in range(300):
+        broken = bytearray(data)
+        for _ in range(rng.randint(1, 4)):
+            broken[rng.randrange(len(data))] = rng.randrange(256)
+        samples.append((bytes(broken), len(data)))
+    return samples
+
+
+@mark.parametrize("build", [_mp4_faststart, build_mkv], ids=["mp4", "mkv"])
+def test_broken_files_fail_with_parse_errors(build):
+    samples = _broken_copies(build(), random.Random(31))
+
+    async def scenario():
+        for data, size in samples:
+            try:
+                _ = await build_seek_index(reader(data), size)
+            except ContainerParseException:
+                pass
+
+    asyncio.run(scenario())
+
+
+def test_zero_timescale_is_rejected():
+    data = _mp4_faststart()
+    mdhd = data.index(b"mdhd")
+    # Timescale follows version, flags and two timestamps
+    data = data[: mdhd + 16] + b"\0" * 4 + data[mdhd + 20 :]
+
+    with raises(ContainerParseException, match="zero timescale"):
+        _ = asyncio.run(build_seek_index(reader(data), len(data)))
+
+
+def test_unknown_container():
+    data = b"\0" * 100
+    with raises(UnknownContainerException):
+        _ = asyncio.run(build_seek_index(reader(data), len(data)))
+
+
+@mark.parametrize(
+    "command,expected",
+    [
+        (SuspendClientCommand(0, 10 + SEEK_THRESHOLD_S + 1), [10 + SEEK_THRESHOLD_S + 1]),
+        (SuspendClientCommand(0, 10.5), []),
+        (PauseClientCommand(0, 100), []),
+    ],
+)
+def test_seek_listener(command, expected):
+    seeks: list[float] = []
+    handler = StateChangeCommandsHandler(StatusHandler(PauseStatus(10, 0)), seeks.append)
+    handler.handle(command)
+    assert seeks == expected
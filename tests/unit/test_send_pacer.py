@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+from starlette.requests import Request
+
+from lib.custom_responses import LoadingTorrentFileResponse, file_validators
+from lib.send_pacer import SendPacer
+
+SIZE = 8000
+CHUNK = 1000
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now: float = 0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_burst_then_rate():
+    clock = Clock()
+    pacer = SendPacer(lambda position: 100, burst=1000, clock=clock)
+
+    assert pacer.reserve(0, 1000) == 0
+    assert pacer.reserve(1000, 200) == pytest.approx(2)
+    clock.now = 2
+    assert pacer.reserve(1200, 100) == pytest.approx(1)
+
+
+def test_idle_reader_gets_no_new_burst():
+    clock = Clock()
+    pacer = SendPacer(lambda position: 100, burst=1000, clock=clock)
+    _ = pacer.reserve(0, 1000)
+
+    clock.now = 60
+    assert pacer.reserve(1000, 100) == 0
+    assert pacer.reserve(1100, 100) == pytest.approx(1)
+
+
+def test_unpaced_positions_are_free():
+    clock = Clock()
+    pacer = SendPacer(
+        lambda position: None if position >= 5000 else 100, burst=0, clock=clock
+    )
+
+    assert pacer.reserve(5000, 10_000) == 0
+    assert pacer.reserve(0, 100) == pytest.approx(1)
+
+
+class RecordingPacer(SendPacer):
+    def __init__(self) -> None:
+        super().__init__(lambda position: None, burst=0)
+        self.waits: list[tuple[int, int]] = []
+
+    async def wait(self, position: int, size: int):
+        self.waits.append((position, size))
+
+
+class FakeTorrent:
+    def piece_bytes_offset(self, file_id: int, byte: int) -> tuple[int, int]:
+        return byte // CHUNK, byte % CHUNK
+
+
+class FakeHandler:
+    def __init__(self) -> None:
+        self.torrent: FakeTorrent = FakeTorrent()
+        self.file_index: int = 0
+
+    async def iter_pieces(self, start: int, end: int):
+        while start < end:
+            size = min(CHUNK, end - start)
+            yield b"x" * size
+            start += size
+
+
+def _paced(range_header: str) -> list[tuple[int, int]]:
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/",
+        "headers": [(b"range", range_header.encode())],
+    }
+    response = LoadingTorrentFileResponse(
+        FakeHandler(),  # pyright: ignore[reportArgumentType]
+        file_validators("abc", 0, SIZE),
+        Request(scope),
+        "video.mkv",
+    )
+    pacer = RecordingPacer()
+    response.pacer = pacer
+
+    async def receive():
+        return {"type": "http.request"}
+
+    async def send(message: dict):
+        pass
+
+    asyncio.run(response(scope, receive, send))
+    return pacer.waits
+
+
+def test_responses_pace_every_chunk():
+    assert _paced("bytes=2500-5499") == [(2500, 1000), (3500, 1000), (4500, 1000)]
+    assert _paced("bytes=0-999,6000-6499") == [(0, 1000), (6000, 500)]
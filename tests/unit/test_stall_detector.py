@@ -0,0 +1,191 @@
+from collections import defaultdict
+
+import pytest
+
+from lib.torrent.deadline_scheduler import DeadlineScheduler
+from lib.torrent.stall_detector import (
+    STALL_PROGRESS_TIMEOUT_S,
+    StallDetector,
+    StallLevel,
+)
+
+
+class FakeTorrent:
+    def __init__(self) -> None:
+        self.have_pieces: set[int] = set()
+        self.deadline_calls: list[tuple[int, int]] = []
+        self.reset_calls: list[int] = []
+        self.downloading: dict[int, set[str]] = {}
+        self.peers: int = 5
+        self.blocked: set[str] = set()
+        self.reads: list[int] = []
+
+    def have_piece(self, piece_id: int) -> bool:
+        return piece_id in self.have_pieces
+
+    def set_piece_deadline(self, piece_id: int, deadline_s: int, flags: int = 0):
+        self.deadline_calls.append((piece_id, deadline_s))
+
+    def reset_piece_deadline(self, piece_id: int):
+        self.reset_calls.append(piece_id)
+
+    def peers_downloading(self, piece_id: int) -> set[str]:
+        return self.downloading.get(piece_id, set())
+
+    def peers_count(self) -> int:
+        return self.peers
+
+    def block_peers(self, ips):
+        self.blocked.update(ips)
+
+    def unblock_expired_peers(self, now: float):
+        pass
+
+    def read_piece(self, piece_id: int):
+        self.reads.append(piece_id)
+
+
+class FakePieceGetter:
+    def __init__(self) -> None:
+        self.piece_required_at: dict[int, tuple[float, int]] = {}
+        self.read: set[int] = set()
+
+    def is_read(self, piece_id: int) -> bool:
+        return piece_id in self.read
+
+
+class FakeBlockTracker:
+    def __init__(self) -> None:
+        self.finished_blocks: defaultdict[int, set[int]] = defaultdict(set)
+
+
+@pytest.fixture
+def setup():
+    torrent = FakeTorrent()
+    getter = FakePieceGetter()
+    tracker = FakeBlockTracker()
+    detector = StallDetector(torrent, getter, tracker, DeadlineScheduler(torrent))
+    return torrent, getter, tracker, detector
+
+
+def _stall(detector: StallDetector, now: float) -> float:
+    now += STALL_PROGRESS_TIMEOUT_S
+    detector.check(now)
+    return now
+
+
+def test_progressing_piece_is_not_escalated(setup):
+    torrent, getter, tracker, detector = setup
+    getter.piece_required_at[7] = (0, 60_000)
+    detector.check(0)
+    for step in range(1, 5):
+        tracker.finished_blocks[7].add(step)
+        detector.check(step * STALL_PROGRESS_TIMEOUT_S)
+    assert detector.pieces[7].level == StallLevel.NONE
+    assert not detector.at_risk
+    assert torrent.deadline_calls == []
+
+
+def test_stalled_piece_escalates_step_by_step(setup):
+    torrent, getter, _, detector = setup
+    torrent.downloading[7] = {"10.0.0.1"}
+    getter.piece_required_at[7] = (0, 60_000)
+    detector.check(0)
+
+    now = _stall(detector, 0)
+    assert detector.pieces[7].level == StallLevel.TIGHTEN_DEADLINE
+    assert detector.at_risk
+    assert torrent.deadline_calls == [(7, 0)]
+
+    now = _stall(detector, now)
+    assert detector.pieces[7].level == StallLevel.REREQUEST
+    assert torrent.reset_calls == [7]
+
+    now = _stall(detector, now)
+    assert detector.pieces[7].level == StallLevel.DROP_PEERS
+    assert torrent.blocked == {"10.0.0.1"}
+
+
+def test_escalation_keeps_deadlines_of_others(setup):
+    torrent, getter, _, detector = setup
+    detector.scheduler.set_piece_deadline("room", 7, 60_000, now=0)
+    getter.piece_required_at[7] = (0, 60_000)
+    detector.check(0)
+    now = _stall(detector, 0)
+    now = _stall(detector, now)
+    assert torrent.reset_calls == [7]
+    assert torrent.deadline_calls == [(7, 60_000), (7, 0), (7, 0)]
+
+    # The room still wants the piece, libtorrent keeps its deadline
+    del getter.piece_required_at[7]
+    detector.check(now)
+    assert torrent.reset_calls == [7]
+    assert detector.scheduler.merged(7) == (60, 0)
+
+    detector.scheduler.reset_piece_deadline("room", 7)
+    assert torrent.reset_calls == [7, 7]
+
+
+def test_missed_deadline_escalates(setup):
+    _, getter, _, detector = setup
+    getter.piece_required_at[7] = (0, 0)
+    detector.check(0)
+    detector.check(STALL_PROGRESS_TIMEOUT_S / 2)
+    assert detector.pieces[7].level == StallLevel.TIGHTEN_DEADLINE
+
+
+def test_never_drops_every_peer(setup):
+    torrent, getter, _, detector = setup
+    torrent.peers = 1
+    torrent.downloading[7] = {"10.0.0.1"}
+    getter.piece_required_at[7] = (0, 60_000)
+    detector.check(0)
+    now = 0
+    for _ in range(3):
+        now = _stall(detector, now)
+    assert detector.pieces[7].level == StallLevel.DROP_PEERS
+    assert torrent.blocked == set()
+
+
+def test_finished_piece_clears_risk(setup):
+    torrent, getter, _, detector = setup
+    getter.piece_required_at[7] = (0, 60_000)
+    detector.check(0)
+    _stall(detector, 0)
+    assert detector.at_risk
+    torrent.have_pieces.add(7)
+    detector.check(100)
+    assert not detector.at_risk
+
+
+def test_peers_are_dropped_once_per_piece(setup):
+    torrent, getter, _, detector = setup
+    torrent.downloading[7] = {"10.0.0.1"}
+    getter.piece_required_at[7] = (0, 60_000)
+    detector.check(0)
+    now = 0
+    for _ in range(3):
+        now = _stall(detector, now)
+    calls = (list(torrent.deadline_calls), list(torrent.reset_calls))
+
+    for _ in range(3):
+        now = _stall(detector, now)
+    assert detector.pieces[7].level == StallLevel.DROP_PEERS
+    assert (torrent.deadline_calls, torrent.reset_calls) == calls
+
+
+def test_unread_piece_is_read_again(setup):
+    torrent, getter, _, detector = setup
+    getter.piece_required_at[7] = (0, 60_000)
+    torrent.have_pieces.add(7)
+    detector.check(0)
+    detector.check(STALL_PROGRESS_TIMEOUT_S / 2)
+    assert torrent.reads == []
+
+    now = _stall(detector, 0)
+    assert torrent.reads == [7]
+
+    getter.read.add(7)
+    _ = _stall(detector, now)
+    assert torrent.reads == [7]
+    assert detector.reads == {}
@@ -0,0 +1,105 @@
+import libtorrent as lt
+import pytest
+
+from lib.torrent.deadline_scheduler import DeadlineScheduler
+from lib.torrent.torrent_info import SetDeadlineFlags
+from lib.torrent.torrent_registry import TorrentRegistry
+
+ALERT = SetDeadlineFlags.ALERT_WHEN_AVAILABLE
+
+
+class FakeTorrent:
+    def __init__(self) -> None:
+        self.deadlines: dict[int, tuple[int, int]] = {}
+        self.deadline_calls: int = 0
+
+    def set_piece_deadline(self, piece_id: int, deadline_s: int, flags: int = 0):
+        self.deadline_calls += 1
+        self.deadlines[piece_id] = (deadline_s, flags)
+
+    def reset_piece_deadline(self, piece_id: int):
+        _ = self.deadlines.pop(piece_id, None)
+
+
+@pytest.fixture
+def scheduler():
+    return DeadlineScheduler(FakeTorrent())  # pyright: ignore[reportArgumentType]
+
+
+def test_earliest_deadline_wins(scheduler):
+    scheduler.set_piece_deadline("room1", 5, 500, now=0)
+    scheduler.set_piece_deadline("room2", 5, 100, now=0)
+    scheduler.set_piece_deadline("room1", 5, 10, now=0.05)
+
+    assert scheduler.torrent.deadlines[5] == (10, 0)
+    assert scheduler.torrent.deadline_calls == 3
+
+
+def test_later_deadline_is_not_applied(scheduler):
+    scheduler.set_piece_deadline("room1", 5, 100, now=0)
+    scheduler.set_piece_deadline("room2", 5, 500, now=0)
+
+    assert scheduler.torrent.deadlines[5] == (100, 0)
+    assert scheduler.torrent.deadline_calls == 1
+
+
+def test_alert_request_always_reaches_torrent(scheduler):
+    scheduler.set_piece_deadline("room1", 5, 0, now=0)
+    scheduler.set_piece_deadline("getter", 5, 10, ALERT, now=0)
+
+    assert scheduler.torrent.deadlines[5] == (0, ALERT)
+
+
+def test_clear_keeps_pieces_others_want(scheduler):
+    scheduler.set_piece_deadline("room1", 1, 0, now=0)
+    scheduler.set_piece_deadline("room1", 2, 0, now=0)
+    scheduler.set_piece_deadline("room2", 2, 0, now=0)
+
+    scheduler.clear("room1")
+
+    assert list(scheduler.torrent.deadlines) == [2]
+    scheduler.clear("room2")
+    assert scheduler.torrent.deadlines == {}
+
+
+@pytest.fixture
+def torrent_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(TorrentRegistry, "SAVE_PATH", tmp_path / "payload")
+    monkeypatch.setattr(TorrentRegistry, "torrents", {})
+    (tmp_path / "video.mkv").write_bytes(b"x" * 100_000)
+    fs = lt.file_storage()
+    lt.add_files(fs, str(tmp_path / "video.mkv"))
+    ct = lt.create_torrent(fs, 16 * 1024)
+    lt.set_piece_hashes(ct, str(tmp_path))
+    path = tmp_path / "video.torrent"
+    path.write_bytes(lt.bencode(ct.generate()))
+    return str(path)
+
+
+def test_rooms_share_one_handle(torrent_path):
+    first = TorrentRegistry.acquire(torrent_path, "room1")
+    second = TorrentRegistry.acquire(torrent_path, "room2")
+    assert first is second
+    assert len(TorrentRegistry.torrents) == 1
+
+    TorrentRegistry.release(first, "room1")
+    assert TorrentRegistry.torrents == {first.infohash: first}
+    TorrentRegistry.release(first, "room1")
+    assert first.owners == {"room2"}
+
+    TorrentRegistry.release(first, "room2")
+    assert TorrentRegistry.torrents == {}
+    assert TorrentRegistry.acquire(torrent_path, "room1") is not first
+
+
+def test_download_limit_needs_every_owner(torrent_path):
+    shared = TorrentRegistry.acquire(torrent_path, "room1")
+    _ = TorrentRegistry.acquire(torrent_path, "room2")
+    limits: list[int] = []
+    shared.torrent.set_download_limit = limits.append
+
+    shared.set_download_limit("room1", 1000)
+    shared.set_download_limit("room2", 500)
+    TorrentRegistry.release(shared, "room1")
+
+    assert limits == [0, 1000, 500]
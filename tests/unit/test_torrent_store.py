@@ -0,0 +1,51 @@
+import asyncio
+import os
+import time
+
+import libtorrent as lt
+import pytest
+
+from services.torrent_store import GC_GRACE_S, TorrentStore, infohash
+
+
+def _torrent_content(tmp_path, data: bytes) -> bytes:
+    (tmp_path / "video.mkv").write_bytes(data)
+    fs = lt.file_storage()
+    lt.add_files(fs, str(tmp_path / "video.mkv"))
+    ct = lt.create_torrent(fs, 16 * 1024)
+    lt.set_piece_hashes(ct, str(tmp_path))
+    return lt.bencode(ct.generate())
+
+
+@pytest.fixture
+def store_path(tmp_path, monkeypatch):
+    path = tmp_path / "torrents"
+    monkeypatch.setattr(TorrentStore, "save_path", path)
+    return path
+
+
+def test_same_torrent_is_stored_once(tmp_path, store_path):
+    content = _torrent_content(tmp_path, b"x" * 50_000)
+
+    first = asyncio.run(TorrentStore.store(content))
+    second = asyncio.run(TorrentStore.store(content))
+
+    assert first == second == store_path / infohash(content)
+    assert first.read_bytes() == content
+    assert list(store_path.iterdir()) == [first]
+
+
+def test_remove_unreferenced(tmp_path, store_path):
+    referenced = asyncio.run(TorrentStore.store(_torrent_content(tmp_path, b"a" * 1000)))
+    stale = asyncio.run(TorrentStore.store(_torrent_content(tmp_path, b"b" * 1000)))
+    fresh = asyncio.run(TorrentStore.store(_torrent_content(tmp_path, b"c" * 1000)))
+    old = time.time() - GC_GRACE_S - 1
+    for path in (referenced, stale):
+        os.utime(path, (old, old))
+
+    removed = TorrentStore.remove_unreferenced(
+        {referenced.as_posix()}, [referenced, stale, fresh]
+    )
+
+    assert removed == [stale]
+    assert referenced.exists() and fresh.exists()
@@ -0,0 +1,235 @@
+import asyncio
+import shutil
+from typing import cast
+
+import libtorrent as lt
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.requests import Request
+
+import config
+from lib.containers.seek_index import SeekIndex
+from lib.custom_responses import CompletedFileResponse
+from lib.room import RoomStorage
+from lib.torrent.torrent_registry import TorrentRegistry
+from lib.video_sources import TorrentVideoSource
+from models.room_model import RoomModel, VideoSourcesEnum
+
+
+@pytest.fixture
+def torrent_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(TorrentRegistry, "SAVE_PATH", tmp_path / "payload")
+    monkeypatch.setattr(TorrentRegistry, "torrents", {})
+    folder = tmp_path / "show"
+    folder.mkdir()
+    for name in ("e02.mkv", "e01.mkv"):
+        (folder / name).write_bytes(b"x" * 100_000)
+    # Sorted between the episodes
+    for name in ("e01.sample.mkv", "e01.srt"):
+        (folder / name).write_bytes(b"x" * 1_000)
+    fs = lt.file_storage()
+    lt.add_files(fs, str(folder))
+    ct = lt.create_torrent(fs, 16 * 1024)
+    lt.set_piece_hashes(ct, str(tmp_path))
+    path = tmp_path / "show.torrent"
+    path.write_bytes(lt.bencode(ct.generate()))
+    return str(path)
+
+
+def test_metadata_without_engine(torrent_path):
+    source = TorrentVideoSource(torrent_path, 0)
+
+    assert TorrentRegistry.torrents == {}
+    names = [name for _, name in source.get_available_files()]
+    assert names.index("e01.mkv") < names.index("e02.mkv")
+    assert source.set_file_index(names.index("e02.mkv"))
+    assert source.file_size == 100_000
+    assert len(source.file_span_pieces(source.file_index, 0, None)) == 7
+    assert source.seconds_buffered(0) is None
+    assert source.buffer_state(0) is None
+    assert not source.at_risk
+
+
+def test_engine_starts_on_demand_and_idles(torrent_path):
+    source = TorrentVideoSource(torrent_path, 0)
+
+    async def scenario():
+        handler = source.engine()
+        assert source.engine() is handler
+        assert len(TorrentRegistry.torrents) == 1
+        source.stop()
+
+    asyncio.run(scenario())
+
+    assert TorrentRegistry.torrents == {}
+    assert source.torrent_manager is None
+    # Idle keeps downloaded data, only unloading the room removes it
+    assert list(TorrentRegistry.SAVE_PATH.iterdir())
+
+
+def test_unloading_after_idle_stop_removes_files(torrent_path):
+    source = TorrentVideoSource(torrent_path, 0)
+
+    async def scenario():
+        _ = source.engine()
+        source.stop()
+        payload = TorrentRegistry.SAVE_PATH / source.metadata.infohash
+        assert payload.exists()
+        source.cleanup()
+        await asyncio.sleep(0.5)
+        return payload
+
+    payload = asyncio.run(scenario())
+
+    assert not payload.exists()
+
+
+def test_completed_file_is_served_from_disk(torrent_path, tmp_path):
+    source = TorrentVideoSource(torrent_path, 0)
+    names = [name for _, name in source.get_available_files()]
+    assert source.set_file_index(names.index("e01.mkv"))
+    payload = TorrentRegistry.SAVE_PATH / source.metadata.infohash
+    shutil.copytree(tmp_path / "show", payload / "show")
+    request = Request(
+        {
+            "type": "http",
+            "method": "GET",
+            "path": "/",
+            "query_string": b"",
+            "headers": [],
+            "client": None,
+        }
+    )
+
+    async def scenario():
+        handler = source.engine()
+        for _ in range(100):
+            if handler.file_completed:
+                break
+            await asyncio.sleep(0.05)
+        response = await source.get_video_response(request, "bob")
+        source.stop()
+        return response
+
+    response = asyncio.run(scenario())
+
+    assert isinstance(response, CompletedFileResponse)
+    assert response.path.endswith("e01.mkv")
+
+
+def test_pacing_is_lifted_near_playhead(torrent_path, monkeypatch):
+    source = TorrentVideoSource(torrent_path, 0)
+    assert source.pacer() is None
+
+    monkeypatch.setattr(config, "PACING_BITRATE_MULTIPLE", 2)
+    monkeypatch.setattr(config, "PACING_FREE_AHEAD_S", 10)
+    assert source.pacer() is not None
+    rate = source.DEFAULT_BITRATE * 2
+    assert source.pacing_rate(0) == rate
+
+    source.playhead_byte = 1000
+    assert source.pacing_rate(999) == rate
+    assert source.pacing_rate(1000) is None
+    assert source.pacing_rate(1000 + source.DEFAULT_BITRATE * 10) == rate
+
+
+def test_bitrate_comes_from_duration(torrent_path):
+    source = TorrentVideoSource(torrent_path, 0)
+    names = [name for _, name in source.get_available_files()]
+    _ = source.set_file_index(names.index("e01.mkv"))
+    assert source.bitrate == source.DEFAULT_BITRATE
+    assert source.byte_at(0.05) == int(0.05 * source.DEFAULT_BITRATE)
+
+    source.seek_index = SeekIndex(duration=100)
+    assert source.bitrate == 1000
+    assert source.byte_at(10) == 10_000
+    # Another episode is assumed to be as long as the current one
+    assert source.file_byte_at(names.index("e02.mkv"), 10) == 10_000
+
+
+def test_reloading_same_torrent_keeps_files(torrent_path, tmp_path, monkeypatch):
+    model = RoomModel(
+        name="room",
+        video_source=VideoSourcesEnum.torrent,
+        video_source_data=torrent_path,
+        img_link="",
+    )
+
+    async def get_room_id(session, room_id):
+        return model
+
+    monkeypatch.setattr(RoomModel, "get_room_id", get_room_id)
+    monkeypatch.setattr(RoomStorage, "loaded_rooms", {})
+    session = cast(AsyncSession, None)
+
+    async def scenario():
+        await RoomStorage.load_room(session, model.room_id)
+        room = RoomStorage.loaded_rooms[model.room_id]
+        room.start_video()
+        source = room.video_source
+        assert isinstance(source, TorrentVideoSource)
+        payload = TorrentRegistry.SAVE_PATH / source.metadata.infohash
+        shutil.copytree(tmp_path / "show", payload / "show")
+        # Nobody is inside, the new room does not take over the engine
+        await RoomStorage.load_room(session, model.room_id, ignore_if_loaded=False)
+        await asyncio.sleep(0.5)
+        kept = (payload / "show" / "e01.mkv").exists()
+        await RoomStorage.unload_room(model.room_id)
+        return kept
+
+    assert asyncio.run(scenario())
+
+
+class FakeHandler:
+    def __init__(self) -> None:
+        self.prefetched: list[int] = []
+
+    def set_file_index(self, file_index: int):
+        pass
+
+    def prefetch_file(self, file_index: int):
+        self.prefetched.append(file_index)
+
+
+def test_next_file_is_prefetched_once(torrent_path, monkeypatch):
+    monkeypatch.setattr(config, "NEXT_FILE_PREFETCH_AT", 0.8)
+    source = TorrentVideoSource(torrent_path, 0)
+    handler = FakeHandler()
+    source.torrent_manager = handler  # pyright: ignore[reportAttributeAccessIssue]
+    names = [name for _, name in source.get_available_files()]
+    _ = source.set_file_index(names.index("e01.mkv"))
+    source.seek_index = SeekIndex(duration=100)
+
+    source.prefetch_next(79)
+    assert handler.prefetched == []
+    source.prefetch_next(80)
+    source.prefetch_next(90)
+    next_file = source.file_mapping.sorted_to_original(names.index("e02.mkv"))
+    assert handler.prefetched == [next_file]
+
+    # The last episode has nothing after it
+    _ = source.set_file_index(names.index("e02.mkv"))
+    source.prefetch_next(100)
+    assert handler.prefetched == [next_file]
+
+
+def test_prefetch_skips_to_next_episode_and_resets(torrent_path, monkeypatch):
+    monkeypatch.setattr(config, "NEXT_FILE_PREFETCH_AT", 0.8)
+    source = TorrentVideoSource(torrent_path, 0)
+    names = [name for _, name in source.get_available_files()]
+    assert names.index("e01.mkv") < names.index("e01.srt") < names.index("e02.mkv")
+    _ = source.set_file_index(names.index("e01.mkv"))
+    assert source.next_episode() == names.index("e02.mkv")
+
+
+    async def scenario():
+        _ = source.engine()
+        source.seek_index = SeekIndex(duration=100)
+        source.prefetch_next(90)
+        assert source.prefetched == {names.index("e02.mkv")}
+        # A restarted engine prefetches again
+        source.stop()
+
+    asyncio.run(scenario())
+
+    assert source.prefetched == set()
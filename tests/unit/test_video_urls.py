@@ -0,0 +1,109 @@
+import asyncio
+from urllib.parse import parse_qs, urlsplit
+from uuid import uuid4
+
+import pytest
+from starlette.requests import Request
+
+import lib.auth as auth_module
+from lib.auth import sign_video_query, verify_video_signature, video_user
+from lib.http_exceptions import NotFound, Unauthorized
+from lib.room import Room, signed_video_url
+from lib.video_sources import HttpLinkVideoSource
+from lib.video_status.status_storage import StatusHandler
+
+ROOM_ID = uuid4()
+NOW = 1_700_000_000
+
+
+def signed(now: float | None = NOW) -> dict[str, str]:
+    query = parse_qs(sign_video_query(ROOM_ID, 3, "alice", now=now))
+    return {key: value[0] for key, value in query.items()}
+
+
+def test_signature_is_verified():
+    params = signed()
+
+    assert params["user"] == "alice"
+    assert int(params["expires"]) >= NOW + auth_module.VIDEO_URL_EXPIRE
+    verify_video_signature(
+        ROOM_ID, 3, "alice", int(params["expires"]), params["sig"], now=NOW
+    )
+
+
+@pytest.mark.parametrize(
+    "room_id, file_index, user, expires_shift",
+    [
+        (uuid4(), 3, "alice", 0),
+        (ROOM_ID, 4, "alice", 0),
+        (ROOM_ID, 3, "bob", 0),
+        (ROOM_ID, 3, "alice", 3600),
+    ],
+)
+def test_signature_covers_every_field(room_id, file_index, user, expires_shift):
+    params = signed()
+    expires = int(params["expires"]) + expires_shift
+
+    with pytest.raises(Unauthorized) as exc_info:
+        verify_video_signature(
+            room_id, file_index, user, expires, params["sig"], now=NOW
+        )
+    assert exc_info.value.msg == "Invalid video signature"
+
+
+def test_expired_url_is_rejected():
+    params = signed()
+    expires = int(params["expires"])
+
+    with pytest.raises(Unauthorized) as exc_info:
+        verify_video_signature(
+            ROOM_ID, 3, "alice", expires, params["sig"], now=expires + 1
+        )
+    assert exc_info.value.msg == "Video URL expired"
+
+
+def test_url_is_stable_for_a_while():
+    first = sign_video_query(ROOM_ID, 3, "alice", now=NOW)
+
+    assert sign_video_query(ROOM_ID, 3, "alice", now=NOW + 60) == first
+
+
+def test_signed_room_url():
+    url = urlsplit(signed_video_url(ROOM_ID, 3, "alice"))
+
+    assert url.path == f"/files/{ROOM_ID}/3"
+    assert parse_qs(url.query)["user"] == ["alice"]
+
+
+def _request() -> Request:
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": []})
+
+
+def test_video_user_from_signed_url(monkeypatch):
+    async def no_token_auth(token):
+        raise AssertionError("Signed requests do not hit the database")
+
+    monkeypatch.setattr(auth_module, "current_user", no_token_auth)
+    params = signed(now=None)
+
+    user = asyncio.run(
+        video_user(
+            ROOM_ID, 3, _request(), "alice", int(params["expires"]), params["sig"]
+        )
+    )
+
+    assert user == "alice"
+
+
+def test_video_user_without_signature_needs_token():
+    with pytest.raises(Unauthorized):
+        asyncio.run(video_user(ROOM_ID, 3, _request()))
+
+
+def test_only_current_file_is_served():
+    source = HttpLinkVideoSource("http://origin.test/video.mp4", 3)
+    room = Room(ROOM_ID, "room", "", StatusHandler(), source, "")
+
+    room.check_file(3)
+    with pytest.raises(NotFound):
+        room.check_file(4)